@@ -0,0 +1,343 @@
+# app/bench.py
+"""
+Микробенчмарки поиска на синтетическом каталоге (без Google Sheets).
+
+    python -m app.bench phrase [строк]
+    python -m app.bench sheets          # живая таблица, нужен доступ к Google Sheets
+    python -m app.bench load [строк]    # загрузка каталога из XLSX / CSV / Parquet
+    python -m app.bench memory [строк]  # память каталога: как загружен vs compact
+    python -m app.bench norm [строк]    # нормализация: re.sub vs str.translate / по колонке / кеш
+"""
+import re
+import sys
+import time
+import random
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+import app.data as data
+
+
+# ---------- Синтетический каталог ----------
+def synthetic_catalog(n: int = 20000, seed: int = 42) -> pd.DataFrame:
+    rnd = random.Random(seed)
+    nouns = ["подшипник", "фильтр", "ремень", "датчик", "насос", "клапан", "шланг", "втулка"]
+    adjs = ["шариковый", "топливный", "масляный", "приводной", "давления", "гидравлический"]
+    mans = ["Bosch", "Mann", "SKF", "Festo", "Parker", "FAG", "Gates"]
+    lines = ["CSS OP-1100", "MG 2", "покраска", "сварка", "пресс 4"]
+
+    rows = []
+    for i in range(n):
+        noun = rnd.choice(nouns)
+        name = f"{noun} {rnd.choice(adjs)} {rnd.randint(6000, 6400)}"
+        rows.append({
+            "код": f"pi{i:05d}drg{rnd.randint(1, 999)}",
+            "наименование": name,
+            "тип": noun,
+            "oem": f"oem{rnd.randint(1, n // 5 + 1)}",
+            "изготовитель": rnd.choice(mans),
+            "парт номер": f"pn-{rnd.randint(1, n // 4 + 1)}",
+            "oem парт номер": f"x{rnd.randint(1, n // 4 + 1)}",
+            "описание": f"{name} для линии {rnd.choice(lines)}",
+            "количество": str(rnd.randint(0, 50)),
+            "цена": str(rnd.randint(1, 900)),
+            "валюта": rnd.choice(["USD", "UZS", "EUR"]),
+            "image": "",
+        })
+    return pd.DataFrame(rows)
+
+
+def use_catalog(df_: pd.DataFrame) -> None:
+    """
+    Ставим df_ каталогом напрямую (индексы + _install_catalog), минуя
+    ensure_fresh_data: тот сохранил бы снапшот и опубликовал версию.
+    """
+    data._install_catalog(df_, data.build_indexes(df_))
+
+
+def _isolate() -> None:
+    """Бенчмарк не пишет файлы рабочего экземпляра: снапшот, SQLite, координацию."""
+    from app import coordinator
+
+    data.SNAPSHOT_PATH = ""
+    data.SEARCH_DB_PATH = ""
+    coordinator.REFRESH_COORDINATOR = ""
+    coordinator._backend = None
+
+
+def _timeit(fn: Callable[[], object], repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _report(title: str, rows: List[Dict[str, object]]) -> None:
+    print(f"\n== {title} ==")
+    for r in rows:
+        print("  " + " | ".join(f"{k}={v}" for k, v in r.items()))
+
+
+# ---------- Фразы: позиционный индекс vs squash ----------
+def _squash_phrase(df_: pd.DataFrame, phrase: str) -> set:
+    """Текущий фолбэк из search_text: склейка поля + str.contains."""
+    q_squash = data.squash(phrase)
+    mask = pd.Series(False, index=df_.index)
+    for col in data.POSITIONAL_COLUMNS:
+        series = data._safe_col(df_, col)
+        if series is None:
+            continue
+        series_sq = series.str.replace(r"[\W_]+", "", regex=True)
+        mask |= series_sq.str.contains(re.escape(q_squash), na=False)
+    return set(df_.index[mask])
+
+
+def bench_phrase(n: int = 20000) -> None:
+    df_ = synthetic_catalog(n)
+    use_catalog(df_)
+
+    phrases = ["подшипник шариковый", "фильтр топливный 6205", "для линии css op"]
+    out = []
+    for ph in phrases:
+        terms = data._field_tokens("наименование", ph)
+        pos_hits: set = set()
+        for col in data.POSITIONAL_COLUMNS:
+            pos_hits |= data.match_phrase(col, terms)
+        sq_hits = _squash_phrase(df_, ph)
+
+        t_pos = _timeit(lambda: [data.match_phrase(c, terms) for c in data.POSITIONAL_COLUMNS])
+        t_sq = _timeit(lambda: _squash_phrase(df_, ph))
+        out.append({
+            "фраза": ph,
+            "positional_ms": f"{t_pos * 1000:.2f}",
+            "squash_ms": f"{t_sq * 1000:.2f}",
+            "x": f"{t_sq / max(t_pos, 1e-9):.0f}",
+            "hits": f"{len(pos_hits)}/{len(sq_hits)}",
+        })
+
+    terms = ["подшипник", "6205"]
+    t_prox = _timeit(lambda: data.match_phrase("наименование", terms, slop=3))
+    out.append({
+        "фраза": "подшипник ... 6205 (~3)",
+        "positional_ms": f"{t_prox * 1000:.2f}",
+        "squash_ms": "n/a",
+        "hits": len(data.match_phrase("наименование", terms, slop=3)),
+    })
+    _report(f"phrase, {n} строк", out)
+
+
+def bench_sheets(n: int = 0) -> None:
+    """
+    Живая таблица (нужны SPREADSHEET_URL и ключ сервисного аккаунта):
+    прежний путь (open_by_url + worksheet + get_all_values для SAP и пользователей)
+    против одного batchGet с выбранными колонками.
+    """
+    import json
+    from app import sheets
+
+    try:
+        client = data.get_gs_client()
+    except Exception as e:
+        print(f"== sheets: пропущено ({e})")
+        return
+
+    t0 = time.time()
+    sh = client.open_by_url(data.SPREADSHEET_URL)
+    old_vals = sh.worksheet(data.SAP_SHEET_NAME).get_all_values()
+    try:
+        users = sh.worksheet(data.USERS_SHEET_NAME).get_all_values()
+    except Exception:
+        users = []
+    t_old = time.time() - t0
+    b_old = len(json.dumps(old_vals, ensure_ascii=False).encode("utf-8")) + len(
+        json.dumps(users, ensure_ascii=False).encode("utf-8")
+    )
+
+    sheets._layout = {}
+    sheets._titles = None
+    sheets.fetch_all(client)  # первый раз: метаданные + раскладка колонок
+    t0 = time.time()
+    new_vals = sheets.fetch_all(client)
+    t_new = time.time() - t0
+    st = sheets.last_stats
+
+    _report("sheets", [{
+        "строк": len(new_vals) - 1,
+        "колонок": f"{st['columns']}/{st['columns_total']}",
+        "KB_было": f"{b_old / 1024:.0f}",
+        "KB_стало": f"{st['bytes'] / 1024:.0f}",
+        "s_было": f"{t_old:.2f}",
+        "s_стало": f"{t_new:.2f}",
+        "запросов": f"6 → {st['requests']}",
+    }])
+
+
+def bench_load(n: int = 20000) -> None:
+    """
+    Файловые источники (app/sources.py) на синтетическом каталоге:
+    чтение файла + _load_sap_dataframe, без сети — воспроизводимо.
+    """
+    import os
+    import tempfile
+    from app import sources
+
+    df_ = synthetic_catalog(n)
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        writers = {
+            ".csv": lambda p: df_.to_csv(p, index=False),
+            ".xlsx": lambda p: df_.to_excel(p, index=False, sheet_name=data.SAP_SHEET_NAME),
+            ".parquet": lambda p: df_.to_parquet(p, index=False),
+        }
+        for ext, write in writers.items():
+            path = os.path.join(tmp, "catalog" + ext)
+            try:
+                write(path)
+            except Exception as e:
+                out.append({"формат": ext, "пропущено": str(e)[:60]})
+                continue
+            src = sources.make_source(data.get_gs_client, f"file:{path}")
+            prev = data._source
+            data._source = src
+            try:
+                t = _timeit(data._load_sap_dataframe, repeat=3)
+                rows = len(data._load_sap_dataframe())
+            finally:
+                data._source = prev
+            out.append({
+                "формат": ext,
+                "MB": f"{os.path.getsize(path) / 1e6:.1f}",
+                "строк": rows,
+                "s": f"{t:.2f}",
+                "строк/с": f"{rows / max(t, 1e-9):.0f}",
+            })
+    _report(f"load, {n} строк", out)
+
+
+def bench_memory(n: int = 20000) -> None:
+    """
+    Резидентный размер каталога по колонкам (app/compact.py): как после
+    выгрузки (каждая ячейка — свой объект str, как из JSON batchGet)
+    против category / pyarrow-строк.
+    """
+    from app import compact
+
+    base = synthetic_catalog(n)
+    # synthetic_catalog делит объекты строк между ячейками — копируем, как при разборе ответа;
+    # object явно: pandas 3 с pyarrow сам сделал бы колонки pyarrow-строками
+    loaded = pd.DataFrame({c: pd.Series([(v + ".")[:-1] for v in base[c].tolist()], dtype=object)
+                           for c in base.columns})
+    before = compact.memory_report(loaded)
+    t = _timeit(lambda: compact.compact_frame(loaded.copy(deep=True)), repeat=3)
+    compact.compact_frame(loaded)
+    after = compact.memory_report(loaded)
+
+    out = []
+    for b, a in zip(before, after):
+        out.append({
+            "колонка": b["колонка"],
+            "dtype": a["dtype"] or "",
+            "уник.": a["уникальных"],
+            "KB_было": f"{b['байт'] / 1024:.0f}",
+            "KB_стало": f"{a['байт'] / 1024:.0f}",
+            "x": f"{b['байт'] / max(a['байт'], 1):.1f}",
+        })
+    out.append({"колонка": "compact_frame", "s": f"{t:.2f}"})
+    _report(f"memory, {n} строк", out)
+
+
+# ---------- Нормализация: re.sub vs app/textnorm.py ----------
+def _re_norm_code(x) -> str:
+    s = str(x or "").strip().lower().replace("o", "0")
+    return re.sub(r"[^a-z0-9]", "", s)
+
+
+def _re_squash(x) -> str:
+    return re.sub(r"[\W_]+", "", str(x or "").lower())
+
+
+def _re_normalize(x) -> str:
+    return re.sub(r"[^\w\s]", "", str(x or "").lower()).strip()
+
+
+def bench_norm(n: int = 20000) -> None:
+    from app import compact, textnorm
+
+    df_ = synthetic_catalog(n)
+    compact.compact_frame(df_)
+    pairs = [
+        ("norm_code", _re_norm_code, textnorm.norm_code, "код"),
+        ("norm_code", _re_norm_code, textnorm.norm_code, "oem"),
+        ("squash", _re_squash, textnorm.squash, "наименование"),
+        ("squash", _re_squash, textnorm.squash, "тип"),
+        ("normalize", _re_normalize, textnorm.normalize, "описание"),
+    ]
+    out = []
+    for name, old, new, col in pairs:
+        values = df_[col].tolist()
+        assert [old(v) for v in values] == [new(v) for v in values], (name, col)
+        t_re = _timeit(lambda: [old(v) for v in values], repeat=3)
+        t_tr = _timeit(lambda: [new(v) for v in values], repeat=3)
+        t_col = _timeit(lambda: textnorm.map_series(df_[col], new), repeat=3)
+        out.append({
+            "функция": f"{name}({col})",
+            "re_ms": f"{t_re * 1000:.1f}",
+            "translate_ms": f"{t_tr * 1000:.1f}",
+            "колонка_ms": f"{t_col * 1000:.1f}",
+            "x": f"{t_re / max(t_col, 1e-9):.1f}",
+        })
+
+    queries = ["подшипник 6205", "PI 8808 DRG 500", "фильтр масляный", "LR 7000", "bosch"] * 200
+    t_re = _timeit(lambda: [(_re_normalize(q), _re_squash(q), _re_norm_code(q)) for q in queries])
+    t_q = _timeit(lambda: [(textnorm.q_normalize(q), textnorm.q_squash(q), textnorm.q_norm_code(q)) for q in queries])
+    out.append({
+        "функция": f"запрос x{len(queries)}",
+        "re_ms": f"{t_re * 1000:.1f}",
+        "кеш_ms": f"{t_q * 1000:.1f}",
+        "x": f"{t_re / max(t_q, 1e-9):.1f}",
+    })
+
+    # общий индекс: как было (iterrows, токены по каждой строке) и по колонкам
+    cols = [c for c in data.SEARCH_COLUMNS if c in df_.columns]
+
+    def by_rows() -> Dict[str, set]:
+        idx: Dict[str, set] = {}
+        for i, row in df_.iterrows():
+            for t in data._search_tokens(row, cols):
+                idx.setdefault(t, set()).add(i)
+        return idx
+
+    assert by_rows() == data.build_search_index(df_)
+    t_rows = _timeit(by_rows, repeat=1)
+    t_cols = _timeit(lambda: data.build_search_index(df_), repeat=3)
+    out.append({
+        "функция": "build_search_index",
+        "iterrows_ms": f"{t_rows * 1000:.0f}",
+        "колонка_ms": f"{t_cols * 1000:.0f}",
+        "x": f"{t_rows / max(t_cols, 1e-9):.1f}",
+    })
+    _report(f"norm, {n} строк", out)
+
+
+BENCHES: Dict[str, Callable[[int], None]] = {
+    "phrase": bench_phrase,
+    "sheets": bench_sheets,
+    "load": bench_load,
+    "memory": bench_memory,
+    "norm": bench_norm,
+}
+
+
+def main(argv: List[str]) -> None:
+    names = [a for a in argv if not a.isdigit()] or list(BENCHES)
+    n = next((int(a) for a in argv if a.isdigit()), 20000)
+    _isolate()
+    for name in names:
+        BENCHES[name](n)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
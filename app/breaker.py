@@ -0,0 +1,251 @@
+# app/breaker.py
+"""
+Защита от перегрузки и сбоев Google Sheets.
+
+- QuotaBudget — скользящее окно в минуту отдельно для чтений и записей
+  (у Sheets API по умолчанию 60 запросов в минуту на пользователя — наш
+  сервисный аккаунт — и 300 на проект). Если окно занято, запрос ждёт
+  освобождения, но не дольше QUOTA_MAX_WAIT_SEC, иначе QuotaExhausted;
+- повторы при 429 / 5xx / сетевых ошибках с экспоненциальной задержкой
+  и полным jitter (backoff_delay). Записи повторяются только при явном
+  отказе по квоте (429, 403 rateLimitExceeded): после таймаута или 5xx
+  строка могла уже попасть в таблицу, и повтор её задвоит;
+- CircuitBreaker: после BREAKER_FAILURES подряд неудачных запросов
+  (повторы уже исчерпаны) цепь размыкается, и обращения сразу получают
+  SheetsUnavailable, не тратя квоту и потоки. Время размыкания растёт
+  экспоненциально с каждым срабатыванием (с jitter). По истечении одна
+  пробная попытка (half-open): успех замыкает цепь, неудача — снова
+  размыкает.
+
+Всё это применяется на уровне HTTP-клиента gspread (app/gclient.py),
+поэтому действует для любого обращения к таблице.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict
+
+import requests
+from gspread.exceptions import APIError
+
+logger = logging.getLogger("bot.breaker")
+
+try:
+    from app.config import (
+        SHEETS_READS_PER_MIN,
+        SHEETS_WRITES_PER_MIN,
+        BREAKER_FAILURES,
+        BREAKER_OPEN_SEC,
+        BREAKER_MAX_OPEN_SEC,
+    )
+except Exception:
+    SHEETS_READS_PER_MIN = int(os.getenv("SHEETS_READS_PER_MIN", "60"))
+    SHEETS_WRITES_PER_MIN = int(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+    BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+    BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "15"))
+    BREAKER_MAX_OPEN_SEC = float(os.getenv("BREAKER_MAX_OPEN_SEC", "600"))
+
+RETRIES = 3               # повторов одного запроса до того, как он считается неудачным
+RETRY_BASE_SEC = 1.0
+RETRY_CAP_SEC = 16.0
+QUOTA_MAX_WAIT_SEC = 10.0
+PROBE_TIMEOUT_SEC = 60.0  # пробный запрос, не давший ответа за это время, не блокирует следующий
+
+
+class SheetsUnavailable(RuntimeError):
+    """Таблица сейчас недоступна (цепь разомкнута или квота исчерпана)."""
+
+
+class QuotaExhausted(SheetsUnavailable):
+    pass
+
+
+def is_transient(exc: BaseException) -> bool:
+    """429 / 5xx / таймаут / сетевая ошибка — стоит повторить позже."""
+    if isinstance(exc, APIError):
+        code = getattr(exc, "code", 0) or 0
+        if code == 403:
+            # Drive API сообщает о превышении квоты через 403 rateLimitExceeded
+            return "ratelimit" in str(getattr(exc, "error", "")).lower()
+        return code in (408, 429) or code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def is_rejected(exc: BaseException) -> bool:
+    """429 / 403 rateLimitExceeded — Google отказал до выполнения, повтор безопасен и для записи."""
+    if not isinstance(exc, APIError):
+        return False
+    code = getattr(exc, "code", 0) or 0
+    return code == 429 or (code == 403 and is_transient(exc))
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_SEC, cap: float = RETRY_CAP_SEC) -> float:
+    """Экспоненциальная задержка с полным jitter: U(0, min(cap, base·2^attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+# ---------- Квота ----------
+class QuotaBudget:
+    def __init__(self, per_min: Dict[str, int], window: float = 60.0):
+        self.per_min = per_min
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Deque[float]] = {k: deque() for k in per_min}
+        self.waited_sec = 0.0
+        self.rejected = 0
+
+    def _free_at(self, kind: str, now: float) -> float:
+        q = self._calls[kind]
+        while q and now - q[0] >= self.window:
+            q.popleft()
+        if len(q) < self.per_min[kind]:
+            return now
+        return q[0] + self.window
+
+    def acquire(self, kind: str, max_wait: float = QUOTA_MAX_WAIT_SEC) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                at = self._free_at(kind, now)
+                if at <= now:
+                    self._calls[kind].append(now)
+                    return
+                wait = at - now
+                if wait > max_wait:
+                    self.rejected += 1
+                    raise QuotaExhausted(f"квота Sheets ({kind}) исчерпана, свободно через {wait:.0f}s")
+            self.waited_sec += wait
+            time.sleep(wait)
+
+    def used(self) -> Dict[str, int]:
+        """Запросов за последнее окно по видам."""
+        with self._lock:
+            now = time.monotonic()
+            for k in self._calls:
+                self._free_at(k, now)
+            return {k: len(q) for k, q in self._calls.items()}
+
+
+# ---------- Цепь ----------
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failures: int = BREAKER_FAILURES,
+                 open_sec: float = BREAKER_OPEN_SEC, max_open_sec: float = BREAKER_MAX_OPEN_SEC):
+        self.threshold = max(1, failures)
+        self.open_sec = open_sec
+        self.max_open_sec = max_open_sec
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probe_deadline = 0.0
+        self.last_error = ""
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться; в half-open пропускает одну пробу."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if (self.state == self.OPEN and now >= self.open_until) or (
+                self.state == self.HALF_OPEN and now >= self.probe_deadline
+            ):
+                self.state = self.HALF_OPEN
+                self.probe_deadline = now + PROBE_TIMEOUT_SEC
+                logger.info("[breaker] half-open: пробный запрос к Sheets")
+                return True
+            return False
+
+    def is_open(self) -> bool:
+        """Без побочных эффектов: цепь разомкнута или идёт пробный запрос."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                return now < self.probe_deadline
+            return self.state == self.OPEN and now < self.open_until
+
+    def check(self) -> None:
+        if not self.allow():
+            raise SheetsUnavailable(f"Google Sheets недоступен ({self.last_error}), повтор через {self.retry_in():.0f}s")
+
+    def retry_in(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("[breaker] Sheets снова отвечает — цепь замкнута")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+
+    def failure(self, exc: BaseException) -> None:
+        with self._lock:
+            self.last_error = f"{type(exc).__name__}: {str(exc)[:120]}"
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.trips += 1
+                span = min(self.max_open_sec, self.open_sec * (2 ** (self.trips - 1)))
+                span *= random.uniform(0.8, 1.2)
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + span
+                self.failures = 0
+                logger.warning(f"[breaker] цепь разомкнута на {span:.0f}s (срабатываний {self.trips}): {self.last_error}")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {"state": self.state, "trips": self.trips, "retry_in": round(self.retry_in(), 1),
+                    "last_error": self.last_error}
+
+
+breaker = CircuitBreaker()
+budget = QuotaBudget({"read": SHEETS_READS_PER_MIN, "write": SHEETS_WRITES_PER_MIN})
+
+
+def guarded(kind: str, send):
+    """
+    Один HTTP-запрос к Google под защитой: цепь → квота → send() с повторами.
+    Неудачей для цепи считается только временная ошибка после всех повторов.
+    Запись (kind="write") повторяется только после is_rejected: остальные
+    временные ошибки неоднозначны и отдаются вызывающему как есть.
+    """
+    breaker.check()
+    attempt = 0
+    while True:
+        budget.acquire(kind)
+        try:
+            resp = send()
+        except Exception as e:
+            if not is_transient(e):
+                # Google ответил (400/403/404) — сервис жив, это ошибка запроса
+                breaker.success()
+                raise
+            if attempt >= RETRIES or breaker.state == breaker.HALF_OPEN or (
+                kind == "write" and not is_rejected(e)
+            ):
+                breaker.failure(e)
+                raise
+            if breaker.is_open():
+                # цепь уже разомкнули параллельные запросы — не ждём повтора
+                raise
+            delay = backoff_delay(attempt)
+            logger.info(f"[breaker] {type(e).__name__} — повтор через {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        breaker.success()
+        return resp
+
+
+def _reset_after_fork() -> None:
+    # блокировку мог держать поток родителя, которого в дочернем процессе нет
+    breaker._lock = threading.Lock()
+    budget._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,144 @@
+# app/compact.py
+"""
+Компактное представление каталога в памяти.
+
+После загрузки каждая ячейка data.df — отдельный объект str: одинаковые
+"тип", "изготовитель", "валюта" и пустые строки повторяются в памяти
+десятки тысяч раз, а копии результатов пользователей (user_state) держат
+ещё по ссылке на каждый. Здесь при загрузке:
+
+- колонки с малым числом различных значений (доля уникальных не больше
+  CATEGORY_MAX_RATIO) → pandas category: строка хранит код int8/int16,
+  само значение — один раз в categories;
+- остальные (код, наименование, описание — почти все значения разные,
+  category ничего не даёт) → строки pyarrow (StringDtype("pyarrow")): один
+  буфер UTF-8 и смещения вместо объекта str на ячейку (~50 байт заголовка
+  и 2 байта на кириллический символ). Объект str создаётся только при
+  чтении значения;
+- без pyarrow — одинаковые строки таких колонок заменяются одним объектом
+  (общий пул на загрузку, не sys.intern — строки старых версий каталога
+  освобождаются вместе с ними).
+
+Значения читаются теми же str: tolist(), to_dict(), .str и сравнения
+работают как раньше, хеши строк (дельта-синхронизация) совпадают с
+хешами object-колонок. PartStore (app/parts.py) pyarrow-колонки в списки
+не раскладывает, а читает из массива.
+
+memory_report() — сколько колонка реально занимает в памяти (общие
+объекты считаются один раз, в отличие от memory_usage(deep=True)).
+"""
+import os
+import sys
+import time
+import logging
+from typing import Dict, List
+
+import pandas as pd
+
+logger = logging.getLogger("bot.compact")
+
+try:
+    from app.config import CATALOG_COMPACT, CATEGORY_MAX_RATIO
+except Exception:
+    CATALOG_COMPACT = os.getenv("CATALOG_COMPACT", "1") not in ("0", "false", "no", "")
+    CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", "0.5"))
+
+
+def _is_text(s: pd.Series) -> bool:
+    """Строки Python-объектами: object (pandas 2) или str с python-хранилищем (pandas 3)."""
+    if s.dtype == object:
+        return True
+    return isinstance(s.dtype, pd.StringDtype) and s.dtype.storage == "python"
+
+
+def is_arrow_text(s: pd.Series) -> bool:
+    """Строки в буфере pyarrow (после compact_frame или str по умолчанию в pandas 3)."""
+    return isinstance(s.dtype, pd.StringDtype) and s.dtype.storage == "pyarrow"
+
+
+_arrow_dtype = None
+
+
+def _arrow_string_dtype():
+    """StringDtype("pyarrow") или None, если pyarrow не установлен."""
+    global _arrow_dtype
+    if _arrow_dtype is None:
+        try:
+            import pyarrow  # noqa: F401
+            _arrow_dtype = pd.StringDtype("pyarrow")
+        except ImportError:
+            logger.warning("[compact] pyarrow не установлен — уникальные строки остаются объектами str")
+            _arrow_dtype = False
+    return _arrow_dtype or None
+
+
+def compact_frame(df_: pd.DataFrame) -> pd.DataFrame:
+    """На месте: category для повторяющихся колонок, pyarrow-строки (или общие объекты) в остальных."""
+    if not CATALOG_COMPACT or df_ is None or not len(df_):
+        return df_
+    t0 = time.perf_counter()
+    n = len(df_)
+    arrow = _arrow_string_dtype()
+    pool: Dict[str, str] = {}
+    cats: List[str] = []
+    arrows: List[str] = []
+    for col in df_.columns:
+        s = df_[col]
+        if not (_is_text(s) or is_arrow_text(s)):
+            continue
+        values = s.tolist()
+        if len(set(values)) <= CATEGORY_MAX_RATIO * n:
+            df_[col] = pd.Categorical(values)
+            cats.append(col)
+        elif is_arrow_text(s):
+            continue
+        elif arrow is not None and all(isinstance(v, str) for v in values):
+            # только чистые строки: None/NaN в StringDtype стали бы pd.NA
+            df_[col] = pd.Series(values, index=df_.index, dtype=arrow)
+            arrows.append(col)
+        else:
+            df_[col] = pd.Series([pool.setdefault(v, v) if isinstance(v, str) else v for v in values],
+                                 index=df_.index, dtype=s.dtype)
+    logger.info(
+        f"[compact] {n} строк за {time.perf_counter() - t0:.2f}s: category — {', '.join(cats) or 'нет'}, "
+        f"pyarrow — {', '.join(arrows) or 'нет'}, общих строк {len(pool)}"
+    )
+    return df_
+
+
+# ---------- Отчёт ----------
+def _objects_bytes(values, seen: set) -> int:
+    total = 0
+    for v in values:
+        if id(v) not in seen:
+            seen.add(id(v))
+            total += sys.getsizeof(v)
+    return total
+
+
+def column_bytes(s: pd.Series, seen: set) -> int:
+    """Резидентный размер колонки; объекты из seen (уже посчитанные) не учитываются."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = s.cat.categories
+        return s.cat.codes.nbytes + cats.memory_usage() + _objects_bytes(cats.tolist(), seen)
+    if _is_text(s):
+        values = s.to_numpy(dtype=object)
+        return values.nbytes + _objects_bytes(values, seen)
+    return int(s.memory_usage(index=False, deep=True))
+
+
+def memory_report(df_: pd.DataFrame) -> List[Dict[str, object]]:
+    """По колонке: dtype, число различных значений, байт в памяти; последняя строка — итог."""
+    seen: set = set()
+    out: List[Dict[str, object]] = []
+    for col in df_.columns:
+        s = df_[col]
+        out.append({"колонка": col, "dtype": str(s.dtype), "уникальных": int(s.nunique()),
+                    "байт": column_bytes(s, seen)})
+    out.append({"колонка": "всего", "dtype": "", "уникальных": "",
+                "байт": sum(r["байт"] for r in out) + df_.index.memory_usage()})
+    return out
+
+
+def total_bytes(df_: pd.DataFrame) -> int:
+    return memory_report(df_)[-1]["байт"]
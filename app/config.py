@@ -12,6 +12,10 @@ WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
 
 PORT = int(os.getenv("PORT", "8080"))
 
+# Число процессов веб-сервера. >1 — prefork: каталог грузится один раз
+# в родителе и делится с воркерами copy-on-write (см. app/prefork.py)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
 # Таймзона (важно для листа История и времени операций)
 # main.py ожидает TZ_NAME
 TZ_NAME = os.getenv("TZ_NAME", "Asia/Tashkent")
@@ -52,6 +56,102 @@ MAX_QTY = int(os.getenv("MAX_QTY", "999"))
 # Время жизни кеша данных (сек)
 DATA_TTL = int(os.getenv("DATA_TTL", "600"))
 
+# Ранжирование BM25F: параметры и бусты по коду (0 — выключить буст)
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+CODE_EXACT_BOOST = float(os.getenv("CODE_EXACT_BOOST", "100"))
+CODE_PREFIX_BOOST = float(os.getenv("CODE_PREFIX_BOOST", "20"))
+CODE_TOKEN_PREFIX_BOOST = float(os.getenv("CODE_TOKEN_PREFIX_BOOST", "5"))
+PHRASE_BOOST = float(os.getenv("PHRASE_BOOST", "10"))
+
+# Локальный снапшот каталога с индексами (тёплый старт, работа при недоступном Sheets).
+# Пустое значение — не сохранять и не читать.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", ".cache/catalog.snapshot.gz")
+
+# SQLite-файл для поиска подстрок (FTS5 trigram, app/searchdb.py).
+# Пустое значение — фолбэки поиска идут по DataFrame. Файл пересобирается при
+# смене каталога и переиспользуется при старте, если каталог тот же.
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", "")
+
+# Компактный каталог в памяти (app/compact.py): колонки, где различных значений
+# не больше CATEGORY_MAX_RATIO от числа строк, хранятся как category, остальные —
+# строками pyarrow (без pyarrow — одинаковые строки одним объектом).
+# "0" — как загружено, каждая ячейка отдельно.
+CATALOG_COMPACT = os.getenv("CATALOG_COMPACT", "1") not in ("0", "false", "no", "")
+CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", "0.5"))
+
+# Какие колонки SAP выгружать (values.batchGet по диапазонам, app/sheets.py).
+# "*" — все колонки листа, как get_all_values().
+SAP_COLUMNS = [
+    c.strip().lower()
+    for c in os.getenv(
+        "SAP_COLUMNS",
+        "код,наименование,тип,oem,изготовитель,парт номер,oem парт номер,описание,количество,цена,валюта,image",
+    ).split(",")
+    if c.strip()
+]
+
+# Источник каталога (app/sources.py): "sheets" — лист SAP в Google Sheets,
+# "file:<путь>" — локальная выгрузка из SAP (.xlsx / .csv / .tsv / .parquet,
+# формат по расширению). Для файла изменения отслеживаются по его mtime.
+CATALOG_SOURCE = os.getenv("CATALOG_SOURCE", "sheets")
+
+# Проба изменений таблицы перед выгрузкой (app/probe.py):
+# "drive" — version/modifiedTime файла через Drive API, "file:<путь>" — mtime
+# локального файла (для тестов), "" — без пробы, выгрузка каждые DATA_TTL.
+# Интервал опроса подстраивается под частоту правок в пределах MIN..MAX.
+CHANGE_PROBE = os.getenv("CHANGE_PROBE", "drive")
+CHANGE_PROBE_MIN_SEC = float(os.getenv("CHANGE_PROBE_MIN_SEC", "30"))
+CHANGE_PROBE_MAX_SEC = float(os.getenv("CHANGE_PROBE_MAX_SEC", "1800"))
+
+# Push об изменении таблицы (Apps Script onEdit → POST /admin/catalog/changed, app/push.py).
+# Пустой секрет — эндпоинт выключен. Перезагрузка — после RELOAD_DEBOUNCE_SEC тишины,
+# но не позже RELOAD_MAX_DELAY_SEC от первой правки.
+CATALOG_PUSH_SECRET = os.getenv("CATALOG_PUSH_SECRET", "")
+RELOAD_DEBOUNCE_SEC = float(os.getenv("RELOAD_DEBOUNCE_SEC", "5"))
+RELOAD_MAX_DELAY_SEC = float(os.getenv("RELOAD_MAX_DELAY_SEC", "30"))
+
+# Дельта-синхронизация: при перезагрузке индексы обновляются только для
+# добавленных/изменённых/удалённых строк (по хешу содержимого, ключ — код).
+# Если изменилось больше DELTA_MAX_FRACTION каталога — полная пересборка.
+DELTA_SYNC = os.getenv("DELTA_SYNC", "1") not in ("0", "false", "no", "")
+DELTA_MAX_FRACTION = float(os.getenv("DELTA_MAX_FRACTION", "0.3"))
+
+# Координация обновления между репликами (app/coordinator.py):
+# "" — каждая реплика читает Sheets сама; "file" / "sqlite" — читает только лидер,
+# остальные поднимают опубликованный им снапшот из REFRESH_SHARED_DIR.
+REFRESH_COORDINATOR = os.getenv("REFRESH_COORDINATOR", "")
+REFRESH_SHARED_DIR = os.getenv("REFRESH_SHARED_DIR", ".cache/shared")
+REFRESH_LEASE_TTL = float(os.getenv("REFRESH_LEASE_TTL", str(3 * DATA_TTL)))
+
+# Все запросы к Google Sheets идут через app/gateway.py: отдельный пул из
+# SHEETS_WORKERS потоков и таймауты на операцию (чтение, запись, перезагрузка
+# каталога). SHEETS_HTTP_TIMEOUT — таймаут самого HTTP-запроса, чтобы зависший
+# ответ Google не занимал поток пула бесконечно.
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "4"))
+SHEETS_READ_TIMEOUT = float(os.getenv("SHEETS_READ_TIMEOUT", "20"))
+SHEETS_WRITE_TIMEOUT = float(os.getenv("SHEETS_WRITE_TIMEOUT", "15"))
+SHEETS_RELOAD_TIMEOUT = float(os.getenv("SHEETS_RELOAD_TIMEOUT", "120"))
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+
+# Квота Sheets API на минуту (по умолчанию лимит Google на пользователя —
+# сервисный аккаунт) и цепь-предохранитель (app/breaker.py): после
+# BREAKER_FAILURES неудач подряд запросы к таблице приостанавливаются на
+# BREAKER_OPEN_SEC, с каждым срабатыванием вдвое дольше (до BREAKER_MAX_OPEN_SEC).
+# Пока цепь разомкнута, поиск работает по последней загруженной версии, а
+# списания копятся в DEFERRED_WRITES_PATH и дописываются после восстановления.
+SHEETS_READS_PER_MIN = int(os.getenv("SHEETS_READS_PER_MIN", "60"))
+SHEETS_WRITES_PER_MIN = int(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "15"))
+BREAKER_MAX_OPEN_SEC = float(os.getenv("BREAKER_MAX_OPEN_SEC", "600"))
+DEFERRED_WRITES_PATH = os.getenv("DEFERRED_WRITES_PATH", ".cache/deferred_writes.jsonl")
+
+# Аналоги по общим парт-номерам ("парт номер", "oem парт номер"), без цепочек:
+# номера короче минимума и встречающиеся слишком часто ("-", "нет", серии) не связывают строки
+ANALOG_MIN_KEY_LEN = int(os.getenv("ANALOG_MIN_KEY_LEN", "4"))
+ANALOG_MAX_KEY_ROWS = int(os.getenv("ANALOG_MAX_KEY_ROWS", "20"))
+
 # =========================
 # Доступы и роли
 # =========================
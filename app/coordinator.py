@@ -0,0 +1,251 @@
+# app/coordinator.py
+"""
+Координация обновления каталога между репликами.
+
+Из Google Sheets читает только лидер — держатель аренды (lease). Он строит
+индексы, публикует снапшот под номером версии и записывает в общий реестр
+(версия, путь). Остальные реплики (followers) по тому же DATA_TTL смотрят
+только в реестр и, если версия выросла, поднимают опубликованный снапшот.
+
+Аренда продлевается лидером при каждом обновлении; если лидер пропал,
+после REFRESH_LEASE_TTL её забирает любая другая реплика.
+
+Бэкенды (REFRESH_COORDINATOR):
+- "file"   — JSON-файл под fcntl.flock, для реплик на одной машине / общем томе;
+- "sqlite" — одна строка в SQLite (BEGIN IMMEDIATE), удобно для локальных тестов;
+- свой — register_backend(name, factory).
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("bot.coordinator")
+
+try:
+    from app.config import REFRESH_COORDINATOR, REFRESH_SHARED_DIR, REFRESH_LEASE_TTL
+except Exception:
+    REFRESH_COORDINATOR = os.getenv("REFRESH_COORDINATOR", "")
+    REFRESH_SHARED_DIR = os.getenv("REFRESH_SHARED_DIR", ".cache/shared")
+    REFRESH_LEASE_TTL = float(os.getenv("REFRESH_LEASE_TTL", "1800"))
+
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+# Сколько последних опубликованных снапшотов держать на диске
+KEEP_PUBLISHED = 3
+
+
+class LeaseBackend:
+    """
+    Интерфейс бэкенда: аренда лидера + реестр опубликованной версии.
+    Все методы атомарны относительно других реплик.
+    """
+
+    def acquire(self, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду; False — лидер другой и аренда не истекла."""
+        raise NotImplementedError
+
+    def release(self, holder: str) -> None:
+        raise NotImplementedError
+
+    def published(self) -> Tuple[int, str]:
+        """(версия, путь к снапшоту); (0, "") — ещё ничего не опубликовано."""
+        raise NotImplementedError
+
+    def publish(self, holder: str, version: int, path: str) -> bool:
+        """Записать новую версию; только действующий лидер."""
+        raise NotImplementedError
+
+
+# ---------- file ----------
+class FileLease(LeaseBackend):
+    def __init__(self, shared_dir: str):
+        import fcntl  # только POSIX
+
+        self._fcntl = fcntl
+        os.makedirs(shared_dir, exist_ok=True)
+        self.path = os.path.join(shared_dir, "lease.json")
+        self.lock_path = self.path + ".lock"
+
+    def _update(self, fn: Callable[[dict], Optional[dict]]):
+        """fn(state) под эксклюзивной блокировкой; вернул dict — он записывается."""
+        with open(self.lock_path, "a+") as lock:
+            self._fcntl.flock(lock, self._fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                new_state = fn(dict(state))
+                if new_state is not None:
+                    tmp = f"{self.path}.tmp.{os.getpid()}"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        json.dump(new_state, f)
+                    os.replace(tmp, self.path)
+                return new_state if new_state is not None else state
+            finally:
+                self._fcntl.flock(lock, self._fcntl.LOCK_UN)
+
+    def acquire(self, holder: str, ttl: float) -> bool:
+        now = time.time()
+
+        def fn(st: dict) -> Optional[dict]:
+            if st.get("holder") not in (None, holder) and st.get("expires", 0) > now:
+                return None
+            st.update(holder=holder, expires=now + ttl)
+            return st
+
+        return self._update(fn).get("holder") == holder
+
+    def release(self, holder: str) -> None:
+        def fn(st: dict) -> Optional[dict]:
+            if st.get("holder") != holder:
+                return None
+            st.update(holder=None, expires=0)
+            return st
+
+        self._update(fn)
+
+    def published(self) -> Tuple[int, str]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                st = json.load(f)
+        except (OSError, ValueError):
+            return 0, ""
+        return int(st.get("version") or 0), str(st.get("snapshot") or "")
+
+    def publish(self, holder: str, version: int, path: str) -> bool:
+        def fn(st: dict) -> Optional[dict]:
+            if st.get("holder") != holder or version <= int(st.get("version") or 0):
+                return None
+            st.update(version=version, snapshot=path, published_at=time.time(), publisher=holder)
+            return st
+
+        return self._update(fn).get("version") == version
+
+
+# ---------- sqlite ----------
+class SqliteLease(LeaseBackend):
+    def __init__(self, shared_dir: str):
+        os.makedirs(shared_dir, exist_ok=True)
+        self.path = os.path.join(shared_dir, "lease.sqlite3")
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lease ("
+                " name TEXT PRIMARY KEY, holder TEXT, expires REAL NOT NULL DEFAULT 0,"
+                " version INTEGER NOT NULL DEFAULT 0, snapshot TEXT NOT NULL DEFAULT '',"
+                " published_at REAL NOT NULL DEFAULT 0)"
+            )
+            conn.execute("INSERT OR IGNORE INTO lease(name) VALUES ('catalog')")
+
+    def _conn(self) -> sqlite3.Connection:
+        # isolation_level=None: транзакции открываем сами (BEGIN IMMEDIATE)
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def acquire(self, holder: str, ttl: float) -> bool:
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(
+                "UPDATE lease SET holder = ?, expires = ? "
+                "WHERE name = 'catalog' AND (holder IS NULL OR holder = ? OR expires <= ?)",
+                (holder, now + ttl, holder, now),
+            )
+            conn.execute("COMMIT")
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def release(self, holder: str) -> None:
+        conn = self._conn()
+        try:
+            conn.execute(
+                "UPDATE lease SET holder = NULL, expires = 0 WHERE name = 'catalog' AND holder = ?", (holder,)
+            )
+        finally:
+            conn.close()
+
+    def published(self) -> Tuple[int, str]:
+        conn = self._conn()
+        try:
+            row = conn.execute("SELECT version, snapshot FROM lease WHERE name = 'catalog'").fetchone()
+        finally:
+            conn.close()
+        return (int(row[0]), str(row[1])) if row else (0, "")
+
+    def publish(self, holder: str, version: int, path: str) -> bool:
+        conn = self._conn()
+        try:
+            cur = conn.execute(
+                "UPDATE lease SET version = ?, snapshot = ?, published_at = ? "
+                "WHERE name = 'catalog' AND holder = ? AND version < ?",
+                (version, path, time.time(), holder, version),
+            )
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+
+# ---------- Реестр бэкендов ----------
+BACKENDS: Dict[str, Callable[[str], LeaseBackend]] = {
+    "file": FileLease,
+    "sqlite": SqliteLease,
+}
+
+_backend: Optional[LeaseBackend] = None
+
+
+def register_backend(name: str, factory: Callable[[str], LeaseBackend]) -> None:
+    """Подключить свой бэкенд (Redis, Postgres advisory lock, ...)."""
+    BACKENDS[name] = factory
+
+
+def backend() -> Optional[LeaseBackend]:
+    """Бэкенд из REFRESH_COORDINATOR или None (координация выключена)."""
+    global _backend
+    if _backend is None and REFRESH_COORDINATOR:
+        factory = BACKENDS.get(REFRESH_COORDINATOR)
+        if factory is None:
+            logger.error(f"[coord] неизвестный REFRESH_COORDINATOR={REFRESH_COORDINATOR!r} — координация выключена")
+            return None
+        _backend = factory(REFRESH_SHARED_DIR)
+        logger.info(f"[coord] бэкенд {REFRESH_COORDINATOR}, реплика {REPLICA_ID}")
+    return _backend
+
+
+def enabled() -> bool:
+    return backend() is not None
+
+
+def snapshot_path(version: int) -> str:
+    return os.path.join(REFRESH_SHARED_DIR, f"catalog.v{version:06d}.snapshot.gz")
+
+
+def prune_published(keep: int = KEEP_PUBLISHED) -> None:
+    """Удалить старые опубликованные снапшоты (последние keep оставляем для отстающих реплик)."""
+    try:
+        names: List[str] = sorted(
+            n for n in os.listdir(REFRESH_SHARED_DIR) if n.startswith("catalog.v") and n.endswith(".snapshot.gz")
+        )
+    except OSError:
+        return
+    for n in names[:-keep]:
+        try:
+            os.remove(os.path.join(REFRESH_SHARED_DIR, n))
+        except OSError:
+            pass
+
+
+def release() -> None:
+    """Отдать аренду при остановке — следующий лидер не ждёт истечения TTL."""
+    b = backend()
+    if b is not None:
+        try:
+            b.release(REPLICA_ID)
+        except Exception as e:
+            logger.warning(f"[coord] release: {e}")
@@ -1,18 +1,22 @@
 import os
 import io
+import asyncio
 import re
+import math
+import bisect
 import time
-import json
+import threading
 import logging
-from typing import Dict, Set, Tuple, List, Optional
+from typing import Dict, Set, Tuple, List, Mapping, Optional
 
 import pandas as pd
 import aiohttp
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+from app import breaker, compact, coordinator, gateway, gclient, parts, probe, searchdb, sheets, similar, snapshot, sources, textnorm
+from app.segments import PositionsIndex, PostingsIndex, merge_all
+
 logger = logging.getLogger("bot.data")
 
 # ---------- Конфиг ----------
@@ -23,6 +27,12 @@ try:
         USERS_SHEET_NAME,        # "Пользователи"
         DATA_TTL,
         SEARCH_COLUMNS,
+        ANALOG_MIN_KEY_LEN,
+        ANALOG_MAX_KEY_ROWS,
+        SNAPSHOT_PATH,
+        SEARCH_DB_PATH,
+        DELTA_SYNC,
+        DELTA_MAX_FRACTION,
     )
 except Exception:
     SPREADSHEET_URL = os.getenv("SPREADSHEET_URL", "")
@@ -38,15 +48,46 @@ except Exception:
         "парт номер",
         "oem парт номер",
     ]
+    ANALOG_MIN_KEY_LEN = int(os.getenv("ANALOG_MIN_KEY_LEN", "4"))
+    ANALOG_MAX_KEY_ROWS = int(os.getenv("ANALOG_MAX_KEY_ROWS", "20"))
+    SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", ".cache/catalog.snapshot.gz")
+    SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", "")
+    DELTA_SYNC = os.getenv("DELTA_SYNC", "1") not in ("0", "false", "no", "")
+    DELTA_MAX_FRACTION = float(os.getenv("DELTA_MAX_FRACTION", "0.3"))
 
-GOOGLE_APPLICATION_CREDENTIALS_JSON = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON", "")
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+GOOGLE_APPLICATION_CREDENTIALS_JSON = gclient.GOOGLE_APPLICATION_CREDENTIALS_JSON
+SCOPES = gclient.SCOPES
 
 # ---------- Глобальное состояние ----------
 df: Optional[pd.DataFrame] = None
 _last_load_ts: float = 0.0
+_catalog_version: int = 0   # растёт при каждой перезагрузке; id строк валидны в пределах версии
 _search_index: Dict[str, Set[int]] = {}
+_field_index: Dict[str, Dict[str, Set[int]]] = {}
+_field_terms: Dict[str, List[str]] = {}
+_positions: Dict[str, Dict[str, Dict[int, List[int]]]] = {}
+_code_index: Dict[str, int] = {}
+_bm25: Dict[str, object] = {}
+_search_db: Optional[searchdb.SearchDB] = None   # SQLite FTS5 текущей версии (если включено)
+_search_db_version: int = 0
+_parts: Optional[parts.PartStore] = None   # строки текущей версии для карточек (app/parts.py)
+_analog_row_keys: Dict[int, Tuple[str, ...]] = {}   # строка → её парт-номера (ключи аналогов)
+_analog_key_rows: Dict[str, List[int]] = {}         # парт-номер → строки с ним
 _image_index: Dict[str, str] = {}
+# склеенные имена файлов картинок + промахи поиска по ним (на версию каталога), см. build_image_names
+_image_names: Tuple[str, List[int], List[str], Set[str]] = ("", [], [], set())
+_published_version: int = 0   # версия опубликованного лидером снапшота, на которой стоит реплика
+_row_hashes: Dict[str, Tuple[int, int]] = {}   # ключ строки (код) → (индекс строки, хеш содержимого)
+_facets: Dict[str, Dict[str, int]] = {}         # колонка → значение → число строк
+_last_sync: Dict[str, object] = {}              # сводка последней синхронизации
+AUTO_REFRESH: bool = True   # False — каталог обновляет кто-то другой (воркер prefork)
+_source = sources.make_source(lambda: get_gs_client())
+_poller = probe.Poller(_source.probe())
+IMAGE_MISS_CACHE_MAX = 100000   # промахи поиска картинок на версию (коды приходят и из запросов Mini App)
+STALE_RETRY_SEC = 30         # пауза перед новой попыткой после неудачного фонового обновления
+_refresh_lock = threading.Lock()   # одно обновление каталога за раз, кто бы его ни запустил
+_refresh_started = 0               # номер последнего начатого обновления
+_refresh_done = 0                  # номер последнего удачно завершённого (single-flight)
 
 user_state: Dict[int, dict] = {}
 issue_state: Dict[int, dict] = {}
@@ -57,22 +98,42 @@ SHEET_BLOCKED: Set[int] = set()
 
 ASK_QUANTITY, ASK_COMMENT, ASK_CONFIRM = range(3)
 
-# ---------- Утилиты ----------
-def _norm_code(x: str) -> str:
-    """
-    Нормализация кодов:
-    - lower
-    - заменить букву 'o' на цифру '0'
-    - убрать все символы кроме [a-z0-9]
-    """
-    s = str(x or "").strip().lower()
-    s = s.replace("o", "0")  # буква O → цифра 0
-    s = re.sub(r"[^a-z0-9]", "", s)
-    return s
+# Логические поля → колонки листа SAP (для пофилдовых индексов и синтаксиса "поле:значение")
+FIELD_COLUMNS: Dict[str, str] = {
+    "code": "код",
+    "name": "наименование",
+    "type": "тип",
+    "oem": "oem",
+    "part_number": "парт номер",
+    "oem_part_number": "oem парт номер",
+    "manufacturer": "изготовитель",
+    "description": "описание",
+}
+
+# Колонки с кодами/номерами — нормализуются через _norm_code
+CODE_COLUMNS = ("код", "парт номер", "oem парт номер")
+
+# Колонки с парт-номерами, общие значения которых связывают аналоги.
+# "oem" сюда не входит: в листе там часто бренд/производитель, а не номер.
+ANALOG_COLUMNS = ("парт номер", "oem парт номер")
 
+# Колонки с позиционным индексом (фразы и близость слов)
+POSITIONAL_COLUMNS = ("наименование", "описание")
 
-def _norm_str(x: str) -> str:
-    return str(x or "").strip().lower()
+# Колонки с фасетами (счётчики значений для меню категорий)
+FACET_COLUMNS = ("тип",)
+
+# ---------- Утилиты ----------
+# Нормализация — таблицами str.translate (app/textnorm.py):
+# _norm_code — lower, буква 'o' → цифра '0', только [a-z0-9]
+_norm_code = textnorm.norm_code
+_norm_str = textnorm.norm_str
+squash = textnorm.squash
+normalize = textnorm.normalize
+
+_AZ09_RE = re.compile(r"[a-z0-9]+")
+_WORD_RE = re.compile(r"\w+")
+_ANALOG_SPLIT_RE = re.compile(r"[,;\n]+")
 
 
 def now_local_str(tz_name: str = "Asia/Tashkent") -> str:
@@ -80,7 +141,7 @@ def now_local_str(tz_name: str = "Asia/Tashkent") -> str:
     return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def val(d: dict, key: str, default: str = "") -> str:
+def val(d: Mapping, key: str, default: str = "") -> str:
     return str(d.get(key, default) or default)
 
 
@@ -96,19 +157,11 @@ def _url_name_tokens(url: str) -> List[str]:
 def _safe_col(df_: pd.DataFrame, col: str) -> Optional[pd.Series]:
     if col not in df_.columns:
         return None
-    return df_[col].astype(str).fillna("").str.strip().str.lower()
-
-
-def squash(text: str) -> str:
-    return re.sub(r"[\W_]+", "", str(text or "").lower())
-
-
-def normalize(text: str) -> str:
-    return re.sub(r"[^\w\s]", "", str(text or "").lower()).strip()
+    return textnorm.lower_column(df_[col])
 
 
 # ---------- Формат карточки ----------
-def format_row(row: dict) -> str:
+def format_row(row: Mapping) -> str:
     """
     Компактная карточка: КОД первым, затем Наименование, Тип и остальные поля.
     Плотная верстка под мобильный Telegram (HTML).
@@ -165,36 +218,31 @@ def format_row(row: dict) -> str:
     return "\n".join(lines)
 
 
+def card_html(row: Mapping) -> str:
+    """format_row; для Part — один раз на строку и версию каталога (app/parts.py)."""
+    if isinstance(row, parts.Part):
+        return row.cached("card", format_row)
+    return format_row(row)
+
+
 # ---------- Google Sheets ----------
 def get_gs_client():
-    if not GOOGLE_APPLICATION_CREDENTIALS_JSON:
-        raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS_JSON не задан")
-    try:
-        info = json.loads(GOOGLE_APPLICATION_CREDENTIALS_JSON)
-        creds = Credentials.from_service_account_info(info, scopes=SCOPES)
-    except json.JSONDecodeError:
-        creds = Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS_JSON, scopes=SCOPES)
-    return gspread.authorize(creds)
+    """Общий клиент процесса (keep-alive сессия, токен обновляется заранее) — см. app/gclient.py."""
+    return gclient.client()
 
 
 def _load_sap_dataframe() -> pd.DataFrame:
     """
     Загружаем данные ТАК, как они отображаются в Google Sheets.
     Это гарантирует точное совпадение цены (и других полей) с интерфейсом Sheets.
+    Источник — Sheets или локальный файл (CATALOG_SOURCE, app/sources.py).
     """
-    client = get_gs_client()
-    sh = client.open_by_url(SPREADSHEET_URL)
-    ws = sh.worksheet(SAP_SHEET_NAME)
-
-    values = ws.get_all_values()
-    if not values:
+    new_df = _source.load()
+    if new_df.empty and not len(new_df.columns):
         return pd.DataFrame()
 
-    # Первая строка — заголовки
-    headers = [c.strip().lower() for c in values[0]]
-    rows = values[1:]
-
-    new_df = pd.DataFrame(rows, columns=headers)
+    # Заголовки — в нижнем регистре
+    new_df.columns = [str(c).strip().lower() for c in new_df.columns]
 
     # Нормализуем только коды/номера для поиска
     for col in ("код", "oem", "парт номер", "oem парт номер"):
@@ -209,28 +257,250 @@ def _load_sap_dataframe() -> pd.DataFrame:
 
 
 # ---------- Индексы ----------
+def _value_search_tokens(col: str, value) -> Set[str]:
+    val_ = str(value).lower()
+    out: Set[str] = set()
+
+    # Для кодов нормализуем отдельно
+    if col in ("код", "парт номер", "oem парт номер"):
+        norm = _norm_code(val_)
+        if norm:
+            out.add(norm)
+
+    # Токенизация по a-z0-9 (уже в нижнем регистре)
+    out.update(_AZ09_RE.findall(val_))
+    return out
+
+
+def _search_tokens(row, cols: List[str]) -> Set[str]:
+    out: Set[str] = set()
+    for c in cols:
+        out |= _value_search_tokens(c, row.get(c, ""))
+    return out
+
+
 def build_search_index(df_: pd.DataFrame) -> Dict[str, Set[int]]:
     idx: Dict[str, Set[int]] = {}
     cols = [c for c in SEARCH_COLUMNS if c in df_.columns]
+    if not cols:
+        return idx
+
+    # по колонкам: токены считаются один раз на различное значение
+    rows = df_.index.tolist()
+    for col in cols:
+        for i, toks in zip(rows, textnorm.map_series(df_[col], lambda v, c=col: _value_search_tokens(c, v))):
+            for t in toks:
+                idx.setdefault(t, set()).add(i)
+    return idx
+
 
-    for i, row in df_.iterrows():
-        for c in cols:
-            val_ = str(row.get(c, "")).lower()
-
-            # Для кодов нормализуем отдельно
-            if c in ("код", "парт номер", "oem парт номер"):
-                norm = _norm_code(val_)
-                if norm:
-                    idx.setdefault(norm, set()).add(i)
-
-            # Токенизация по a-z0-9
-            for t in re.findall(r"[a-z0-9]+", val_):
-                t = _norm_str(t)
-                if t:
-                    idx.setdefault(t, set()).add(i)
+def _field_tokens(col: str, value: str) -> List[str]:
+    """
+    Термины одного значения поля так же, как их видит пофилдовый индекс:
+    - для кодов: весь нормализованный код + его a-z0-9 куски
+    - для текста: слова из букв/цифр в нижнем регистре (кириллица тоже)
+    """
+    s = str(value or "").strip().lower()
+    if not s:
+        return []
+    if col in CODE_COLUMNS:
+        out = [_norm_code(s)]
+        out.extend(_norm_code(t) for t in _AZ09_RE.findall(s))
+        return [t for t in out if t]
+    return _WORD_RE.findall(s.replace("ё", "е"))
+
+
+def _column_tokens(df_: pd.DataFrame, col: str) -> List[List[str]]:
+    """_field_tokens по всей колонке, один раз на различное значение (списки общие — не менять)."""
+    return textnorm.map_series(df_[col], lambda v: _field_tokens(col, v))
+
+
+def build_field_index(df_: pd.DataFrame) -> Dict[str, Dict[str, Set[int]]]:
+    """
+    Пофилдовые posting-листы: колонка → термин → множество индексов строк.
+    Используются парсером запросов (app.query) для "код:PI88* изготовитель:bosch".
+    """
+    idx: Dict[str, Dict[str, Set[int]]] = {}
+    for col in FIELD_COLUMNS.values():
+        if col not in df_.columns:
+            continue
+        postings: Dict[str, Set[int]] = {}
+        for i, toks in zip(df_.index, _column_tokens(df_, col)):
+            for t in toks:
+                postings.setdefault(t, set()).add(i)
+        idx[col] = postings
     return idx
 
 
+def build_bm25_stats(df_: pd.DataFrame, field_idx: Dict[str, Dict[str, Set[int]]]) -> Dict[str, object]:
+    """
+    Статистика для BM25F (app.ranking), считается один раз при построении индекса:
+    - tf:     колонка → термин → {строка: tf}  (только tf > 1; иначе tf = 1)
+    - len:    колонка → {строка: число терминов}
+    - avglen: колонка → средняя длина
+    - idf:    термин → idf по документам, где он есть хоть в одном поле
+    - code:   строка → нормализованный код (для бустов точного/префиксного кода)
+    """
+    tf: Dict[str, Dict[str, Dict[int, int]]] = {}
+    lens: Dict[str, Dict[int, int]] = {}
+    avglen: Dict[str, float] = {}
+    n = len(df_)
+
+    for col in field_idx:
+        col_tf: Dict[str, Dict[int, int]] = {}
+        col_len: Dict[int, int] = {}
+        for i, toks in zip(df_.index, _column_tokens(df_, col)):
+            if not toks:
+                continue
+            col_len[i] = len(toks)
+            seen: Dict[str, int] = {}
+            for t in toks:
+                seen[t] = seen.get(t, 0) + 1
+            for t, c in seen.items():
+                if c > 1:
+                    col_tf.setdefault(t, {})[i] = c
+        tf[col] = col_tf
+        lens[col] = col_len
+        avglen[col] = (sum(col_len.values()) / len(col_len)) if col_len else 1.0
+
+    docs: Dict[str, Set[int]] = {}
+    for col, postings in field_idx.items():
+        for t, rows in postings.items():
+            if t in docs:
+                docs[t] = docs[t] | rows
+            else:
+                docs[t] = rows
+    idf = {
+        t: math.log(1.0 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+        for t, rows in docs.items()
+    }
+
+    code: Dict[int, str] = {}
+    if "код" in df_.columns:
+        code = dict(zip(df_.index, textnorm.map_series(df_["код"], _norm_code)))
+
+    return {"n": n, "tf": tf, "len": lens, "avglen": avglen, "idf": idf, "code": code}
+
+
+def build_positional_index(df_: pd.DataFrame) -> Dict[str, Dict[str, Dict[int, List[int]]]]:
+    """
+    Позиции слов в наименовании/описании: колонка → термин → {строка: [позиции]}.
+    Позволяет отвечать на "фразы" и "близость"~N прямо из индекса,
+    без squash() и str.contains по склеенному тексту.
+    """
+    idx: Dict[str, Dict[str, Dict[int, List[int]]]] = {}
+    for col in POSITIONAL_COLUMNS:
+        if col not in df_.columns:
+            continue
+        postings: Dict[str, Dict[int, List[int]]] = {}
+        for i, toks in zip(df_.index, _column_tokens(df_, col)):
+            for pos, t in enumerate(toks):
+                postings.setdefault(t, {}).setdefault(i, []).append(pos)
+        idx[col] = postings
+    return idx
+
+
+def match_phrase(
+    col: str, terms: List[str], slop: int = 0, within: Optional[Set[int]] = None
+) -> Set[int]:
+    """
+    Строки, где terms идут по порядку и между соседними словами не больше slop
+    других слов (slop=0 — точная фраза). within — ограничить кандидатов.
+    """
+    postings = _positions.get(col, {})
+    lists = [postings.get(t) for t in terms]
+    if not lists or not all(lists):
+        return set()
+
+    cand = set(lists[0]) if within is None else within & lists[0].keys()
+    for p in lists[1:]:
+        cand &= p.keys()
+        if not cand:
+            return set()
+
+    out: Set[int] = set()
+    for r in cand:
+        cur = lists[0][r]
+        for p in lists[1:]:
+            cur = [b for b in p[r] if any(0 < b - a <= slop + 1 for a in cur)]
+            if not cur:
+                break
+        if cur:
+            out.add(r)
+    return out
+
+
+def build_code_index(df_: pd.DataFrame) -> Dict[str, int]:
+    """код (lower/strip) → индекс первой строки с этим кодом."""
+    idx: Dict[str, int] = {}
+    if "код" not in df_.columns:
+        return idx
+    for i, v in zip(df_.index, df_["код"].tolist()):
+        key = str(v or "").strip().lower()
+        if key:
+            idx.setdefault(key, i)
+    return idx
+
+
+def _code_key(v) -> str:
+    return str(v or "").strip().lower()
+
+
+def find_row_by_code(code: str) -> Optional[int]:
+    return _code_index.get(str(code or "").strip().lower())
+
+
+def _analog_keys(v) -> List[str]:
+    keys = (_norm_code(part) for part in _ANALOG_SPLIT_RE.split(str(v or "")))
+    return [k for k in keys if len(k) >= ANALOG_MIN_KEY_LEN]
+
+
+def build_analog_index(df_: pd.DataFrame) -> Tuple[Dict[int, Tuple[str, ...]], Dict[str, List[int]]]:
+    """
+    Аналоги — строки с общим нормализованным парт-номером (в любой из
+    ANALOG_COLUMNS, в т.ч. перекрёстно). Только прямая смежность, без
+    транзитивного замыкания: цепочки через разные номера склеивали каталог
+    в одну огромную группу. Номера, которые встречаются больше чем в
+    ANALOG_MAX_KEY_ROWS строках ("-", "нет", серии), строки не связывают.
+    Возвращает (строка → её номера, номер → строки); одиночки не хранятся.
+    """
+    key_rows: Dict[str, List[int]] = {}
+    for col in ANALOG_COLUMNS:
+        if col not in df_.columns:
+            continue
+        for i, ks in zip(df_.index, textnorm.map_series(df_[col], _analog_keys)):
+            for k in ks:
+                key_rows.setdefault(k, []).append(i)
+
+    kept: Dict[str, List[int]] = {}
+    row_keys: Dict[int, List[str]] = {}
+    for k, rows in key_rows.items():
+        rows = list(dict.fromkeys(rows))
+        if len(rows) < 2 or len(rows) > ANALOG_MAX_KEY_ROWS:
+            continue
+        kept[k] = rows
+        for r in rows:
+            row_keys.setdefault(r, []).append(k)
+    return {r: tuple(ks) for r, ks in row_keys.items()}, kept
+
+
+def analogs_of(row_id: Optional[int]) -> List[int]:
+    """Аналоги строки (без неё самой): строки с общим парт-номером, по порядку листа."""
+    if row_id is None:
+        return []
+    keys = _analog_row_keys.get(row_id)
+    if not keys:
+        return []
+    return sorted({r for k in keys for r in _analog_key_rows.get(k, ()) if r != row_id})
+
+
+def similar_rows(row_id: Optional[int], k: int = similar.TOP_K) -> List[int]:
+    """Похожие детали из фоновой TF-IDF таблицы текущей версии (пока не готова — пусто)."""
+    if row_id is None:
+        return []
+    return [r for r, _ in similar.neighbors(row_id, _catalog_version, k)]
+
+
 def build_image_index(df_: pd.DataFrame) -> Dict[str, str]:
     index: Dict[str, str] = {}
     if "image" not in df_.columns:
@@ -238,8 +508,8 @@ def build_image_index(df_: pd.DataFrame) -> Dict[str, str]:
 
     skip = {"png", "jpg", "jpeg", "gif", "webp", "svg"}
 
-    for _, row in df_.iterrows():
-        url = str(row.get("image", "")).strip()
+    for url in df_["image"].tolist():
+        url = str(url or "").strip()
         if not url:
             continue
 
@@ -255,18 +525,788 @@ def build_image_index(df_: pd.DataFrame) -> Dict[str, str]:
     return index
 
 
+def build_image_names(df_: pd.DataFrame) -> Tuple[str, List[int], List[str], Set[str]]:
+    """
+    Фолбэк поиска картинки по подстроке имени файла без перебора df:
+    склеенные токены имён всех URL (в порядке листа, без повторов) — одна
+    строка через "\0", начала имён и URL. Код ищется одним str.find, URL —
+    bisect по началам. Последний элемент — промахи этой версии каталога.
+    """
+    urls: List[str] = []
+    if "image" in df_.columns:
+        for url in dict.fromkeys(textnorm.map_series(df_["image"], lambda v: str(v or "").strip())):
+            if url:
+                urls.append(url)
+    names = ["".join(_url_name_tokens(u)) for u in urls]
+    starts: List[int] = []
+    pos = 0
+    for name in names:
+        starts.append(pos)
+        pos += len(name) + 1
+    return "\0".join(names), starts, urls, set()
+
+
+def _facet_value(v) -> str:
+    s = str(v if v is not None else "").strip()
+    return "" if s.lower() in ("nan", "none") else s
+
+
+def build_facets(df_: pd.DataFrame) -> Dict[str, Dict[str, int]]:
+    """Фасеты для меню категорий: колонка → значение → число строк."""
+    out: Dict[str, Dict[str, int]] = {}
+    for col in FACET_COLUMNS:
+        if col not in df_.columns:
+            continue
+        counts: Dict[str, int] = {}
+        for v in df_[col].tolist():
+            v = _facet_value(v)
+            if v:
+                counts[v] = counts.get(v, 0) + 1
+        out[col] = counts
+    return out
+
+
+def facet_values(col: str) -> List[str]:
+    """Значения фасета (например, типы деталей) по алфавиту."""
+    return sorted(_facets.get(col, {}))
+
+
+def build_indexes(df_: pd.DataFrame) -> Dict[str, object]:
+    """Все индексы каталога одним словарём (его же сохраняет снапшот)."""
+    field_index = build_field_index(df_)
+    analog_row_keys, analog_key_rows = build_analog_index(df_)
+    rows = df_.index.tolist()
+    return {
+        "hashes": row_hashes(df_),
+        "facets": build_facets(df_),
+        "search": build_search_index(df_),
+        "field": {col: PostingsIndex.from_dict(p, rows) for col, p in field_index.items()},
+        "field_terms": {col: sorted(p) for col, p in field_index.items()},
+        "positions": {col: PositionsIndex.from_dict(p, rows) for col, p in build_positional_index(df_).items()},
+        "bm25": build_bm25_stats(df_, field_index),
+        "code": build_code_index(df_),
+        "analog_row_keys": analog_row_keys,
+        "analog_key_rows": analog_key_rows,
+        "image": build_image_index(df_),
+    }
+
+
+def _install_catalog(new_df: pd.DataFrame, idx: Dict[str, object]) -> None:
+    """
+    Подмена каталога: всё тяжёлое (индексы, PartStore, имена картинок)
+    строится заранее, а под _install_lock глобальные переменные
+    переприсваиваются одна за другой. Это не одна атомарная подмена:
+    читатель без блокировки в этот короткий момент может взять, например,
+    новый индекс и старый df. Где это важно, сверяется _catalog_version
+    (page_rows, Part, кеши карточек и результатов).
+    """
+    global df, _search_index, _field_index, _field_terms, _positions, _image_index, _last_load_ts
+    global _catalog_version, _code_index, _analog_row_keys, _analog_key_rows, _bm25, _row_hashes, _facets, _parts
+    global _image_names
+
+    # category / общие строки (app/compact.py); и для загрузки, и для снапшотов старого формата
+    compact.compact_frame(new_df)
+    new_parts = parts.PartStore(new_df)
+    new_image_names = build_image_names(new_df)
+    # снапшоты до аналогов по смежности хранят группы union-find — пересобираем
+    new_analogs = (
+        (idx["analog_row_keys"], idx["analog_key_rows"]) if "analog_key_rows" in idx else build_analog_index(new_df)
+    )
+    rows = new_df.index
+    with _install_lock:
+        _search_index = idx["search"]
+        # снапшоты до сегментированного индекса хранят обычные dict
+        _field_index = {c: PostingsIndex.wrap(p, rows) for c, p in idx["field"].items()}
+        _field_terms = idx["field_terms"]
+        _positions = {c: PositionsIndex.wrap(p, rows) for c, p in idx["positions"].items()}
+        _bm25 = idx["bm25"]
+        _code_index = idx["code"]
+        _analog_row_keys = new_analogs[0]
+        _analog_key_rows = new_analogs[1]
+        _image_index = idx["image"]
+        _image_names = new_image_names
+        # снапшоты до дельта-синхронизации — без хешей и фасетов
+        _row_hashes = idx.get("hashes") or row_hashes(new_df)
+        _facets = idx.get("facets") or build_facets(new_df)
+        df = new_df
+        _last_load_ts = time.time()
+        _catalog_version += 1
+        new_parts.version = _catalog_version
+        _parts = new_parts
+    similar.start_build(df, _catalog_version)
+    _merge_segments_async()
+    _write_search_db_async(new_df, _row_hashes, _catalog_version)
+
+
+# ---------- Слияние сегментов ----------
+_install_lock = threading.Lock()
+_merge_running = threading.Event()
+
+
+def _replace_segmented(name: str):
+    """current(col, fn) для segments.merge_all: подмена индекса колонки под блокировкой."""
+    def current(col: str, fn) -> bool:
+        global _field_index, _positions
+        with _install_lock:
+            indexes = _field_index if name == "field" else _positions
+            cur = indexes.get(col)
+            new = fn(cur) if cur is not None else None
+            if new is None:
+                return False
+            if name == "field":
+                _field_index = {**_field_index, col: new}
+            else:
+                _positions = {**_positions, col: new}
+            return True
+    return current
+
+
+def _merge_segments() -> None:
+    try:
+        merge_all(_field_index, _replace_segmented("field"))
+        merge_all(_positions, _replace_segmented("positions"))
+    except Exception as e:
+        logger.warning(f"[segments] ошибка слияния: {e}")
+    finally:
+        _merge_running.clear()
+
+
+def _merge_segments_async() -> None:
+    """Фоновое слияние сегментов, если какой-то колонке оно нужно (одно за раз)."""
+    pending = [ix for ix in list(_field_index.values()) + list(_positions.values()) if ix.needs_merge()]
+    if not pending or _merge_running.is_set():
+        return
+    _merge_running.set()
+    threading.Thread(target=_merge_segments, name="segments-merge", daemon=True).start()
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _needs_refresh(force: bool) -> bool:
+    # интервал адаптивный (см. app/probe.py); без пробы — DATA_TTL
+    return force or df is None or (AUTO_REFRESH and time.time() - _last_load_ts > _poller.interval)
+
+
 def ensure_fresh_data(force: bool = False):
-    global df, _search_index, _image_index, _last_load_ts
-    need = force or df is None or (time.time() - _last_load_ts > DATA_TTL)
-    if not need:
+    """
+    Обновить каталог, если пора (или force). Фоновое обновление, /reload,
+    push и первая загрузка идут под общим _refresh_lock, какое бы имя
+    операции им ни дал gateway: плановое при идущем обновлении просто
+    пропускается, принудительное дожидается его и не повторяет, если
+    пока оно ждало, началось и удачно прошло обновление новее вызова.
+    """
+    global _refresh_started, _refresh_done
+    if not _needs_refresh(force):
+        return
+    if not force and df is not None and _on_event_loop():
+        # вызов из обработчика (поиск, картинки): отвечаем по текущей версии,
+        # обновление — в фоне в пуле Sheets, чтобы не держать event loop
+        gateway.spawn("catalog.refresh", ensure_fresh_data)
+        return
+
+    if not force and df is not None and breaker.breaker.is_open():
+        # Sheets недоступен — работаем на последней удачной версии, не дёргая API
+        return
+
+    ticket = _refresh_started
+    if not force and df is not None:
+        if not _refresh_lock.acquire(blocking=False):
+            return
+    else:
+        _refresh_lock.acquire()
+    try:
+        if _refresh_done > ticket:
+            # пока ждали, прошло обновление, начатое уже после этого вызова
+            return
+        if not _needs_refresh(force):
+            return
+        _refresh_started += 1
+        seq = _refresh_started
+        if _refresh_guarded(force):
+            _refresh_done = seq
+    finally:
+        _refresh_lock.release()
+
+
+def _refresh_guarded(force: bool) -> bool:
+    """_refresh; False — фоновое обновление не удалось (ошибка уже залогирована)."""
+    global _last_load_ts
+    try:
+        _refresh(force)
+        return True
+    except Exception as e:
+        if force or df is None:
+            raise
+        # фоновое обновление не удалось: ошибку в поиск не пробрасываем,
+        # следующая попытка — не раньше, чем цепь снова пустит запросы
+        retry = max(STALE_RETRY_SEC, breaker.breaker.retry_in())
+        _last_load_ts = time.time() - _poller.interval + retry
+        logger.warning(f"⚠️ Таблица недоступна, каталог v{_catalog_version} без обновления (повтор через {retry:.0f}s): {e}")
+        return False
+
+
+def _refresh(force: bool) -> None:
+    global _last_load_ts
+    lease = coordinator.backend()
+    if lease is not None:
+        _coordinated_refresh(lease, force)
+        return
+
+    if not _sheet_changed(force):
         return
+    new_df, idx = sync_from_sheets()
+    _poller.commit()
+    if not sync_changed():
+        _last_load_ts = time.time()
+        logger.info(f"✅ Каталог без изменений: {sync_summary()}")
+        return
+    _install_catalog(new_df, idx)
+    snapshot.save_snapshot_async(SNAPSHOT_PATH, new_df, idx)
+    logger.info(f"✅ Перезагружено {len(df)} строк: {sync_summary()}")
+
+
+# ---------- Дельта-синхронизация ----------
+def _row_keys(df_: pd.DataFrame) -> List[str]:
+    """Ключ строки — код; повторяющиеся коды различаются номером вхождения."""
+    codes = df_["код"].tolist() if "код" in df_.columns else [""] * len(df_)
+    seen: Dict[str, int] = {}
+    keys: List[str] = []
+    for c in codes:
+        c = _code_key(c)
+        k = seen.get(c, 0)
+        seen[c] = k + 1
+        keys.append(c if k == 0 else f"{c}#{k}")
+    return keys
+
+
+def _content_hashes(df_: pd.DataFrame) -> List[int]:
+    return pd.util.hash_pandas_object(df_, index=False).tolist() if len(df_) else []
+
+
+def row_hashes(df_: pd.DataFrame) -> Dict[str, Tuple[int, int]]:
+    """Ключ строки → (индекс строки, хеш содержимого всех колонок)."""
+    return dict(zip(_row_keys(df_), zip(df_.index.tolist(), _content_hashes(df_))))
+
+
+def diff_rows(
+    old: Dict[str, Tuple[int, int]], keys: List[str], hashes: List[int]
+) -> Tuple[List[int], List[int], List[int], List[int]]:
+    """
+    Сравнение свежей выгрузки (ключи и хеши её строк по порядку) с хешами
+    текущей версии. Возвращает (индексы для новых строк, добавленные,
+    изменённые, удалённые): у неизменённых и изменённых строк индекс прежний,
+    новые получают следующие.
+    """
+    next_label = max((lab for lab, _ in old.values()), default=-1) + 1
+    labels: List[int] = []
+    added: List[int] = []
+    changed: List[int] = []
+    seen: Set[str] = set()
+    for key, h in zip(keys, hashes):
+        prev = old.get(key)
+        if prev is None:
+            lab = next_label
+            next_label += 1
+            added.append(lab)
+        else:
+            lab = prev[0]
+            seen.add(key)
+            if prev[1] != h:
+                changed.append(lab)
+        labels.append(lab)
+    removed = [lab for key, (lab, _) in old.items() if key not in seen]
+    return labels, added, changed, removed
+
+
+def _current_indexes() -> Dict[str, object]:
+    return {
+        "hashes": _row_hashes,
+        "facets": _facets,
+        "search": _search_index,
+        "field": _field_index,
+        "field_terms": _field_terms,
+        "positions": _positions,
+        "bm25": _bm25,
+        "code": _code_index,
+        "analog_row_keys": _analog_row_keys,
+        "analog_key_rows": _analog_key_rows,
+        "image": _image_index,
+    }
+
+
+def _patch_sets(
+    postings: Dict[str, Set[int]], minus: Dict[str, Set[int]], plus: Dict[str, Set[int]]
+) -> Tuple[Dict[str, Set[int]], Set[str], Set[str]]:
+    """
+    Копия posting-листов с применённой дельтой: затронутые термины получают
+    новые множества (старая версия индекса не меняется — её читают другие потоки).
+    Возвращает (листы, появившиеся термины, исчезнувшие термины).
+    """
+    if not minus and not plus:
+        return postings, set(), set()
+    out = dict(postings)
+    born: Set[str] = set()
+    gone: Set[str] = set()
+    for t in minus.keys() | plus.keys():
+        prev = out.get(t)
+        rows = ((prev or set()) - minus.get(t, set())) | plus.get(t, set())
+        if rows:
+            out[t] = rows
+            if prev is None:
+                born.add(t)
+        elif prev is not None:
+            del out[t]
+            gone.add(t)
+    return out, born, gone
+
+
+def _patch_terms(terms: List[str], born: Set[str], gone: Set[str]) -> List[str]:
+    if not born and not gone:
+        return terms
+    out = list(terms)
+    for t in gone:
+        k = bisect.bisect_left(out, t)
+        if k < len(out) and out[k] == t:
+            del out[k]
+    for t in born:
+        bisect.insort(out, t)
+    return out
+
+
+def _row_token_map(rows: pd.DataFrame, col: str, fn) -> Dict[str, Set[int]]:
+    out: Dict[str, Set[int]] = {}
+    for i, v in zip(rows.index, rows[col].tolist()):
+        for t in fn(col, v):
+            out.setdefault(t, set()).add(i)
+    return out
+
 
+def _touches(old_rows: pd.DataFrame, new_rows: pd.DataFrame, cols) -> bool:
+    """Меняет ли дельта хоть одно непустое значение в колонках cols."""
+    for col in cols:
+        if col not in new_rows.columns:
+            continue
+        before = old_rows[col].astype(str).str.strip()
+        after = new_rows[col].astype(str).str.strip()
+        common = before.index.intersection(after.index)
+        if (before.loc[common] != after.loc[common]).any():
+            return True
+        if (before.drop(common) != "").any() or (after.drop(common) != "").any():
+            return True
+    return False
+
+
+def apply_delta(
+    old_df: pd.DataFrame, idx: Dict[str, object], new_df: pd.DataFrame,
+    added: List[int], changed: List[int], removed: List[int],
+    hashes: Dict[str, Tuple[int, int]],
+) -> Dict[str, object]:
+    """
+    Новые индексы = старые + дельта. Posting-листы и позиции — сегментированные
+    (app/segments.py): дельта ложится в delta-сегмент и tombstones, старые
+    сегменты не копируются. Работа пропорциональна числу изменённых
+    строк и их терминов; исключения — граф аналогов и индекс картинок, они
+    пересобираются целиком, только если дельта задела их колонки.
+    idf нетронутых терминов остаётся от прежнего числа строк (пересчитается
+    при полной пересборке) — на ранжирование это почти не влияет.
+    """
+    old_rows = old_df.loc[list(changed) + list(removed)]
+    new_rows = new_df.loc[list(changed) + list(added)]
+    out = dict(idx)
+    out["hashes"] = hashes
+
+    # пофилдовые posting-листы и отсортированные термины
+    field: Dict[str, Dict[str, Set[int]]] = {}
+    field_terms = dict(idx["field_terms"])
+    touched: Set[str] = set()
+    gone_rows = old_rows.index.tolist()
+    for col, postings in idx["field"].items():
+        postings = PostingsIndex.wrap(postings, old_df.index)
+        minus = _row_token_map(old_rows, col, _field_tokens)
+        content = {i: dict.fromkeys(_field_tokens(col, v), True) for i, v in zip(new_rows.index, new_rows[col].tolist())}
+        field[col] = postings.apply(gone_rows, content)
+        terms = minus.keys() | {t for c in content.values() for t in c}
+        born = {t for t in terms if t not in postings and t in field[col]}
+        gone = {t for t in terms if t in postings and t not in field[col]}
+        field_terms[col] = _patch_terms(field_terms.get(col, []), born, gone)
+        touched |= terms
+    out["field"] = field
+    out["field_terms"] = field_terms
+
+    # позиции слов
+    positions = {}
+    for col, postings in idx["positions"].items():
+        postings = PositionsIndex.wrap(postings, old_df.index)
+        content: Dict[int, Dict[str, object]] = {}
+        for i, v in zip(new_rows.index, new_rows[col].tolist()):
+            terms: Dict[str, List[int]] = {}
+            for pos, t in enumerate(_field_tokens(col, v)):
+                terms.setdefault(t, []).append(pos)
+            content[i] = terms
+        positions[col] = postings.apply(gone_rows, content)
+    out["positions"] = positions
+
+    # BM25F: tf / длины / средние длины по полям, idf затронутых терминов, коды
+    bm = idx["bm25"]
+    tf = dict(bm["tf"])
+    lens = dict(bm["len"])
+    avglen = dict(bm["avglen"])
+    for col in field:
+        col_tf = dict(tf.get(col, {}))
+        col_len = dict(lens.get(col, {}))
+        for i, v in zip(old_rows.index, old_rows[col].tolist()):
+            col_len.pop(i, None)
+            for t in set(_field_tokens(col, v)):
+                if i in col_tf.get(t, {}):
+                    rest = {r: c for r, c in col_tf[t].items() if r != i}
+                    if rest:
+                        col_tf[t] = rest
+                    else:
+                        del col_tf[t]
+        for i, v in zip(new_rows.index, new_rows[col].tolist()):
+            toks = _field_tokens(col, v)
+            if not toks:
+                continue
+            col_len[i] = len(toks)
+            seen: Dict[str, int] = {}
+            for t in toks:
+                seen[t] = seen.get(t, 0) + 1
+            for t, c in seen.items():
+                if c > 1:
+                    col_tf[t] = {**col_tf.get(t, {}), i: c}
+        tf[col] = col_tf
+        lens[col] = col_len
+        avglen[col] = (sum(col_len.values()) / len(col_len)) if col_len else 1.0
+
+    n = len(new_df)
+    idf = dict(bm["idf"])
+    for t in touched:
+        docs: Set[int] = set()
+        for postings in field.values():
+            docs |= postings.get(t, set())
+        if docs:
+            idf[t] = math.log(1.0 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+        else:
+            idf.pop(t, None)
+
+    code = dict(bm["code"])
+    for i in old_rows.index:
+        code.pop(i, None)
+    if "код" in new_rows.columns:
+        code.update(zip(new_rows.index, textnorm.map_series(new_rows["код"], _norm_code)))
+    out["bm25"] = {"n": n, "tf": tf, "len": lens, "avglen": avglen, "idf": idf, "code": code}
+
+    # код → первая строка с этим кодом
+    if "код" in new_df.columns:
+        code_index = dict(idx["code"])
+        keys = {_code_key(v) for v in old_rows["код"].tolist()} | {_code_key(v) for v in new_rows["код"].tolist()}
+        keys.discard("")
+        for key in keys:
+            norm = _norm_code(key)
+            cand = field.get("код", {}).get(norm) if norm else None
+            if cand is None:
+                cand = set(new_df.index[new_df["код"].map(_code_key) == key])
+            owners = [r for r in cand if _code_key(new_df.at[r, "код"]) == key]
+            if owners:
+                code_index[key] = min(owners)
+            else:
+                code_index.pop(key, None)
+        out["code"] = code_index
+
+    # фасеты
+    facets = dict(idx.get("facets") or {})
+    for col, counts in list(facets.items()):
+        c = dict(counts)
+        for v in old_rows[col].tolist():
+            v = _facet_value(v)
+            if v:
+                c[v] = c.get(v, 0) - 1
+                if c[v] <= 0:
+                    del c[v]
+        for v in new_rows[col].tolist():
+            v = _facet_value(v)
+            if v:
+                c[v] = c.get(v, 0) + 1
+        facets[col] = c
+    out["facets"] = facets
+
+    # старый общий индекс (по SEARCH_COLUMNS)
+    cols = [c for c in SEARCH_COLUMNS if c in new_df.columns]
+    if cols:
+        minus = {}
+        plus = {}
+        for rows, acc in ((old_rows, minus), (new_rows, plus)):
+            for i, row in rows.iterrows():
+                for t in _search_tokens(row, cols):
+                    acc.setdefault(t, set()).add(i)
+        out["search"], _, _ = _patch_sets(idx["search"], minus, plus)
+
+    if _touches(old_rows, new_rows, ANALOG_COLUMNS):
+        out["analog_row_keys"], out["analog_key_rows"] = build_analog_index(new_df)
+    if _touches(old_rows, new_rows, ("image",)):
+        out["image"] = build_image_index(new_df)
+    return out
+
+
+def sync_from_sheets() -> Tuple[pd.DataFrame, Dict[str, object]]:
+    """
+    Свежая выгрузка SAP + индексы для неё. Если каталог уже загружен, а
+    изменилось не больше DELTA_MAX_FRACTION строк — индексы получаются
+    применением дельты к текущим, иначе строятся заново.
+    Сводка — в _last_sync (см. sync_summary()).
+    """
+    global _last_sync
+    t0 = time.time()
     new_df = _load_sap_dataframe()
-    df = new_df
-    _search_index = build_search_index(df)
-    _image_index = build_image_index(df)
+    t_fetch = time.time() - t0
+    summary: Dict[str, object] = {"mode": "full", "rows": len(new_df), "added": len(new_df), "changed": 0, "removed": 0}
+
+    idx: Optional[Dict[str, object]] = None
+    if DELTA_SYNC and df is not None and _row_hashes and list(new_df.columns) == list(df.columns):
+        keys, content = _row_keys(new_df), _content_hashes(new_df)
+        labels, added, changed, removed = diff_rows(_row_hashes, keys, content)
+        n_changes = len(added) + len(changed) + len(removed)
+        if n_changes <= DELTA_MAX_FRACTION * max(1, len(df)):
+            hashes = dict(zip(keys, zip(labels, content)))
+            new_df.index = pd.Index(labels, dtype="int64")
+            new_df = new_df.sort_index()
+            idx = apply_delta(df, _current_indexes(), new_df, added, changed, removed, hashes)
+            summary.update(mode="delta", added=len(added), changed=len(changed), removed=len(removed))
+            summary["sample"] = {
+                "added": [_code_key(new_df.at[r, "код"]) for r in added[:5]] if "код" in new_df.columns else [],
+                "changed": [_code_key(new_df.at[r, "код"]) for r in changed[:5]] if "код" in new_df.columns else [],
+                "removed": [_code_key(df.at[r, "код"]) for r in removed[:5]] if "код" in df.columns else [],
+            }
+    if idx is None:
+        idx = build_indexes(new_df)
+
+    summary.update(fetch_s=round(t_fetch, 3), index_s=round(time.time() - t0 - t_fetch, 3), at=time.time())
+    _last_sync = summary
+    return new_df, idx
+
+
+def sync_changed() -> bool:
+    """Изменила ли последняя синхронизация хоть одну строку."""
+    s = _last_sync
+    return s.get("mode") != "delta" or bool(s.get("added") or s.get("changed") or s.get("removed"))
+
+
+def sync_summary() -> str:
+    s = _last_sync
+    if not s:
+        return "синхронизаций ещё не было"
+    text = (
+        f"{'дельта' if s['mode'] == 'delta' else 'полная пересборка'}: "
+        f"+{s['added']} ~{s['changed']} −{s['removed']} из {s['rows']} строк, "
+        f"выгрузка {s['fetch_s']:.2f}s, индексы {s['index_s']:.2f}s"
+    )
+    sample = s.get("sample") or {}
+    parts = [f"{k}: {', '.join(v)}" for k, v in sample.items() if v]
+    if parts:
+        text += " (" + "; ".join(parts) + ")"
+    return text
+
+
+def _sheet_changed(force: bool) -> bool:
+    """Проба ревизии перед выгрузкой: False — таблица не менялась, выгрузку пропускаем."""
+    global _last_load_ts
+    if force or df is None:
+        _poller.note()
+        return True
+    if _poller.check():
+        return True
     _last_load_ts = time.time()
-    logger.info(f"✅ Перезагружено {len(df)} строк и построены индексы")
+    logger.info(f"[probe] таблица не менялась — выгрузка пропущена ({_poller.stats()})")
+    return False
+
+
+# ---------- Координация реплик ----------
+def _install_published(version: int, path: str) -> bool:
+    """Поднять опубликованный лидером снапшот версии version."""
+    global _published_version
+    loaded = snapshot.load_snapshot(path)
+    if loaded is None:
+        return False
+    snap_df, idx, _meta = loaded
+    try:
+        _install_catalog(snap_df, idx)
+    except KeyError as e:
+        logger.warning(f"[coord] в снапшоте v{version} нет индекса {e}")
+        return False
+    _published_version = version
+    return True
+
+
+def _coordinated_refresh(lease, force: bool = False) -> None:
+    """
+    Лидер читает Sheets и публикует снапшот следующей версии,
+    остальные подтягивают опубликованную версию, если она новее своей.
+    """
+    global _last_load_ts, _published_version
+    published, path = lease.published()
+
+    if not lease.acquire(coordinator.REPLICA_ID, coordinator.REFRESH_LEASE_TTL):
+        if published > _published_version and _install_published(published, path):
+            logger.info(f"✅ [coord] follower: каталог v{published} от лидера, {len(df)} строк")
+        elif df is None:
+            # лидер ещё ничего не опубликовал — стартуем сами, без публикации
+            new_df = _load_sap_dataframe()
+            _install_catalog(new_df, build_indexes(new_df))
+            logger.info(f"[coord] follower: публикаций нет, загружено из Sheets {len(df)} строк")
+        else:
+            _last_load_ts = time.time()
+        return
+
+    # лидер: догоняем чужую публикацию, если проспали смену лидера
+    if published > _published_version:
+        _install_published(published, path)
+
+    if not _sheet_changed(force):
+        return
+    new_df, idx = sync_from_sheets()
+    _poller.commit()
+    if not sync_changed():
+        _last_load_ts = time.time()
+        return
+    _install_catalog(new_df, idx)
+
+    version = max(published, _published_version) + 1
+    out = coordinator.snapshot_path(version)
+    if snapshot.save_snapshot(out, new_df, idx, meta={"version": version, "leader": coordinator.REPLICA_ID}) \
+            and lease.publish(coordinator.REPLICA_ID, version, out):
+        _published_version = version
+        coordinator.prune_published()
+        logger.info(f"✅ [coord] лидер: опубликован каталог v{version}, {len(df)} строк")
+    else:
+        logger.warning(f"[coord] лидер: не удалось опубликовать v{version}")
+
+
+# ---------- SQLite FTS5 ----------
+def _current_search_db() -> Optional[searchdb.SearchDB]:
+    db = _search_db
+    return db if db is not None and _search_db_version == _catalog_version else None
+
+
+def _write_search_db(df_: pd.DataFrame, hashes: Dict[str, Tuple[int, int]], version: int) -> None:
+    global _search_db, _search_db_version
+    try:
+        db = searchdb.open_or_build(SEARCH_DB_PATH, df_, searchdb.digest(hashes))
+    except Exception as e:
+        logger.warning(f"[searchdb] {SEARCH_DB_PATH}: {e}")
+        return
+    if version != _catalog_version:
+        db.close()
+        return
+    # Старый объект не закрываем: запросы в других потоках могут ещё идти по
+    # его соединениям. Они закроются сборщиком, когда отпустят последнюю ссылку
+    # (_current_search_db отдаёт объект целиком, а не соединение).
+    _search_db, _search_db_version = db, version
+
+
+def _write_search_db_async(df_: pd.DataFrame, hashes: Dict[str, Tuple[int, int]], version: int) -> None:
+    if not SEARCH_DB_PATH:
+        return
+    threading.Thread(
+        target=_write_search_db, args=(df_, hashes, version), name="searchdb-write", daemon=True
+    ).start()
+
+
+def contains_rows(tokens: List[str], cols: List[str]) -> Set[int]:
+    """
+    Строки, где хотя бы в одном поле из cols встречаются все tokens (AND внутри
+    поля, OR по полям). SQLite FTS5, если файл текущей версии готов, иначе df.
+    """
+    db = _current_search_db()
+    if db is not None:
+        return db.contains_all(tokens, cols)
+    df_ = df
+    mask_any = pd.Series(False, index=df_.index)
+    for col in cols:
+        series = _safe_col(df_, col)
+        if series is None:
+            continue
+        field_mask = pd.Series(True, index=df_.index)
+        for t in tokens:
+            if t:
+                field_mask &= series.str.contains(re.escape(t), na=False)
+        mask_any |= field_mask
+    return set(df_.index[mask_any])
+
+
+def squash_rows(q_squash: str, cols: List[str]) -> Set[int]:
+    """Строки, где "склеенное" значение одного из полей cols содержит q_squash."""
+    db = _current_search_db()
+    if db is not None:
+        return db.contains_squashed(q_squash, cols)
+    df_ = df
+    mask_any = pd.Series(False, index=df_.index)
+    for col in cols:
+        series = _safe_col(df_, col)
+        if series is None:
+            continue
+        series_sq = series.str.replace(r"[\W_]+", "", regex=True)
+        mask_any |= series_sq.str.contains(re.escape(q_squash), na=False)
+    return set(df_.index[mask_any])
+
+
+def part(row_id: int) -> Optional[parts.Part]:
+    """Строка текущей версии каталога (Part, без Series/dict) или None."""
+    store = _parts
+    return store.part(row_id) if store is not None else None
+
+
+def page_rows(results: pd.DataFrame, start: int, end: int, version: int) -> List[Mapping]:
+    """
+    Строки выдачи [start:end]. Выдача той же версии каталога — Part по id;
+    если каталог с тех пор перезагружен (id уже другие) — dict из самой выдачи.
+    """
+    store = _parts
+    if store is not None and version == store.version:
+        out = [store.part(r) for r in results.index[start:end].tolist()]
+        if all(p is not None for p in out):
+            return out
+    return [row.to_dict() for _, row in results.iloc[start:end].iterrows()]
+
+
+def row_dict(row_id: int) -> Mapping:
+    """
+    Строка каталога: Part текущей версии, иначе из df.
+    """
+    p = part(row_id)
+    if p is not None:
+        return p
+    return df.loc[row_id].to_dict()
+
+
+def load_snapshot() -> bool:
+    """
+    Тёплый старт: поднимаем каталог из локального снапшота (SNAPSHOT_PATH).
+    Свежую загрузку из Sheets вызывающий запускает сам (обычно в фоне).
+    """
+    if df is not None:
+        return True
+    lease = coordinator.backend()
+    if lease is not None:
+        # при координации источник тёплого старта — последняя публикация лидера
+        published, path = lease.published()
+        if published and _install_published(published, path):
+            return True
+    loaded = snapshot.load_snapshot(SNAPSHOT_PATH)
+    if loaded is None:
+        return False
+    snap_df, idx, _meta = loaded
+    try:
+        _install_catalog(snap_df, idx)
+    except KeyError as e:
+        logger.warning(f"[snapshot] в снапшоте нет индекса {e} — игнорируем")
+        return False
+    return True
 
 
 # ---------- Картинки ----------
@@ -274,25 +1314,23 @@ async def find_image_by_code_async(code: str) -> str:
     ensure_fresh_data()
     if not code:
         return ""
-    key = _norm_code(code)
+    key = textnorm.q_norm_code(code)
     hit = _image_index.get(key)
     if hit:
         return hit
 
-    # Фолбэк — полный перебор по имени файла
-    try:
-        if df is not None and "image" in df.columns:
-            for url in df["image"]:
-                url = str(url or "").strip()
-                if not url:
-                    continue
-                tokens = _url_name_tokens(url)
-                name_join = "".join(tokens)
-                if key in tokens or key in name_join:
-                    return url
-    except Exception as e:
-        logger.warning(f"find_image_by_code_async fallback error: {e}")
-
+    # Фолбэк — код как подстрока склеенного имени файла (первый URL по порядку листа)
+    blob, starts, urls, misses = _image_names
+    if not urls or key in misses:
+        return ""
+    at = blob.find(key)
+    if at >= 0:
+        return urls[bisect.bisect_right(starts, at) - 1]
+
+    # у большинства деталей картинки нет — промах запоминаем до следующей версии
+    if len(misses) >= IMAGE_MISS_CACHE_MAX:
+        misses.clear()
+    misses.add(key)
     logger.info(f"[image] нет записи в индексе для кода: {key}")
     return ""
 
@@ -342,7 +1380,7 @@ def match_row_by_index(tokens: List[str]) -> Set[int]:
     if not tokens:
         return set()
 
-    tokens_norm = [_norm_code(t) for t in tokens if t]
+    tokens_norm = [textnorm.q_norm_code(t) for t in tokens if t]
     if not tokens_norm:
         return set()
 
@@ -368,60 +1406,6 @@ def match_row_by_index(tokens: List[str]) -> Set[int]:
     return found
 
 
-def _relevance_score(row: dict, tokens: List[str], q_squash: str) -> float:
-    tkns = [_norm_str(t) for t in tokens if t]
-    if not tkns:
-        return 0.0
-
-    code = _norm_str(row.get("код", ""))
-    name = _norm_str(row.get("наименование", ""))
-    ttype = _norm_str(row.get("тип", ""))
-    oem  = _norm_str(row.get("oem", ""))
-    manuf = _norm_str(row.get("изготовитель", ""))
-
-    weights = {
-        "код": 5.0,
-        "наименование": 3.0,
-        "тип": 2.0,
-        "oem": 2.0,
-        "изготовитель": 2.0,
-    }
-    fields = {
-        "код": code,
-        "наименование": name,
-        "тип": ttype,
-        "oem": oem,
-        "изготовитель": manuf,
-    }
-
-    score = 0.0
-    # Нахождение токенов
-    for f, text in fields.items():
-        for t in tkns:
-            if t and (t in text):
-                score += weights[f]
-
-    # Непрерывное вхождение
-    if q_squash:
-        joined = squash(code + name + ttype + oem + manuf)
-        if q_squash in joined:
-            score += 10.0
-
-    # Буст за точное совпадение/начало кода
-    q_full = " ".join(tkns)
-    q_full_no_ws = squash(q_full)
-    if code:
-        if code == q_full:
-            score += 100.0
-        if code.startswith(q_full) or code.startswith(q_full_no_ws):
-            score += 20.0
-        for t in tkns:
-            if code.startswith(t):
-                score += 5.0
-
-    return score
-
-
 # ---------- Экспорт ----------
 def _df_to_xlsx(df_: pd.DataFrame, filename: str = "export.xlsx") -> io.BytesIO:
     buf = io.BytesIO()
@@ -468,14 +1452,16 @@ def load_users_from_sheet() -> Tuple[Set[int], Set[int], Set[int]]:
     blocked: Set[int] = set()
 
     try:
-        client = get_gs_client()
-        sh = client.open_by_url(SPREADSHEET_URL)
-        ws = sh.worksheet(USERS_SHEET_NAME)
-    except Exception:
+        # обычно уже пришёл в общей выгрузке каталога — без отдельного запроса
+        all_vals = sheets.users_values(get_gs_client())
+    except Exception as e:
+        # таблица недоступна — оставляем последние известные права, а не "пускаем всех"
+        logger.warning(f"Лист пользователей не прочитан, права без изменений: {e}")
+        return set(SHEET_ALLOWED), set(SHEET_ADMINS), set(SHEET_BLOCKED)
+    if all_vals is None:
         logger.info("Лист пользователей отсутствует — пускаем всех по умолчанию")
         return allowed, admins, blocked
 
-    all_vals = ws.get_all_values()
     if not all_vals:
         return allowed, admins, blocked
 
@@ -532,10 +1518,9 @@ def load_users_from_sheet() -> Tuple[Set[int], Set[int], Set[int]]:
 
 
 # ---------- Async helper ----------
-import asyncio
 async def asyncio_to_thread(func, *args, **kwargs):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    # обращения к таблице — через пул и таймауты app/gateway.py
+    return await gateway.run(f"data.{getattr(func, '__name__', 'call')}", func, *args, **kwargs)
 
 
 # ---------- Backward-compat ----------
@@ -557,13 +1542,13 @@ def initial_load():
 
 async def initial_load_async():
     try:
-        await asyncio_to_thread(ensure_fresh_data, True)
+        await gateway.run("catalog.load", ensure_fresh_data, True)
     except Exception as e:
         logger.exception(f"initial_load_async error: {e}")
         raise
 
     try:
-        allowed, admins, blocked = await asyncio_to_thread(load_users_from_sheet)
+        allowed, admins, blocked = await gateway.run("users.load", load_users_from_sheet)
         SHEET_ALLOWED.clear(); SHEET_ALLOWED.update(allowed)
         SHEET_ADMINS.clear(); SHEET_ADMINS.update(admins)
         SHEET_BLOCKED.clear(); SHEET_BLOCKED.update(blocked)
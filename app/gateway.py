@@ -0,0 +1,333 @@
+# app/gateway.py
+"""
+Единый async-шлюз к Google Sheets.
+
+Вся синхронная работа gspread (выгрузка каталога, пользователи, запись в
+"История") выполняется в отдельном ограниченном пуле потоков, а не в общем
+executor'е asyncio и не прямо в event loop:
+
+- run(op, fn, ...) — дождаться результата, но не дольше таймаута операции;
+  по таймауту — SheetsTimeout, обработка вебхуков продолжается;
+- spawn(op, fn, ...) — запустить в фоне без ожидания (одна задача на op:
+  повторный вызов, пока первая не закончилась, ничего не делает);
+- write(title, row) — дописать строку в лист; если таблица недоступна
+  (цепь app/breaker.py разомкнута, квота, 429), строка откладывается в
+  DEFERRED_WRITES_PATH и дописывается одним запросом после первого удачного
+  обращения к таблице. После таймаута или 5xx строка могла уже записаться —
+  такие ошибки не откладываются, а отдаются вызывающему.
+
+Таймаут выбирается по префиксу имени операции ("catalog.*", "users.*",
+"history.*"). Поток, в котором идёт запрос, asyncio прервать не может —
+его ограничивает HTTP-таймаут клиента (SHEETS_HTTP_TIMEOUT, app/gclient.py).
+
+По каждой операции считаются вызовы, ошибки, таймауты и задержки (stats()).
+"""
+import os
+import json
+import time
+import fcntl
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from app import breaker, gclient
+from app.breaker import SheetsUnavailable
+
+logger = logging.getLogger("bot.gateway")
+
+try:
+    from app.config import (
+        SHEETS_WORKERS,
+        SHEETS_READ_TIMEOUT,
+        SHEETS_WRITE_TIMEOUT,
+        SHEETS_RELOAD_TIMEOUT,
+        DEFERRED_WRITES_PATH,
+    )
+except Exception:
+    SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "4"))
+    SHEETS_READ_TIMEOUT = float(os.getenv("SHEETS_READ_TIMEOUT", "20"))
+    SHEETS_WRITE_TIMEOUT = float(os.getenv("SHEETS_WRITE_TIMEOUT", "15"))
+    SHEETS_RELOAD_TIMEOUT = float(os.getenv("SHEETS_RELOAD_TIMEOUT", "120"))
+    DEFERRED_WRITES_PATH = os.getenv("DEFERRED_WRITES_PATH", ".cache/deferred_writes.jsonl")
+
+TIMEOUTS: Dict[str, float] = {
+    "catalog": SHEETS_RELOAD_TIMEOUT,
+    "users": SHEETS_READ_TIMEOUT,
+    "history": SHEETS_WRITE_TIMEOUT,
+}
+
+
+class SheetsTimeout(asyncio.TimeoutError):
+    """Операция с таблицей не уложилась в таймаут (сам запрос может ещё идти)."""
+
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_background: Dict[str, Future] = {}
+_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, SHEETS_WORKERS), thread_name_prefix="sheets")
+        return _executor
+
+
+def timeout_for(op: str) -> float:
+    return TIMEOUTS.get(op.split(".", 1)[0], SHEETS_READ_TIMEOUT)
+
+
+# ---------- Учёт ----------
+def _entry(op: str) -> Dict[str, float]:
+    return _stats.setdefault(op, {"calls": 0, "errors": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+
+def _record(op: str, ms: float, failed: bool) -> None:
+    with _lock:
+        s = _entry(op)
+        s["calls"] += 1
+        s["errors"] += int(failed)
+        s["total_ms"] += ms
+        s["max_ms"] = max(s["max_ms"], ms)
+
+
+def _timed(op: str, fn: Callable, args, kwargs):
+    """Обёртка для потока пула: время считается по фактическому выполнению."""
+    t0 = time.perf_counter()
+    try:
+        res = fn(*args, **kwargs)
+    except Exception:
+        _record(op, (time.perf_counter() - t0) * 1000, True)
+        raise
+    _record(op, (time.perf_counter() - t0) * 1000, False)
+    return res
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        out = {}
+        for op, s in _stats.items():
+            # calls/total_ms — завершившиеся выполнения (в т.ч. после таймаута ожидания)
+            out[op] = {**s, "avg_ms": round(s["total_ms"] / s["calls"], 1) if s["calls"] else 0.0}
+        out["_pool"] = {"workers": SHEETS_WORKERS, "background": sorted(k for k, f in _background.items() if not f.done())}
+    out["_breaker"] = {**breaker.breaker.stats(), "quota_used": breaker.budget.used(), "deferred": deferred_count()}
+    return out
+
+
+def summary() -> str:
+    parts = []
+    st = stats()
+    for op, s in st.items():
+        if op.startswith("_"):
+            continue
+        parts.append(
+            f"{op}: {s['calls']} выз., ср. {s['avg_ms']:.0f} ms, макс. {s['max_ms']:.0f} ms"
+            + (f", ошибок {s['errors']}" if s["errors"] else "")
+            + (f", таймаутов {s['timeouts']}" if s["timeouts"] else "")
+        )
+    b = st["_breaker"]
+    if b["state"] != breaker.CircuitBreaker.CLOSED:
+        parts.append(f"цепь {b['state']}, повтор через {b['retry_in']:.0f}s")
+    if b["deferred"]:
+        parts.append(f"отложено записей {b['deferred']}")
+    return "; ".join(parts) or "запросов к таблице ещё не было"
+
+
+# ---------- Вызовы ----------
+async def run(op: str, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+    """
+    fn(*args, **kwargs) в пуле Sheets; SheetsTimeout, если не успела за таймаут,
+    SheetsUnavailable сразу, если цепь разомкнута.
+    """
+    if breaker.breaker.is_open():
+        raise SheetsUnavailable(f"{op}: Google Sheets недоступен, повтор через {breaker.breaker.retry_in():.0f}s")
+    timeout = timeout_for(op) if timeout is None else timeout
+    fut = _pool().submit(_timed, op, fn, args, kwargs)
+    try:
+        res = await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+    except asyncio.TimeoutError:
+        # поток продолжит запрос и запишет его время сам; здесь — факт таймаута
+        with _lock:
+            _entry(op)["timeouts"] += 1
+        logger.warning(f"[gateway] {op}: нет ответа за {timeout:g}s")
+        raise SheetsTimeout(f"{op}: Google Sheets не ответил за {timeout:g}s") from None
+    if op != "history.flush" and deferred_count():
+        spawn("history.flush", flush_deferred)
+    return res
+
+
+def spawn(op: str, fn: Callable, *args, **kwargs) -> bool:
+    """Фоновый запуск без ожидания; False — такая операция уже идёт."""
+    pool = _pool()
+    with _lock:
+        cur = _background.get(op)
+        if cur is not None and not cur.done():
+            return False
+        fut = _background[op] = pool.submit(_timed, op, fn, args, kwargs)
+    fut.add_done_callback(lambda f: f.exception() and logger.warning(f"[gateway] {op}: {f.exception()}"))
+    return True
+
+
+# ---------- Отложенные записи ----------
+async def write(title: str, row: list, header: Optional[List[str]] = None) -> bool:
+    """
+    Дописать строку в лист. True — записано; False — таблица недоступна
+    или отказала по квоте до выполнения, строка отложена и будет записана
+    позже. SheetsTimeout, 5xx, сетевые ошибки — запрос мог дойти: записано
+    ли, неизвестно, поэтому не откладываем (иначе возможен дубль списания).
+    """
+    try:
+        await run("history.append", gclient.append_row, title, row, header)
+        return True
+    except SheetsUnavailable as e:
+        reason = str(e)
+    except Exception as e:
+        if not breaker.is_rejected(e):
+            raise
+        reason = f"{type(e).__name__}: {e}"
+    _defer([{"title": title, "row": row, "header": header, "ts": time.time()}])
+    logger.warning(f"[gateway] запись в {title!r} отложена ({reason})")
+    return False
+
+
+def _defer(items: List[dict]) -> None:
+    os.makedirs(os.path.dirname(DEFERRED_WRITES_PATH) or ".", exist_ok=True)
+    with open(DEFERRED_WRITES_PATH, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        for it in items:
+            f.write(json.dumps(it, ensure_ascii=False) + "\n")
+
+
+def _flushing_path() -> str:
+    return DEFERRED_WRITES_PATH + ".flushing"
+
+
+def _read_items(path: str) -> List[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _write_items(path: str, items: List[dict]) -> None:
+    """Атомарно (tmp + fsync + rename) заменить файл; пустой список — удалить его."""
+    if not items:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for it in items:
+            f.write(json.dumps(it, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def deferred_count() -> int:
+    n = 0
+    for path in (DEFERRED_WRITES_PATH, _flushing_path()):
+        try:
+            if not os.path.getsize(path):
+                continue
+            with open(path, encoding="utf-8") as f:
+                n += sum(1 for line in f if line.strip())
+        except OSError:
+            pass
+    return n
+
+
+def _take_queue() -> List[dict]:
+    """
+    Перенести очередь в .flushing: сначала файл .flushing (остаток прошлой
+    попытки + новые строки) надёжно записан, только потом очередь очищается.
+    Падение между этими шагами оставит строки в обоих файлах — при следующем
+    сбросе они склеиваются без повторов.
+    """
+    pending = _read_items(_flushing_path())
+    try:
+        with open(DEFERRED_WRITES_PATH, "r+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            queued = [json.loads(line) for line in f if line.strip()]
+            if queued:
+                seen = {json.dumps(it, sort_keys=True, ensure_ascii=False) for it in pending}
+                pending += [it for it in queued if json.dumps(it, sort_keys=True, ensure_ascii=False) not in seen]
+                _write_items(_flushing_path(), pending)
+                f.seek(0)
+                f.truncate()
+    except FileNotFoundError:
+        pass
+    return pending
+
+
+def _park_failed(items: List[dict], exc: BaseException) -> None:
+    """Строки, судьба которых неизвестна, — на ручную сверку, не в очередь."""
+    with open(DEFERRED_WRITES_PATH + ".failed", "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        for it in items:
+            f.write(json.dumps({**it, "error": f"{type(exc).__name__}: {exc}"[:300]}, ensure_ascii=False) + "\n")
+
+
+def flush_deferred() -> int:
+    """
+    Дописать отложенные строки (по листам, одним append_rows на лист).
+
+    Воркеры prefork пишут в ту же очередь, поэтому сбрасывает один процесс
+    (неблокирующий flock на .lock). Строки удаляются из .flushing только
+    после подтверждённой записи своего листа; при отказе по квоте (429) и
+    недоступности таблицы они остаются там до следующей попытки. Если же
+    ответа нет или он неоднозначный (таймаут, 5xx) либо ошибка постоянная,
+    лист в очередь не возвращается — строки уходят в .failed для ручной
+    сверки, чтобы не задвоить списания.
+    """
+    os.makedirs(os.path.dirname(DEFERRED_WRITES_PATH) or ".", exist_ok=True)
+    with open(DEFERRED_WRITES_PATH + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        pending = _take_queue()
+        if not pending:
+            return 0
+
+        titles = list(dict.fromkeys(it["title"] for it in pending))
+        done = 0
+        for title in titles:
+            group = [it for it in pending if it["title"] == title]
+            try:
+                gclient.append_rows(title, [it["row"] for it in group], group[0].get("header"))
+            except Exception as e:
+                if isinstance(e, SheetsUnavailable) or breaker.is_rejected(e):
+                    logger.warning(f"[gateway] отложенные записи: {done} записано, {len(pending)} ждут: {e}")
+                    raise
+                pending = [it for it in pending if it["title"] != title]
+                _park_failed(group, e)
+                _write_items(_flushing_path(), pending)
+                logger.error(
+                    f"[gateway] отложенные записи в {title!r} ({len(group)}): исход неизвестен, "
+                    f"перенесены в {DEFERRED_WRITES_PATH}.failed: {e}"
+                )
+                raise
+            pending = [it for it in pending if it["title"] != title]
+            _write_items(_flushing_path(), pending)
+            done += len(group)
+    logger.info(f"[gateway] отложенные записи дописаны: {done}")
+    return done
+
+
+def _reset_after_fork() -> None:
+    # потоки пула в дочерний процесс не переходят
+    global _executor, _lock
+    _lock = threading.Lock()
+    _executor = None
+    _background.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,183 @@
+# app/gclient.py
+"""
+Один долгоживущий клиент Google Sheets на процесс.
+
+Раньше каждый вызов get_gs_client() заново разбирал JSON ключа, строил
+Credentials и делал gspread.authorize (новая HTTP-сессия → OAuth + TLS),
+а затем open_by_url и worksheet() — ещё два запроса метаданных.
+Здесь:
+- клиент и его AuthorizedSession (keep-alive пул соединений) создаются один раз;
+- токен обновляется заранее, за REFRESH_MARGIN_SEC до истечения, а не
+  внутри пользовательского запроса;
+- Spreadsheet и Worksheet кешируются по названию листа.
+В итоге операция над листом — один API-запрос.
+
+После fork (prefork-воркеры) клиент сбрасывается: сокеты пула нельзя делить
+между процессами.
+"""
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import gspread
+from gspread.http_client import HTTPClient
+from gspread.utils import extract_id_from_url
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+from app import breaker
+
+logger = logging.getLogger("bot.gclient")
+
+try:
+    from app.config import SPREADSHEET_URL, HISTORY_SHEET, SHEETS_HTTP_TIMEOUT
+except Exception:
+    SPREADSHEET_URL = os.getenv("SPREADSHEET_URL", "")
+    HISTORY_SHEET = os.getenv("HISTORY_SHEET", "История")
+    SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+
+GOOGLE_APPLICATION_CREDENTIALS_JSON = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON", "")
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    # version/modifiedTime файла для пробы изменений (app/probe.py)
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
+HISTORY_HEADER = ["Дата", "ID", "Имя", "Тип", "Наименование", "Код", "Количество", "Коментарий"]
+
+# Обновлять токен, если до истечения осталось меньше
+REFRESH_MARGIN_SEC = 300
+
+_lock = threading.RLock()
+_creds: Optional[Credentials] = None
+_client: Optional[gspread.Client] = None
+_spreadsheet: Optional[gspread.Spreadsheet] = None
+_worksheets: Dict[str, gspread.Worksheet] = {}
+stats: Dict[str, int] = {"authorize": 0, "token_refresh": 0, "open": 0, "worksheet": 0}
+
+
+class GuardedHTTPClient(HTTPClient):
+    """Каждый HTTP-запрос — через цепь, квоту и повторы app/breaker.py (GET — чтение, остальное — запись)."""
+
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = "read" if method.lower() == "get" else "write"
+        return breaker.guarded(kind, lambda: super(GuardedHTTPClient, self).request(method, endpoint, *args, **kwargs))
+
+
+def _credentials() -> Credentials:
+    if not GOOGLE_APPLICATION_CREDENTIALS_JSON:
+        raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS_JSON не задан")
+    try:
+        info = json.loads(GOOGLE_APPLICATION_CREDENTIALS_JSON)
+        return Credentials.from_service_account_info(info, scopes=SCOPES)
+    except json.JSONDecodeError:
+        return Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS_JSON, scopes=SCOPES)
+
+
+def _refresh_if_needed() -> None:
+    expiry = _creds.expiry
+    now = datetime.now(timezone.utc).replace(tzinfo=None)   # google-auth хранит expiry в naive UTC
+    if _creds.token and expiry is not None and (expiry - now).total_seconds() > REFRESH_MARGIN_SEC:
+        return
+    _creds.refresh(Request())
+    stats["token_refresh"] += 1
+
+
+def client() -> gspread.Client:
+    """Клиент процесса; токен к моменту возврата действителен ещё REFRESH_MARGIN_SEC."""
+    global _creds, _client
+    with _lock:
+        if _client is None:
+            _creds = _credentials()
+            _client = gspread.authorize(_creds, http_client=GuardedHTTPClient)
+            # без таймаута зависший ответ навсегда занимает поток пула app/gateway.py
+            _client.set_timeout(SHEETS_HTTP_TIMEOUT)
+            stats["authorize"] += 1
+        _refresh_if_needed()
+        return _client
+
+
+def spreadsheet() -> gspread.Spreadsheet:
+    global _spreadsheet
+    c = client()
+    with _lock:
+        if _spreadsheet is None:
+            _spreadsheet = c.open_by_key(extract_id_from_url(SPREADSHEET_URL))
+            stats["open"] += 1
+        return _spreadsheet
+
+
+def worksheet(title: str, create_header: Optional[List[str]] = None) -> gspread.Worksheet:
+    """
+    Лист по названию из кеша. Если листа нет и дан create_header — лист
+    создаётся с этим заголовком, иначе WorksheetNotFound.
+    """
+    with _lock:
+        ws = _worksheets.get(title)
+        if ws is not None:
+            return ws
+        sh = spreadsheet()
+        try:
+            ws = sh.worksheet(title)
+        except gspread.WorksheetNotFound:
+            if create_header is None:
+                raise
+            ws = sh.add_worksheet(title=title, rows=1000, cols=max(12, len(create_header)))
+            ws.append_row(create_header)
+        stats["worksheet"] += 1
+        _worksheets[title] = ws
+        return ws
+
+
+def append_rows(title: str, rows: List[list], create_header: Optional[List[str]] = None) -> None:
+    """
+    append_rows в лист из кеша (одним запросом). Если хендл устарел (лист
+    удалили/пересоздали: 400 "Unable to parse range" или 404) — кеш хендлов
+    сбрасывается и запись повторяется один раз. Такие ответы означают, что
+    строки не записаны; при любой другой ошибке повтор мог бы их задвоить.
+    """
+    ws = worksheet(title, create_header)
+    try:
+        ws.append_rows(rows, value_input_option="USER_ENTERED")
+    except gspread.exceptions.APIError as e:
+        if getattr(e, "code", 0) not in (400, 404):
+            raise
+        logger.warning(f"[gclient] {title}: {e} — перечитываю лист")
+        forget()
+        worksheet(title, create_header).append_rows(rows, value_input_option="USER_ENTERED")
+
+
+def append_row(title: str, row: list, create_header: Optional[List[str]] = None) -> None:
+    append_rows(title, [row], create_header)
+
+
+def history() -> gspread.Worksheet:
+    """Лист списаний; создаётся с HISTORY_HEADER, если его нет."""
+    return worksheet(HISTORY_SHEET, HISTORY_HEADER)
+
+
+def forget(title: Optional[str] = None) -> None:
+    """Сбросить кеш листа (переименовали/удалили) или всей таблицы."""
+    global _spreadsheet
+    with _lock:
+        if title is None:
+            _spreadsheet = None
+            _worksheets.clear()
+        else:
+            _worksheets.pop(title, None)
+
+
+def reset() -> None:
+    """Полный сброс: новый клиент, сессия и хендлы при следующем обращении."""
+    global _creds, _client, _spreadsheet, _lock
+    _lock = threading.RLock()
+    _creds = None
+    _client = None
+    _spreadsheet = None
+    _worksheets.clear()
+
+
+os.register_at_fork(after_in_child=reset)
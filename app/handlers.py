@@ -6,7 +6,6 @@ import asyncio
 import logging
 from html import escape
 
-import pandas as pd
 import aiohttp  # для байтового фолбэка изображений
 from telegram import (
     Update,
@@ -40,6 +39,9 @@ from app.config import (
 
 # ВАЖНО: работаем через модуль, чтобы всегда видеть актуальные данные
 import app.data as data
+import app.query as query
+import app.ranking as ranking
+from app import gateway, gclient, prefork, sheets, textnorm
 
 logger = logging.getLogger("bot.handlers")
 
@@ -62,8 +64,27 @@ def confirm_markup():
     )
 
 
-def more_markup():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⏭ Ещё", callback_data="more")]])
+def more_markup(has_more: bool = True):
+    rows = []
+    if has_more:
+        rows.append([InlineKeyboardButton("⏭ Ещё", callback_data="more")])
+    rows.append([InlineKeyboardButton("🔎 Искать в результатах", callback_data="refine")])
+    return InlineKeyboardMarkup(rows)
+
+
+def card_markup(code: str):
+    """
+    Кнопки под карточкой: списание + аналоги (если есть общие OEM/парт-номера)
+    + похожие (если таблица соседей уже посчитана).
+    """
+    row_id = data.find_row_by_code(code)
+    buttons = [InlineKeyboardButton("📦 Взять деталь", callback_data=f"issue:{code}")]
+    if data.analogs_of(row_id):
+        buttons.append(InlineKeyboardButton("🔁 Аналоги", callback_data=f"analogs:{code}"))
+    rows = [buttons]
+    if data.similar_rows(row_id):
+        rows.append([InlineKeyboardButton("🧭 Похожие", callback_data=f"similar:{code}")])
+    return InlineKeyboardMarkup(rows)
 
 
 def main_menu_markup():
@@ -131,7 +152,12 @@ async def _safe_send_html_message(bot, chat_id: int, text: str, **kwargs):
 
 # --------------------- Пользователи: допуски -----------------
 async def ensure_users_async(force: bool = False):
-    allowed, admins, blocked = await asyncio.to_thread(data.load_users_from_sheet)
+    try:
+        allowed, admins, blocked = await gateway.run("users.load", data.load_users_from_sheet)
+    except Exception as e:
+        # цепь разомкнута / таймаут — права остаются прежними
+        logger.debug(f"Пользователи не обновлены: {e}")
+        return
     data.SHEET_ALLOWED.clear()
     data.SHEET_ALLOWED.update(allowed)
     data.SHEET_ADMINS.clear()
@@ -330,9 +356,7 @@ async def send_row_with_image(update: Update, row: dict, text: str):
     если нет — текстовое сообщение через _safe_send_html_message.
     """
     code = str(row.get("код", "")).strip().lower()
-    kb = InlineKeyboardMarkup(
-        [[InlineKeyboardButton("📦 Взять деталь", callback_data=f"issue:{code}")]]
-    )
+    kb = card_markup(code)
 
     bot = update.get_bot()
     chat_id = update.effective_chat.id
@@ -375,9 +399,7 @@ async def send_row_with_image_bot(bot, chat_id: int, row: dict, text: str):
     То же, что send_row_with_image, но используется, когда у нас уже есть bot и chat_id.
     """
     code = str(row.get("код", "")).strip().lower()
-    kb = InlineKeyboardMarkup(
-        [[InlineKeyboardButton("📦 Взять деталь", callback_data=f"issue:{code}")]]
-    )
+    kb = card_markup(code)
 
     url_raw = await data.find_image_by_code_async(code)
     if not url_raw:
@@ -416,6 +438,7 @@ async def send_row_with_image_bot(bot, chat_id: int, row: dict, text: str):
 async def menu_search_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
+    _drop_refine(q.from_user.id)
     msg = (
         "🔍 <b>Умный поиск</b>\n\n"
         "Введите <i>название</i>, <i>модель</i>, <i>код</i> или <i>парт-номер</i>.\n"
@@ -423,7 +446,11 @@ async def menu_search_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "<b>Примеры:</b>\n"
         "• <code>PI 8808 DRG 500</code>\n"
         "• <code>фильтр топливный</code>\n"
-        "• <code>W 75/3</code>"
+        "• <code>W 75/3</code>\n\n"
+        "<b>Точный поиск:</b>\n"
+        "• <code>код:PI88* изготовитель:bosch</code>\n"
+        "• <code>\"фильтр топливный\" -тип:масляный</code>\n"
+        "• <code>bosch OR mann</code>"
     )
     await _safe_send_html_message(context.bot, q.message.chat_id, msg)
 
@@ -463,7 +490,7 @@ async def noop_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     data.issue_state.pop(uid, None)
-    data.user_state.pop(uid, None)
+    data.user_state.pop(uid, None)  # вместе с флагом уточнения
 
     await send_welcome_sequence(update, context)
 
@@ -529,10 +556,18 @@ async def reload_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if not is_admin(uid):
         return await update.message.reply_text("Доступ запрещён.")
-    data.ensure_fresh_data(force=True)
+    # prefork: каталог обновляет родитель и перезапускает воркеров с новой версией
+    if prefork.request_refresh():
+        ensure_users(force=True)
+        return await update.message.reply_text("✅ Данные и пользователи перезагружены (в фоне).")
+    try:
+        await gateway.run("catalog.reload", data.ensure_fresh_data, True)
+    except gateway.SheetsTimeout as e:
+        return await update.message.reply_text(f"⏳ {e}. Перезагрузка продолжится в фоне.")
     ensure_users(force=True)
     await update.message.reply_text(
-        "✅ Данные и пользователи перезагружены (в фоне)."
+        f"✅ Данные и пользователи перезагружены.\n{data.sync_summary()}\n"
+        f"Sheets: {gateway.summary()}"
     )
 
 
@@ -626,6 +661,11 @@ async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --------------------- Поиск -----------------
+def _drop_refine(uid: int) -> None:
+    """Режим «искать в результатах» действует только на следующий запрос."""
+    data.user_state.get(uid, {}).pop("refine", None)
+
+
 async def send_page(update: Update, uid: int):
     st = data.user_state.get(uid, {})
     results = st.get("results")
@@ -645,12 +685,14 @@ async def send_page(update: Update, uid: int):
     await update.message.reply_text(
         f"Стр. {page+1}/{pages}. Показываю {start + 1}–{end} из {total}."
     )
-    for _, row in results.iloc[start:end].iterrows():
-        await send_row_with_image(
-            update, row.to_dict(), data.format_row(row.to_dict())
-        )
+    for row in data.page_rows(results, start, end, st.get("version", 0)):
+        await send_row_with_image(update, row, data.card_html(row))
     if end < total:
         await update.message.reply_text("Показать ещё?", reply_markup=more_markup())
+    elif total > PAGE_SIZE:
+        await update.message.reply_text(
+            "Это все результаты.", reply_markup=more_markup(has_more=False)
+        )
 
 
 async def send_page_via_bot(bot, chat_id: int, uid: int):
@@ -673,14 +715,18 @@ async def send_page_via_bot(bot, chat_id: int, uid: int):
         chat_id=chat_id,
         text=f"Стр. {page+1}/{pages}. Показываю {start + 1}–{end} из {total}.",
     )
-    for _, row in results.iloc[start:end].iterrows():
-        await send_row_with_image_bot(
-            bot, chat_id, row.to_dict(), data.format_row(row.to_dict())
-        )
+    for row in data.page_rows(results, start, end, st.get("version", 0)):
+        await send_row_with_image_bot(bot, chat_id, row, data.card_html(row))
     if end < total:
         await bot.send_message(
             chat_id=chat_id, text="Показать ещё?", reply_markup=more_markup()
         )
+    elif total > PAGE_SIZE:
+        await bot.send_message(
+            chat_id=chat_id,
+            text="Это все результаты.",
+            reply_markup=more_markup(has_more=False),
+        )
 
 
 async def search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -690,6 +736,8 @@ async def search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid = update.effective_user.id
+    # Флаг уточнения снимаем сразу, чтобы ранний выход его не оставил
+    refine = data.user_state.get(uid, {}).pop("refine", False)
     st_issue = data.issue_state.get(uid)
     if st_issue:
         if "quantity" not in st_issue:
@@ -717,81 +765,79 @@ async def search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         st["search_history"] = history
 
     # Базовые токены и "склеенная" фраза
-    tokens = data.normalize(q).split()
-    q_squash = data.squash(q)
-    norm_code = data._norm_code(q)  # "LR 7000" -> "lr7000"
+    # нормализация запроса — с кешем (app/textnorm.py)
+    tokens = textnorm.q_normalize(q).split()
+    q_squash = textnorm.q_squash(q)
+    norm_code = textnorm.q_norm_code(q)  # "LR 7000" -> "lr7000"
 
     # Гарантируем наличие данных
     if data.df is None:
-        await asyncio.to_thread(data.ensure_fresh_data, True)
+        try:
+            await gateway.run("catalog.load", data.ensure_fresh_data)
+        except Exception as e:
+            logger.warning(f"Загрузка каталога: {e}")
         if data.df is None:
             return await update.message.reply_text("Ошибка загрузки данных.")
     df_ = data.df
 
+    # Уточнение: ищем только среди прошлой выдачи (если каталог не перезагружался)
+    if refine:
+        prev = st.get("results")
+        if (
+            prev is not None
+            and not prev.empty
+            and st.get("version") == data._catalog_version
+        ):
+            keep = query.refine_query(prev.index, q)
+            if not keep:
+                return await update.message.reply_text(
+                    f"Среди {len(prev)} результатов по «{q}» ничего не найдено.",
+                    reply_markup=more_markup(has_more=False),
+                )
+            st["query"] = f"{st.get('query', '')} + {q}"
+            st["results"] = prev[prev.index.isin(keep)]
+            st["page"] = 0
+            return await send_page(update, uid)
+
+    # 0) Запрос с синтаксисом (поле:значение, "фраза", OR, -исключение, префикс*)
+    if query.is_structured(q):
+        ids = query.run_query(q)
+        if not ids:
+            return await update.message.reply_text(
+                f"По запросу «{q}» ничего не найдено."
+            )
+        st["query"] = q
+        st["results"] = df_.loc[ids]
+        st["version"] = data._catalog_version
+        st["page"] = 0
+        return await send_page(update, uid)
+
     # 1) Строгий поиск по нормализованному коду
     if norm_code:
         matched_indices = data.match_row_by_index([norm_code])
     else:
         matched_indices = data.match_row_by_index(tokens)
 
-    # 2) Фолбэк: AND внутри поля, OR по полям
+    # 2) Фолбэк: AND внутри поля, OR по полям (SQLite FTS5 или df, см. data.contains_rows)
+    fallback_cols = ["тип", "наименование", "код", "oem", "изготовитель"]
     if not matched_indices:
-        mask_any = pd.Series(False, index=df_.index)
-        for col in ["тип", "наименование", "код", "oem", "изготовитель"]:
-            series = data._safe_col(df_, col)
-            if series is None:
-                continue
-            field_mask = pd.Series(True, index=df_.index)
-            for t in tokens:
-                if t:
-                    field_mask &= series.str.contains(re.escape(t), na=False)
-            mask_any |= field_mask
-        matched_indices = set(df_.index[mask_any])
+        matched_indices = data.contains_rows(tokens, fallback_cols)
 
     # 3) Фразовый поиск по склеенным полям
     if not matched_indices and q_squash:
-        mask_any = pd.Series(False, index=df_.index)
-        for col in ["тип", "наименование", "код", "oem", "изготовитель"]:
-            series = data._safe_col(df_, col)
-            if series is None:
-                continue
-            series_sq = series.str.replace(r"[\W_]+", "", regex=True)
-            mask_any |= series_sq.str.contains(re.escape(q_squash), na=False)
-        matched_indices = set(df_.index[mask_any])
+        matched_indices = data.squash_rows(q_squash, fallback_cols)
 
     if not matched_indices:
         return await update.message.reply_text(
             f"По запросу «{q}» ничего не найдено."
         )
 
-    results_df = df_.loc[list(matched_indices)].copy()
-
-    # Сортировка по релевантности
-    scores = []
-    for _, r in results_df.iterrows():
-        scores.append(
-            data._relevance_score(
-                r.to_dict(),
-                tokens + ([norm_code] if norm_code else []),
-                q_squash,
-            )
-        )
-    results_df["__score"] = scores
-
-    if "код" in results_df.columns:
-        results_df = results_df.sort_values(
-            by=["__score", "код"],
-            ascending=[False, True],
-            key=lambda s: s
-            if s.name != "код"
-            else s.astype(str).str.len(),
-        )
-    else:
-        results_df = results_df.sort_values(by=["__score"], ascending=False)
-    results_df = results_df.drop(columns="__score")
+    # Сортировка по релевантности (BM25F по статистике индекса + бусты по коду)
+    results_df = df_.loc[ranking.rank(matched_indices, q)]
 
     st["query"] = q
     st["results"] = results_df
+    st["version"] = data._catalog_version
     st["page"] = 0
 
     await send_page(update, uid)
@@ -799,6 +845,7 @@ async def search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def more_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
+    _drop_refine(uid)
     st = data.user_state.get(uid, {})
     results = st.get("results")
     if results is None or results.empty:
@@ -807,18 +854,72 @@ async def more_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_page(update, uid)
 
 
+async def on_refine_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    uid = q.from_user.id
+    st = data.user_state.get(uid, {})
+    results = st.get("results")
+    if results is None or results.empty:
+        return await q.message.reply_text("Сначала выполните поиск.")
+    st["refine"] = True
+    await q.message.reply_text(
+        f"🔎 Введите слово — поищу среди {len(results)} результатов "
+        f"по «{st.get('query', '')}»."
+    )
+
+
+async def on_analogs_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    uid = q.from_user.id
+    _drop_refine(uid)
+    code = q.data.split(":", 1)[1].strip().lower()
+
+    ids = data.analogs_of(data.find_row_by_code(code))
+    if not ids or data.df is None:
+        return await q.message.reply_text("Аналогов по OEM / парт-номерам не найдено.")
+
+    st = data.user_state.setdefault(uid, {})
+    st["query"] = f"Аналоги {code.upper()}"
+    st["results"] = data.df.loc[ids]
+    st["version"] = data._catalog_version
+    st["page"] = 0
+    await send_page_via_bot(context.bot, q.message.chat.id, uid)
+
+
+async def on_similar_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    uid = q.from_user.id
+    _drop_refine(uid)
+    code = q.data.split(":", 1)[1].strip().lower()
+
+    ids = data.similar_rows(data.find_row_by_code(code))
+    if not ids or data.df is None:
+        return await q.message.reply_text("Похожие детали ещё не рассчитаны — попробуйте позже.")
+
+    st = data.user_state.setdefault(uid, {})
+    st["query"] = f"Похожие на {code.upper()}"
+    st["results"] = data.df.loc[ids]
+    st["version"] = data._catalog_version
+    st["page"] = 0
+    await send_page_via_bot(context.bot, q.message.chat.id, uid)
+
+
 # ------------------ Списание -----------------
 async def on_issue_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
+    _drop_refine(uid)
     code = q.data.split(":", 1)[1].strip().lower()
 
     found = None
-    if data.df is not None and "код" in data.df.columns:
-        hit = data.df[data.df["код"].astype(str).str.lower() == code]
-        if not hit.empty:
-            found = hit.iloc[0].to_dict()
+    if data.df is not None:
+        row_id = data.find_row_by_code(code)
+        if row_id is not None:
+            found = data.part(row_id)
 
     if not found:
         return await q.edit_message_text(
@@ -894,30 +995,23 @@ async def handle_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return data.ASK_CONFIRM
 
 
-async def save_issue_to_sheet(bot, user, part: dict, quantity, comment: str):
-    from app.config import SPREADSHEET_URL
-    import gspread
+async def save_issue_to_sheet(bot, user, part: dict, quantity, comment: str) -> bool:
+    """True — записано в "История", False — таблица недоступна, запись отложена."""
+    # заголовок обычно уже есть из общей выгрузки (app/sheets.py)
+    headers_raw = sheets.history_header()
+    if headers_raw is None:
+        try:
+            headers_raw = await gateway.run("history.header", lambda: gclient.history().row_values(1))
+        except Exception as e:
+            logger.warning(f"Заголовок 'История' недоступен, стандартные колонки: {e}")
+            headers_raw = gclient.HISTORY_HEADER
+    row = _issue_row(user, part, quantity, comment, headers_raw)
+    ok = await gateway.write(gclient.HISTORY_SHEET, row, gclient.HISTORY_HEADER)
+    logger.info("💾 Списание записано в 'История'" if ok else "💾 Списание отложено до восстановления таблицы")
+    return ok
 
-    client = data.get_gs_client()
-    sh = client.open_by_url(SPREADSHEET_URL)
-    try:
-        ws = sh.worksheet("История")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="История", rows=1000, cols=12)
-        ws.append_row(
-            [
-                "Дата",
-                "ID",
-                "Имя",
-                "Тип",
-                "Наименование",
-                "Код",
-                "Количество",
-                "Коментарий",
-            ]
-        )
 
-    headers_raw = ws.row_values(1)
+def _issue_row(user, part: dict, quantity, comment: str, headers_raw) -> list:
     headers = [h.strip() for h in headers_raw]
     norm = [h.lower() for h in headers]
 
@@ -947,9 +1041,7 @@ async def save_issue_to_sheet(bot, user, part: dict, quantity, comment: str):
         "комментарий": comment or "",
         "comment": comment or "",
     }
-    row = [values_by_key.get(hn, "") for hn in norm]
-    ws.append_row(row, value_input_option="USER_ENTERED")
-    logger.info("💾 Списание записано в 'История'")
+    return [values_by_key.get(hn, "") for hn in norm]
 
 
 async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -968,7 +1060,14 @@ async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         qty = st["quantity"]
         comment = st.get("comment", "")
 
-        await save_issue_to_sheet(context.bot, q.from_user, part, qty, comment)
+        try:
+            written = await save_issue_to_sheet(context.bot, q.from_user, part, qty, comment)
+        except gateway.SheetsTimeout:
+            data.issue_state.pop(uid, None)
+            return await q.message.reply_text(
+                "⏳ Google Sheets не ответил вовремя. Списание могло не записаться — "
+                "проверьте «Историю» позже, прежде чем повторять."
+            )
         data.issue_state.pop(uid, None)
 
         await q.message.reply_text(
@@ -976,6 +1075,8 @@ async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🔢 Код: {data.val(part, 'код')}\n"
             f"📦 Наименование: {data.val(part, 'наименование')}\n"
             f"💬 Комментарий: {comment or '—'}"
+            + ("" if written else "\n\n🕓 Таблица временно недоступна — запись в «Историю» "
+               "будет добавлена автоматически.")
         )
         return ConversationHandler.END
 
@@ -1004,6 +1105,7 @@ async def on_more_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
+    _drop_refine(uid)
     st = data.user_state.get(uid, {})
     results = st.get("results")
     if results is None or results.empty:
@@ -1038,8 +1140,7 @@ async def menu_categories_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
             ])
         )
     
-    types = data.df['тип'].dropna().unique()
-    types = sorted([str(t).strip() for t in types if str(t).strip() and str(t).strip().lower() not in ['nan', 'none', '']])[:15]
+    types = data.facet_values('тип')[:15]
     
     if not types:
         return await q.message.edit_text(
@@ -1085,6 +1186,7 @@ async def cat_type_search_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return await q.answer("❌ Ошибка", show_alert=True)
     
     uid = q.from_user.id
+    _drop_refine(uid)
     
     # Выполняем поиск по типу
     if data.df is None or data.df.empty:
@@ -1108,6 +1210,7 @@ async def cat_type_search_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
     st = data.user_state.setdefault(uid, {})
     st["results"] = results
     st["query"] = f"Тип: {item_type}"
+    st["version"] = data._catalog_version
     st["page"] = 0
     
     # Удаляем сообщение с меню
@@ -1268,6 +1371,7 @@ async def back_main_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Возврат в главное меню"""
     q = update.callback_query
     await q.answer()
+    _drop_refine(q.from_user.id)
     
     user = q.from_user
     first = escape((user.first_name or "").strip() or "коллега")
@@ -1325,6 +1429,9 @@ def register_handlers(app):
 
     # Пагинация и отмена
     app.add_handler(CallbackQueryHandler(on_more_click, pattern=r"^more$"))
+    app.add_handler(CallbackQueryHandler(on_refine_click, pattern=r"^refine$"))
+    app.add_handler(CallbackQueryHandler(on_analogs_click, pattern=r"^analogs:"))
+    app.add_handler(CallbackQueryHandler(on_similar_click, pattern=r"^similar:"))
     app.add_handler(CallbackQueryHandler(cancel_action, pattern=r"^cancel_action$"))
 
     # Диалог списания
@@ -0,0 +1,104 @@
+# app/parts.py
+"""
+Строки каталога без pandas на горячем пути.
+
+Карточки, выдача и JSON Mini App раньше брали строку как
+row.to_dict() / hit.iloc[0].to_dict(): на каждую строку — Series и новый
+dict (а send_page делал это дважды). Здесь при установке версии каталога
+колонки один раз раскладываются в списки (значения — те же объекты str,
+что в data.df; pyarrow-строки app/compact.py не раскладываются — поле
+читается прямо из массива), и строка по id — это Part: два слота
+(хранилище, позиция), поле читается индексом по колонке.
+
+Part — Mapping: get / [] / in / keys / items работают как у dict, поэтому
+format_row, _row_public и _issue_row принимают его без изменений. Part
+держит своё хранилище, так что строка, сохранённая в issue_state, читается
+и после перезагрузки каталога (значения версии, в которой её нашли).
+
+Производное от строки (HTML карточки, JSON для Mini App) кешируется в
+хранилище её версии (Part.cached): заполняется при первом показе и
+уходит вместе с версией — сбрасывать при перезагрузке нечего.
+"""
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import pandas as pd
+
+from app.compact import is_arrow_text
+
+
+class PartStore:
+    """Колонки одной версии каталога списками + позиция строки по id."""
+
+    def __init__(self, df_: pd.DataFrame, version: int = 0):
+        self.version = version
+        self.columns = tuple(df_.columns)
+        self.col_pos: Dict[str, int] = {c: i for i, c in enumerate(self.columns)}
+        # pyarrow-колонка: её массив (позиционный [] отдаёт str), а не список объектов
+        self.values: List[Sequence] = [
+            df_[c].array if is_arrow_text(df_[c]) else df_[c].tolist() for c in self.columns
+        ]
+        self.row_ids: List[int] = df_.index.tolist()
+        # после полной загрузки id = позиция; после дельты — с дырами
+        n = len(self.row_ids)
+        contiguous = n == 0 or (self.row_ids[0] == 0 and self.row_ids[-1] == n - 1 and df_.index.is_monotonic_increasing)
+        self._pos: Optional[Dict[int, int]] = None if contiguous else {r: i for i, r in enumerate(self.row_ids)}
+        self._memo: Dict[str, Dict[int, object]] = {}
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
+
+    def position(self, row_id: int) -> Optional[int]:
+        if self._pos is not None:
+            return self._pos.get(row_id)
+        return row_id if 0 <= row_id < len(self.row_ids) else None
+
+    def part(self, row_id: int) -> Optional["Part"]:
+        pos = self.position(row_id)
+        return None if pos is None else Part(self, pos)
+
+
+class Part(Mapping):
+    """Строка каталога: чтение полей из колонок PartStore, без копий."""
+
+    __slots__ = ("_store", "_pos")
+
+    def __init__(self, store: PartStore, pos: int):
+        self._store = store
+        self._pos = pos
+
+    @property
+    def row_id(self) -> int:
+        return self._store.row_ids[self._pos]
+
+    def __getitem__(self, key: str):
+        return self._store.values[self._store.col_pos[key]][self._pos]
+
+    def get(self, key: str, default=None):
+        i = self._store.col_pos.get(key)
+        return default if i is None else self._store.values[i][self._pos]
+
+    def __contains__(self, key) -> bool:
+        return key in self._store.col_pos
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._store.columns)
+
+    def __len__(self) -> int:
+        return len(self._store.columns)
+
+    def cached(self, kind: str, build: Callable[["Part"], object]):
+        """build(self), посчитанное один раз на строку и версию каталога."""
+        memo = self._store._memo.get(kind)
+        if memo is None:
+            memo = self._store._memo.setdefault(kind, {})
+        out = memo.get(self._pos)
+        if out is None:
+            out = memo[self._pos] = build(self)
+        return out
+
+    def to_dict(self) -> dict:
+        return dict(zip(self._store.columns, (col[self._pos] for col in self._store.values)))
+
+    def __repr__(self) -> str:
+        return f"Part({self.row_id}, {self.get('код', '')!r})"
@@ -0,0 +1,284 @@
+# app/prefork.py
+"""
+Многопроцессный режим (WEB_WORKERS > 1): один загрузчик, N воркеров.
+
+- Родитель один раз загружает каталог и строит индексы, делает gc.freeze()
+  и форкает воркеров: DataFrame и индексы делятся copy-on-write, сборщик
+  мусора не трогает замороженные объекты и не "пачкает" их страницы.
+- Все воркеры принимают соединения с общего слушающего сокета, так что
+  /api/* и вебхук распределяются ядром по процессам.
+- Состояние диалогов (user_state, issue_state, ConversationHandler) живёт в
+  памяти процесса, поэтому апдейт Telegram обрабатывает воркер uid % N;
+  чужие апдейты пересылаются ему через unix-сокет.
+- Обновление каталога делает только родитель. Новую версию он пишет
+  снапшотом в catalog_path() и шлёт воркерам SIGUSR2; воркер поднимает её
+  у себя (reload_from_parent) без перезапуска, поэтому диалоги, выдачи и
+  незаконченные списания переживают перезагрузку. Общие страницы
+  copy-on-write остаются только у версии, с которой воркер форкнут, —
+  новая версия у каждого воркера своя.
+- Вебхук ставит родитель один раз до fork (on_ready); воркеры, в том числе
+  перезапущенные после падения, его не трогают.
+"""
+import os
+import gc
+import time
+import signal
+import socket
+import logging
+import tempfile
+import threading
+from typing import Callable, Dict, Optional
+
+import aiohttp
+
+import app.data as data
+from app import coordinator, snapshot
+
+logger = logging.getLogger("bot.prefork")
+
+SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", tempfile.gettempdir())
+FORWARD_HEADER = "X-Baza-Forwarded"
+RETRY_SEC = 60   # пауза после неудачного обновления каталога
+
+IS_WORKER = False   # выставляется в процессе-воркере
+_parent_pid = 0      # pid родителя (имя файла каталога для воркеров)
+_parent_version = 0  # версия каталога родителя, которая стоит в этом процессе
+
+_sessions: Dict[int, aiohttp.ClientSession] = {}
+
+
+def request_refresh() -> bool:
+    """Из воркера: попросить родителя обновить каталог (SIGUSR1)."""
+    if not IS_WORKER:
+        return False
+    os.kill(os.getppid(), signal.SIGUSR1)
+    return True
+
+
+# ---------- Каталог для воркеров ----------
+def catalog_path() -> str:
+    return os.path.join(SOCKET_DIR, f"baza-catalog-{_parent_pid}.snapshot.gz")
+
+
+def _publish_catalog() -> bool:
+    """Родитель: записать текущую версию для воркеров."""
+    global _parent_version
+    version = data._catalog_version
+    if not snapshot.save_snapshot(catalog_path(), data.df, data._current_indexes(), meta={"version": version}):
+        return False
+    _parent_version = version
+    return True
+
+
+def reload_from_parent() -> bool:
+    """Воркер: поставить версию, опубликованную родителем, если она новее своей."""
+    global _parent_version
+    with data._refresh_lock:
+        loaded = snapshot.load_snapshot(catalog_path())
+        if loaded is None:
+            return False
+        snap_df, idx, meta = loaded
+        version = int(meta.get("version", 0))
+        if version <= _parent_version:
+            return False
+        data._install_catalog(snap_df, idx)
+        _parent_version = version
+    logger.info(f"[prefork] воркер pid {os.getpid()}: каталог v{version} родителя, {len(snap_df)} строк")
+    return True
+
+
+def on_catalog_signal() -> None:
+    """Обработчик SIGUSR2 в воркере: загрузка в потоке, event loop не ждёт."""
+    threading.Thread(target=reload_from_parent, name="catalog-reload", daemon=True).start()
+
+
+# ---------- Маршрутизация апдейтов ----------
+def socket_path(worker_id: int) -> str:
+    return os.path.join(SOCKET_DIR, f"baza-worker-{worker_id}.sock")
+
+
+def update_user_id(payload: dict) -> Optional[int]:
+    """from.id любого вида апдейта (message, callback_query, ...)."""
+    for key, val in payload.items():
+        if isinstance(val, dict):
+            user = val.get("from") or (val.get("user") if key != "chat" else None)
+            if isinstance(user, dict) and user.get("id"):
+                return int(user["id"])
+    return None
+
+
+def owner_of(uid: Optional[int], n_workers: int) -> int:
+    return (uid or 0) % max(1, n_workers)
+
+
+async def forward(worker_id: int, path: str, body: bytes, headers: dict) -> int:
+    """Переслать апдейт воркеру-владельцу; возвращает HTTP-статус."""
+    session = _sessions.get(worker_id)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=socket_path(worker_id)),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+        _sessions[worker_id] = session
+    fwd = {k: v for k, v in headers.items() if k.lower() in ("content-type", "x-telegram-bot-api-secret-token")}
+    fwd[FORWARD_HEADER] = "1"
+    async with session.post(f"http://worker{path}", data=body, headers=fwd) as resp:
+        return resp.status
+
+
+async def close_sessions() -> None:
+    for s in list(_sessions.values()):
+        await s.close()
+    _sessions.clear()
+
+
+# ---------- Родитель ----------
+def _join_background(timeout: float = 120.0) -> None:
+    """
+    Дождаться фоновых потоков загрузки (соседи, снапшот, хранилище):
+    fork копирует только текущий поток, а их блокировки могли бы остаться занятыми.
+    """
+    deadline = time.time() + timeout
+    for th in threading.enumerate():
+        if th is threading.current_thread() or not th.daemon:
+            continue
+        th.join(max(0.0, deadline - time.time()))
+
+
+def _listen(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _spawn(worker_id: int, sock: socket.socket, worker_main: Callable[[socket.socket, int], None]) -> int:
+    pid = os.fork()
+    if pid == 0:
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(sig, signal.SIG_DFL)
+        # до установки обработчика в event loop воркера SIGUSR2 не должен его убить;
+        # пропущенную версию воркер подтянет сам при старте
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        code = 0
+        try:
+            worker_main(sock, worker_id)
+        except BaseException:
+            logger.exception(f"[worker {worker_id}] упал")
+            code = 1
+        finally:
+            os._exit(code)
+    logger.info(f"[prefork] воркер {worker_id} запущен (pid {pid})")
+    return pid
+
+
+def _freeze() -> None:
+    gc.collect()
+    gc.freeze()
+    logger.info(f"[prefork] gc.freeze(): заморожено {gc.get_freeze_count()} объектов")
+
+
+def run(n_workers: int, port: int, worker_main: Callable[[socket.socket, int], None],
+        on_ready: Optional[Callable[[], None]] = None) -> None:
+    """
+    Родительский цикл: загрузка → on_ready() → fork → надзор за воркерами и
+    обновление каталога. worker_main(sock, worker_id) крутит event loop
+    воркера до SIGTERM. Когда проверять таблицу, решает data.ensure_fresh_data
+    (адаптивный интервал).
+    """
+    global _parent_pid, _parent_version
+    _parent_pid = os.getpid()
+    if data.load_snapshot():
+        # воркеры стартуют со снапшота, свежая загрузка — сразу после их запуска
+        force_refresh = True
+    else:
+        try:
+            data.initial_load()
+        except Exception as e:
+            logger.error(f"[prefork] ❌ Ошибка при загрузке данных: {e}")
+        force_refresh = False
+
+    _parent_version = data._catalog_version
+    if on_ready is not None:
+        try:
+            on_ready()
+        except Exception as e:
+            logger.error(f"[prefork] on_ready: {e}")
+
+    _join_background()
+    _freeze()
+    sock = _listen(port)
+
+    workers: Dict[int, int] = {k: _spawn(k, sock, worker_main) for k in range(n_workers)}
+    retry_at = 0.0
+    stopping = False
+
+    def _stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    def _refresh_now(*_):
+        nonlocal force_refresh
+        force_refresh = True
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGUSR1, _refresh_now)
+
+    while not stopping:
+        time.sleep(0.5)
+
+        # упавших воркеров поднимаем заново
+        for k, pid in list(workers.items()):
+            done, _status = os.waitpid(pid, os.WNOHANG)
+            if done and not stopping:
+                logger.warning(f"[prefork] воркер {k} (pid {pid}) завершился — перезапуск")
+                workers[k] = _spawn(k, sock, worker_main)
+
+        if time.time() < retry_at and not force_refresh:
+            continue
+        version = data._catalog_version
+        force, force_refresh = force_refresh, False
+        try:
+            data.ensure_fresh_data(force=force)
+        except Exception as e:
+            logger.warning(f"[prefork] обновление каталога не удалось, воркеры остаются на v{version}: {e}")
+            retry_at = time.time() + RETRY_SEC
+            continue
+        if data._catalog_version == _parent_version:
+            continue
+
+        if not _publish_catalog():
+            logger.warning(f"[prefork] не удалось записать каталог v{data._catalog_version} для воркеров")
+            retry_at = time.time() + RETRY_SEC
+            continue
+        # воркеры, которые форкнутся позже (после падения), получат новую версию от родителя
+        _join_background()
+        gc.unfreeze()
+        _freeze()
+        for pid in workers.values():
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+        logger.info(f"[prefork] воркерам отправлен каталог v{data._catalog_version}")
+
+    logger.info("[prefork] остановка воркеров...")
+    for pid in workers.values():
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers.values():
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    sock.close()
+    try:
+        os.remove(catalog_path())
+    except OSError:
+        pass
+    coordinator.release()
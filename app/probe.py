@@ -0,0 +1,141 @@
+# app/probe.py
+"""
+Дешёвая проверка "изменилась ли таблица" перед полной выгрузкой.
+
+- DriveProbe: files.get из Drive API (поля version + modifiedTime) — один
+  маленький запрос вместо выгрузки всего листа SAP;
+- FileProbe: локальная замена для тестов — ревизия = mtime/размер файла
+  (CHANGE_PROBE="file:/tmp/catalog.rev", "правка таблицы" — touch файла).
+
+Интервал опроса адаптивный: пока таблица не меняется — растёт в 1.5 раза
+до CHANGE_PROBE_MAX_SEC, после замеченного изменения — падает вдвое до
+CHANGE_PROBE_MIN_SEC. Ошибка пробы считается изменением (лучше лишняя
+выгрузка, чем устаревший каталог).
+"""
+import os
+import time
+import logging
+from typing import Callable, Optional
+
+from gspread.utils import extract_id_from_url
+
+logger = logging.getLogger("bot.probe")
+
+try:
+    from app.config import (
+        SPREADSHEET_URL,
+        DATA_TTL,
+        CHANGE_PROBE,
+        CHANGE_PROBE_MIN_SEC,
+        CHANGE_PROBE_MAX_SEC,
+    )
+except Exception:
+    SPREADSHEET_URL = os.getenv("SPREADSHEET_URL", "")
+    DATA_TTL = int(os.getenv("DATA_TTL", "600"))
+    CHANGE_PROBE = os.getenv("CHANGE_PROBE", "drive")
+    CHANGE_PROBE_MIN_SEC = float(os.getenv("CHANGE_PROBE_MIN_SEC", "30"))
+    CHANGE_PROBE_MAX_SEC = float(os.getenv("CHANGE_PROBE_MAX_SEC", "1800"))
+
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files/{}"
+
+
+class ChangeProbe:
+    """Ревизия источника; None — узнать не удалось."""
+
+    def revision(self) -> Optional[str]:
+        raise NotImplementedError
+
+
+class DriveProbe(ChangeProbe):
+    def __init__(self, client_factory: Callable[[], object], url: str = ""):
+        self.client_factory = client_factory
+        self.url = url or SPREADSHEET_URL
+
+    def revision(self) -> Optional[str]:
+        client = self.client_factory()
+        r = client.http_client.request(
+            "get",
+            DRIVE_FILES_URL.format(extract_id_from_url(self.url)),
+            params={"fields": "version,modifiedTime", "supportsAllDrives": True},
+        )
+        meta = r.json()
+        return f"{meta.get('version', '')}:{meta.get('modifiedTime', '')}"
+
+
+class FileProbe(ChangeProbe):
+    def __init__(self, path: str):
+        self.path = path
+
+    def revision(self) -> Optional[str]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+class Poller:
+    """Проба + запомненная ревизия + адаптивный интервал."""
+
+    def __init__(self, probe: Optional[ChangeProbe]):
+        self.probe = probe
+        self.seen: Optional[str] = None      # ревизия последней успешной выгрузки
+        self.pending: Optional[str] = None   # ревизия, замеченная перед текущей выгрузкой
+        self.interval = float(DATA_TTL)
+        self.last_change_ts = 0.0
+        self.checks = 0
+        self.skipped = 0
+
+    def check(self) -> bool:
+        """
+        True — нужна полная выгрузка (ревизия изменилась, неизвестна или проба
+        выключена). После удачной выгрузки вызывающий делает commit().
+        """
+        if self.probe is None:
+            return True
+        self.checks += 1
+        try:
+            rev = self.probe.revision()
+        except Exception as e:
+            logger.warning(f"[probe] ошибка проверки ревизии: {e}")
+            rev = None
+        if rev is not None and rev == self.seen:
+            self.skipped += 1
+            self.interval = min(CHANGE_PROBE_MAX_SEC, self.interval * 1.5)
+            return False
+        self.pending = rev
+        if self.seen is not None:
+            self.interval = max(CHANGE_PROBE_MIN_SEC, self.interval / 2)
+            self.last_change_ts = time.time()
+        return True
+
+    def note(self) -> None:
+        """Запомнить ревизию перед принудительной выгрузкой (без влияния на интервал)."""
+        if self.probe is None:
+            return
+        try:
+            self.pending = self.probe.revision()
+        except Exception as e:
+            logger.warning(f"[probe] ошибка проверки ревизии: {e}")
+            self.pending = None
+
+    def commit(self) -> None:
+        if self.pending is not None:
+            self.seen = self.pending
+            self.pending = None
+
+    def stats(self) -> str:
+        return f"интервал {self.interval:.0f}s, проверок {self.checks}, без выгрузки {self.skipped}"
+
+
+def make_probe(client_factory: Callable[[], object]) -> Optional[ChangeProbe]:
+    """CHANGE_PROBE: "drive" (по умолчанию) | "file:<путь>" | "" — выключено."""
+    spec = (CHANGE_PROBE or "").strip()
+    if not spec:
+        return None
+    if spec.startswith("file:"):
+        return FileProbe(spec[5:])
+    if spec == "drive":
+        return DriveProbe(client_factory)
+    logger.error(f"[probe] неизвестный CHANGE_PROBE={spec!r} — проверка выключена")
+    return None
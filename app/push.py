@@ -0,0 +1,158 @@
+# app/push.py
+"""
+Push-уведомление "таблица изменилась" вместо частого опроса.
+
+Apps Script (триггер onEdit, устанавливаемый) шлёт POST на
+/admin/catalog/changed, подписанный HMAC-SHA256 общим секретом
+CATALOG_PUSH_SECRET:
+
+    X-Baza-Timestamp: <unix-время>
+    X-Baza-Signature: sha256=<hex HMAC(secret, "<timestamp>.<тело>")>
+
+    function onEditPush(e) {
+      var body = JSON.stringify({sheet: e.range.getSheet().getName(), range: e.range.getA1Notation()});
+      var ts = String(Math.floor(Date.now() / 1000));
+      var raw = Utilities.computeHmacSha256Signature(ts + "." + body, SECRET);
+      var hex = raw.map(function (b) { return ("0" + (b & 0xff).toString(16)).slice(-2); }).join("");
+      UrlFetchApp.fetch(URL + "/admin/catalog/changed", {method: "post", contentType: "application/json",
+        payload: body, headers: {"X-Baza-Timestamp": ts, "X-Baza-Signature": "sha256=" + hex}});
+    }
+
+Перезагрузка откладывается (debounce): серия правок подряд даёт одну
+выгрузку через RELOAD_DEBOUNCE_SEC тишины, но не позже RELOAD_MAX_DELAY_SEC
+от первой правки. Правки во время перезагрузки — ещё один прогон после неё.
+
+Локальная проверка:
+
+    python -m app.push http://localhost:8080 '{"sheet": "SAP"}'
+"""
+import sys
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Callable, Dict, Optional
+
+from app import gateway
+
+logger = logging.getLogger("bot.push")
+
+try:
+    from app.config import CATALOG_PUSH_SECRET, RELOAD_DEBOUNCE_SEC, RELOAD_MAX_DELAY_SEC
+except Exception:
+    import os
+
+    CATALOG_PUSH_SECRET = os.getenv("CATALOG_PUSH_SECRET", "")
+    RELOAD_DEBOUNCE_SEC = float(os.getenv("RELOAD_DEBOUNCE_SEC", "5"))
+    RELOAD_MAX_DELAY_SEC = float(os.getenv("RELOAD_MAX_DELAY_SEC", "30"))
+
+PUSH_PATH = "/admin/catalog/changed"
+SIGNATURE_HEADER = "X-Baza-Signature"
+TIMESTAMP_HEADER = "X-Baza-Timestamp"
+MAX_SKEW_SEC = 300   # защита от повтора старого запроса
+
+
+# ---------- Подпись ----------
+def sign(secret: str, ts: str, body: bytes) -> str:
+    mac = hmac.new(secret.encode("utf-8"), ts.encode("ascii") + b"." + body, hashlib.sha256)
+    return "sha256=" + mac.hexdigest()
+
+
+def verify(secret: str, ts: str, signature: str, body: bytes, now: Optional[float] = None) -> bool:
+    if not secret or not ts or not signature:
+        return False
+    try:
+        skew = abs((now if now is not None else time.time()) - int(ts))
+    except ValueError:
+        return False
+    if skew > MAX_SKEW_SEC:
+        return False
+    return hmac.compare_digest(sign(secret, ts, body), signature.strip())
+
+
+# ---------- Отложенная перезагрузка ----------
+class ReloadScheduler:
+    """
+    Debounce + склейка: trigger() только отмечает событие, перезагрузку
+    (reload_fn в пуле app/gateway.py) выполняет одна фоновая задача.
+    """
+
+    def __init__(
+        self, reload_fn: Callable[[], None],
+        debounce: float = RELOAD_DEBOUNCE_SEC, max_delay: float = RELOAD_MAX_DELAY_SEC,
+    ):
+        self.reload_fn = reload_fn
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._first = 0.0
+        self._last = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+        self._dirty = False
+        self.triggers = 0
+        self.runs = 0
+
+    def trigger(self) -> str:
+        now = time.monotonic()
+        self.triggers += 1
+        self._last = now
+        if self._task is None or self._task.done():
+            self._first = now
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+            return "scheduled"
+        if self._running:
+            self._dirty = True
+            return "queued"
+        return "coalesced"
+
+    async def _loop(self) -> None:
+        while True:
+            # ждём debounce секунд тишины, но не дольше max_delay от первого события
+            while True:
+                wait = min(self._last + self.debounce, self._first + self.max_delay) - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self._running = True
+            self._dirty = False
+            t0 = time.time()
+            try:
+                await gateway.run("catalog.push", self.reload_fn)
+                self.runs += 1
+                logger.info(f"[push] перезагрузка по событию за {time.time() - t0:.2f}s (событий {self.triggers})")
+            except Exception as e:
+                logger.warning(f"[push] перезагрузка не удалась: {e}")
+            finally:
+                self._running = False
+
+            if not self._dirty:
+                return
+            self._first = self._last = time.monotonic()
+
+    def stats(self) -> Dict[str, object]:
+        return {"triggers": self.triggers, "runs": self.runs, "running": self._running}
+
+
+# ---------- Локальная проверка ----------
+def main(argv) -> None:
+    import urllib.request
+
+    base = argv[0] if argv else "http://localhost:8080"
+    body = (argv[1] if len(argv) > 1 else '{"sheet": "SAP"}').encode("utf-8")
+    ts = str(int(time.time()))
+    req = urllib.request.Request(
+        base.rstrip("/") + PUSH_PATH, data=body, method="POST",
+        headers={
+            "Content-Type": "application/json",
+            TIMESTAMP_HEADER: ts,
+            SIGNATURE_HEADER: sign(CATALOG_PUSH_SECRET, ts, body),
+        },
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        print(resp.status, resp.read().decode("utf-8"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
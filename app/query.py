@@ -0,0 +1,242 @@
+# app/query.py
+"""
+Мини-язык запросов для тех, кто знает, что ищет:
+
+    код:PI88* изготовитель:bosch
+    "фильтр топливный" -тип:масляный
+    "подшипник 6205"~3
+    bosch OR mann
+
+- поле:значение — поиск только в одной колонке (алиасы см. FIELD_ALIASES)
+- "фраза"       — слова подряд (наименование/описание — по позициям,
+                  в остальных полях — все слова в одном поле)
+- "фраза"~N     — слова по порядку, между соседними не больше N других
+- значение*     — префикс термина
+- A OR B (или |) — любое из условий
+- -условие      — исключить строки
+
+Запрос исполняется напрямую по пофилдовым posting-листам data._field_index:
+узкие условия трогают только маленькие множества, проход релевантности не нужен.
+"""
+import re
+import bisect
+import logging
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import app.data as data
+from app import textnorm
+
+logger = logging.getLogger("bot.query")
+
+# Алиасы полей → колонки листа SAP
+FIELD_ALIASES: Dict[str, str] = {
+    "код": "код",
+    "code": "код",
+    "наименование": "наименование",
+    "название": "наименование",
+    "name": "наименование",
+    "тип": "тип",
+    "type": "тип",
+    "oem": "oem",
+    "парт": "парт номер",
+    "pn": "парт номер",
+    "part": "парт номер",
+    "oempn": "oem парт номер",
+    "oem_pn": "oem парт номер",
+    "изготовитель": "изготовитель",
+    "производитель": "изготовитель",
+    "бренд": "изготовитель",
+    "manufacturer": "изготовитель",
+    "brand": "изготовитель",
+    "описание": "описание",
+    "description": "описание",
+}
+
+_TOKEN_RE = re.compile(r'(-?)(?:([^\s:"]+):)?(?:"([^"]*)"(?:~(\d+))?|(\S+))')
+
+
+class Term(NamedTuple):
+    field: Optional[str]   # колонка или None (все поля)
+    text: str
+    phrase: bool = False
+    prefix: bool = False
+    negate: bool = False
+    slop: int = 0          # для фраз: допустимый разрыв между словами
+
+
+# ---------- Парсер ----------
+def parse_query(q: str) -> List[List[Term]]:
+    """
+    Возвращает список AND-групп; каждая группа — список OR-альтернатив.
+    """
+    groups: List[List[Term]] = []
+    join_or = False
+
+    for m in _TOKEN_RE.finditer(str(q or "")):
+        neg, field_raw, quoted, slop, bare = m.groups()
+        if quoted is None and bare in ("OR", "|") and not neg and not field_raw:
+            join_or = bool(groups)
+            continue
+
+        field = None
+        if field_raw:
+            field = FIELD_ALIASES.get(field_raw.lower())
+            if field is None:
+                # не поле (например "W:75") — берём токен целиком как текст
+                bare = f"{field_raw}:{bare if quoted is None else quoted}"
+                quoted = None
+
+        if quoted is not None:
+            term = Term(field, quoted, phrase=True, negate=bool(neg), slop=int(slop or 0))
+        else:
+            text = bare or ""
+            prefix = len(text) > 1 and text.endswith("*")
+            term = Term(field, text.rstrip("*"), prefix=prefix, negate=bool(neg))
+
+        if not term.text.strip():
+            continue
+        if join_or and not term.negate:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        join_or = False
+
+    return groups
+
+
+def is_structured(q: str) -> bool:
+    """
+    Нужен ли разбор запроса: есть поле, кавычки, OR, исключение или префикс.
+    Обычные запросы ("PI 8808 DRG 500") идут по старому пути с релевантностью.
+    Одно исключение без положительных условий ("-5", код "-PI88") — тоже
+    обычный запрос: "всё, кроме X" по такому вводу никто не ищет.
+    """
+    groups = parse_query(q)
+    if not any(not t.negate for grp in groups for t in grp):
+        return False
+    for grp in groups:
+        if len(grp) > 1:
+            return True
+        t = grp[0]
+        if t.field or t.phrase or t.prefix or t.negate:
+            return True
+    return False
+
+
+# ---------- Исполнение ----------
+# within — ограничение кандидатов (уточнение внутри прошлых результатов).
+# Пересечение множеств в CPython идёт по меньшему из них, поэтому
+# уточнение стоит O(min(|within|, |postings|)).
+def _lookup(col: str, key: str, prefix: bool, within: Optional[Set[int]] = None) -> Set[int]:
+    postings = data._field_index.get(col, {})
+    if not prefix:
+        s = postings.get(key, set())
+        return s if within is None else within & s
+
+    terms = data._field_terms.get(col, [])
+    out: Set[int] = set()
+    i = bisect.bisect_left(terms, key)
+    while i < len(terms) and terms[i].startswith(key):
+        s = postings.get(terms[i], set())
+        out |= s if within is None else within & s
+        i += 1
+    return out
+
+
+def _field_rows(col: str, term: Term, within: Optional[Set[int]] = None) -> Set[int]:
+    if term.phrase and col in data._positions:
+        keys = data._field_tokens(col, term.text)
+        return data.match_phrase(col, keys, term.slop, within) if keys else set()
+
+    if col in data.CODE_COLUMNS:
+        key = textnorm.q_norm_code(term.text)
+        if not key:
+            return set()
+        hit = _lookup(col, key, term.prefix, within)
+        if hit or term.prefix:
+            return hit
+
+    keys = data._field_tokens(col, term.text)
+    if col in data.CODE_COLUMNS:
+        keys = keys[1:]  # первый ключ — весь код, уже проверен выше
+    if not keys:
+        return set()
+
+    acc: Optional[Set[int]] = within
+    for n, key in enumerate(keys):
+        s = _lookup(col, key, term.prefix and n == len(keys) - 1)
+        acc = set(s) if acc is None else acc & s
+        if not acc:
+            return set()
+    return acc or set()
+
+
+def _term_rows(term: Term, within: Optional[Set[int]] = None) -> Set[int]:
+    cols = [term.field] if term.field else list(data._field_index)
+    out: Set[int] = set()
+    for col in cols:
+        out |= _field_rows(col, term, within)
+    return out
+
+
+def execute_query(groups: List[List[Term]], within: Optional[Set[int]] = None) -> List[int]:
+    positive: List[Set[int]] = []
+    excluded: Set[int] = set()
+
+    # Сначала самые узкие условия: дальше они ограничивают остальные
+    acc: Optional[Set[int]] = within
+    for grp in groups:
+        alts = [t for t in grp if not t.negate]
+        if not alts:
+            continue
+        s: Set[int] = set()
+        for t in alts:
+            s |= _term_rows(t, acc)
+        positive.append(s)
+        if acc is not None:
+            acc = s
+
+    if positive:
+        positive.sort(key=len)
+        acc = set(positive[0])
+        for s in positive[1:]:
+            if not acc:
+                break
+            acc &= s
+    elif within is not None:
+        acc = set(within)
+    elif data.df is not None:
+        acc = set(data.df.index)
+    else:
+        acc = set()
+
+    for grp in groups:
+        for t in grp:
+            if t.negate and acc:
+                excluded |= _term_rows(t, acc)
+
+    acc -= excluded
+    # Порядок листа: детерминированно и без прохода по тексту строк
+    return sorted(acc)
+
+
+def run_query(q: str) -> List[int]:
+    data.ensure_fresh_data()
+    groups = parse_query(q)
+    if not groups:
+        return []
+    ids = execute_query(groups)
+    logger.info(f"[query] {q!r}: {len(groups)} групп → {len(ids)} строк")
+    return ids
+
+
+def refine_query(ids, q: str) -> Set[int]:
+    """
+    "Искать в результатах": условия q проверяются только среди ids
+    (индексы строк прошлой выдачи той же версии каталога).
+    """
+    groups = parse_query(q)
+    within = set(ids)
+    if not groups or not within:
+        return within
+    return set(execute_query(groups, within))
@@ -0,0 +1,150 @@
+# app/ranking.py
+"""
+Ранжирование выдачи BM25F по предрасчитанной статистике data._bm25.
+
+Скор считается только по posting-листам и статистике индекса — строки
+каталога (DataFrame) не читаются. Бусты за точный/префиксный код и за фразу
+остаются отдельными признаками с весами из конфига.
+"""
+import re
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+import app.data as data
+from app import textnorm
+from app.config import (
+    BM25_K1,
+    BM25_B,
+    CODE_EXACT_BOOST,
+    CODE_PREFIX_BOOST,
+    CODE_TOKEN_PREFIX_BOOST,
+    PHRASE_BOOST,
+)
+
+logger = logging.getLogger("bot.ranking")
+
+# Вес поля в BM25F (колонки без веса не участвуют)
+FIELD_WEIGHTS: Dict[str, float] = {
+    "код": 5.0,
+    "наименование": 3.0,
+    "тип": 2.0,
+    "oem": 2.0,
+    "изготовитель": 2.0,
+    "парт номер": 2.0,
+    "oem парт номер": 2.0,
+    "описание": 1.0,
+}
+
+
+def _query_terms(q: str) -> List[Dict[str, str]]:
+    """
+    Термины запроса: для каждого слова — ключ в каждом поле
+    (коды нормализуются через _norm_code, текст — как в индексе).
+    Плюс весь запрос как один код ("PI 8808 DRG 500" → "pi8808drg500").
+    """
+    words = re.findall(r"\w+", str(q or "").lower().replace("ё", "е"))
+    out: List[Dict[str, str]] = []
+    for w in dict.fromkeys(words):
+        keys = {}
+        for col in FIELD_WEIGHTS:
+            k = textnorm.q_norm_code(w) if col in data.CODE_COLUMNS else w
+            if k:
+                keys[col] = k
+        if keys:
+            out.append(keys)
+
+    full = textnorm.q_norm_code(q)
+    if full and len(words) > 1:
+        out.append({col: full for col in data.CODE_COLUMNS})
+    return out
+
+
+def _idf(keys: Dict[str, str]) -> float:
+    idf = data._bm25.get("idf", {})
+    return max((idf.get(k, 0.0) for k in keys.values()), default=0.0)
+
+
+def bm25f_scores(ids: Iterable[int], q: str) -> Dict[int, float]:
+    stats = data._bm25
+    if not stats:
+        return {i: 0.0 for i in ids}
+
+    tf_all = stats["tf"]
+    len_all = stats["len"]
+    avglen = stats["avglen"]
+    cands = set(ids)
+    scores: Dict[int, float] = dict.fromkeys(cands, 0.0)
+
+    for keys in _query_terms(q):
+        idf = _idf(keys)
+        if idf <= 0:
+            continue
+        # tf~ = Σ_f w_f · tf_f / (1 − b + b · len_f / avglen_f)
+        pseudo: Dict[int, float] = {}
+        for col, key in keys.items():
+            postings = data._field_index.get(col, {}).get(key)
+            if not postings:
+                continue
+            w = FIELD_WEIGHTS[col]
+            col_tf = tf_all.get(col, {}).get(key, {})
+            col_len = len_all.get(col, {})
+            avg = avglen.get(col) or 1.0
+            hit = cands & postings
+            for r in hit:
+                norm = 1.0 - BM25_B + BM25_B * col_len.get(r, 1) / avg
+                pseudo[r] = pseudo.get(r, 0.0) + w * col_tf.get(r, 1) / norm
+        for r, t in pseudo.items():
+            scores[r] += idf * t / (BM25_K1 + t)
+
+    return scores
+
+
+def feature_scores(ids: Iterable[int], q: str) -> Dict[int, float]:
+    """Бусты: точный код, код начинается с запроса / со слова запроса, фраза в наименовании."""
+    codes = data._bm25.get("code", {})
+    qn = textnorm.q_norm_code(q)
+    words = [textnorm.q_norm_code(w) for w in re.findall(r"\w+", str(q or "").lower())]
+    words = [w for w in words if w]
+    ids = list(ids)
+    out: Dict[int, float] = {}
+
+    phrase_rows = set()
+    if PHRASE_BOOST:
+        toks = data._field_tokens("наименование", q)
+        if len(toks) > 1:
+            within = set(ids)
+            for col in data.POSITIONAL_COLUMNS:
+                phrase_rows |= data.match_phrase(col, toks, 0, within)
+
+    for r in ids:
+        s = 0.0
+        code = codes.get(r, "")
+        if code and qn:
+            if code == qn:
+                s += CODE_EXACT_BOOST
+            if code.startswith(qn):
+                s += CODE_PREFIX_BOOST
+            for w in words:
+                if code.startswith(w):
+                    s += CODE_TOKEN_PREFIX_BOOST
+        if r in phrase_rows:
+            s += PHRASE_BOOST
+        out[r] = s
+    return out
+
+
+def rank(ids: Iterable[int], q: str) -> List[int]:
+    """
+    Сортировка кандидатов: BM25F + бусты, при равенстве — более короткий код.
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    bm = bm25f_scores(ids, q)
+    feats = feature_scores(ids, q)
+    codes = data._bm25.get("code", {})
+
+    def key(r: int) -> Tuple[float, int]:
+        return (-(bm.get(r, 0.0) + feats.get(r, 0.0)), len(codes.get(r, "")))
+
+    return sorted(ids, key=key)
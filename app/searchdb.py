@@ -0,0 +1,211 @@
+# app/searchdb.py
+"""
+Поиск подстрок по каталогу в SQLite (FTS5, токенайзер trigram).
+
+Фолбэки поиска ("все слова внутри поля", "склеенная фраза") раньше
+проходили по всему DataFrame: на каждый запрос — str.contains по
+нескольким колонкам и временные Series размером с каталог. Здесь та же
+семантика отдаётся индексом на диске:
+
+- fts — виртуальная таблица FTS5 trigram, rowid = индекс строки data.df;
+  на каждую колонку две: текст в нижнем регистре (t<i>) и "склеенный"
+  текст без пробелов/знаков (s<i>). Подстрока от 3 символов ищется по
+  триграммам через MATCH, короче — LIKE по той же таблице.
+
+Точный поиск по коду сюда не входит — его обслуживает словарь
+data._code_index.
+
+Один файл на версию каталога, запись во временный файл + rename: уже
+открытые соединения дочитывают старую версию. В meta хранится отпечаток
+содержимого каталога (хеши строк), и при старте с тем же каталогом
+(снапшот, повторная загрузка без изменений) готовый файл используется
+без пересборки.
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import weakref
+from typing import Dict, Iterable, List, Optional, Set
+
+import pandas as pd
+
+logger = logging.getLogger("bot.searchdb")
+
+# Колонки фолбэков поиска (handlers.search_text, webapp._search_ids)
+COLUMNS = ["тип", "наименование", "код", "oem", "изготовитель", "парт номер", "oem парт номер"]
+TRIGRAM = 3
+_SQUASH_RE = re.compile(r"[\W_]+")
+
+
+def digest(row_hashes: Dict[str, tuple]) -> str:
+    """Отпечаток версии каталога по хешам строк (data.row_hashes)."""
+    h = hashlib.sha1()
+    for key in sorted(row_hashes):
+        label, content = row_hashes[key]
+        h.update(f"{key}\0{label}\0{content}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _lower(v) -> str:
+    return str(v if v is not None else "").strip().lower()
+
+
+# ---------- Запись ----------
+def write_db(path: str, df_: pd.DataFrame, fingerprint: str) -> str:
+    cols = [c for c in COLUMNS if c in df_.columns]
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    try:
+        con.execute("PRAGMA journal_mode=OFF")
+        con.execute("PRAGMA synchronous=OFF")
+        con.execute("CREATE TABLE meta(k TEXT PRIMARY KEY, v TEXT)")
+        con.executemany("INSERT INTO meta VALUES(?, ?)", [
+            ("digest", fingerprint),
+            ("columns", "\t".join(cols)),
+            ("rows", str(len(df_))),
+        ])
+        fts_cols = [f"t{i}" for i in range(len(cols))] + [f"s{i}" for i in range(len(cols))]
+        con.execute(f"CREATE VIRTUAL TABLE fts USING fts5({', '.join(fts_cols)}, tokenize='trigram')")
+
+        rids = df_.index.tolist()
+        lowered = [[_lower(v) for v in df_[c].tolist()] for c in cols]
+        squashed = [[_SQUASH_RE.sub("", v) for v in col] for col in lowered]
+        con.executemany(
+            f"INSERT INTO fts(rowid, {', '.join(fts_cols)}) VALUES(?{', ?' * len(fts_cols)})",
+            ((rid, *(c[k] for c in lowered), *(c[k] for c in squashed)) for k, rid in enumerate(rids)),
+        )
+        con.execute("INSERT INTO fts(fts) VALUES('optimize')")
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, path)
+    return path
+
+
+def read_digest(path: str) -> Optional[str]:
+    """Отпечаток каталога в готовом файле (None — файла нет или он битый)."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            row = con.execute("SELECT v FROM meta WHERE k = 'digest'").fetchone()
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+# ---------- Чтение ----------
+def _quote(s: str) -> str:
+    return '"' + s.replace('"', '""') + '"'
+
+
+def _like(s: str) -> str:
+    return "%" + s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class SearchDB:
+    """Открытый файл одной версии; соединение — своё у каждого потока (только чтение)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        con = self._conn()
+        meta = dict(con.execute("SELECT k, v FROM meta").fetchall())
+        self.digest = meta.get("digest", "")
+        self.columns = meta.get("columns", "").split("\t") if meta.get("columns") else []
+        self.rows = int(meta.get("rows", "0"))
+        self.queries = 0
+        _open.add(self)
+
+    def _conn(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.con = con
+            with self._lock:
+                self._conns.append(con)
+        return con
+
+    def _ids(self, sql: str, args: Iterable) -> Set[int]:
+        self.queries += 1
+        return {r[0] for r in self._conn().execute(sql, list(args))}
+
+    def _col(self, col: str) -> Optional[int]:
+        try:
+            return self.columns.index(col)
+        except ValueError:
+            return None
+
+    def contains_all(self, tokens: List[str], cols: List[str]) -> Set[int]:
+        """Строки, где в одном из полей cols встречаются все tokens (подстроки)."""
+        tokens = [t for t in tokens if t]
+        idx = [i for i in (self._col(c) for c in cols) if i is not None]
+        if not tokens or not idx:
+            return set()
+        if all(len(t) >= TRIGRAM for t in tokens):
+            expr = " OR ".join(
+                "(" + " AND ".join(f"t{i} : {_quote(t)}" for t in tokens) + ")" for i in idx
+            )
+            return self._ids("SELECT rowid FROM fts WHERE fts MATCH ?", [expr])
+        where = " OR ".join("(" + " AND ".join(f"t{i} LIKE ? ESCAPE '\\'" for _ in tokens) + ")" for i in idx)
+        return self._ids(f"SELECT rowid FROM fts WHERE {where}", [_like(t) for _ in idx for t in tokens])
+
+    def contains_squashed(self, q_squash: str, cols: List[str]) -> Set[int]:
+        """Строки, где "склеенное" значение одного из полей содержит q_squash."""
+        idx = [i for i in (self._col(c) for c in cols) if i is not None]
+        if not q_squash or not idx:
+            return set()
+        if len(q_squash) >= TRIGRAM:
+            expr = "{" + " ".join(f"s{i}" for i in idx) + "} : " + _quote(q_squash)
+            return self._ids("SELECT rowid FROM fts WHERE fts MATCH ?", [expr])
+        where = " OR ".join(f"s{i} LIKE ? ESCAPE '\\'" for i in idx)
+        return self._ids(f"SELECT rowid FROM fts WHERE {where}", [_like(q_squash)] * len(idx))
+
+    def close(self) -> None:
+        """Закрыть соединения всех потоков — только если объект больше никто не читает."""
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for con in conns:
+            try:
+                con.close()
+            except sqlite3.Error:
+                pass
+
+
+_open: "weakref.WeakSet[SearchDB]" = weakref.WeakSet()
+
+
+def _reset_after_fork() -> None:
+    # соединения SQLite нельзя использовать после fork — дочерний процесс откроет свои
+    for db in list(_open):
+        db._local = threading.local()
+        db._conns = []
+        db._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def open_or_build(path: str, df_: pd.DataFrame, fingerprint: str) -> SearchDB:
+    """Готовый файл с тем же отпечатком — как есть, иначе пересборка."""
+    t0 = time.time()
+    if read_digest(path) == fingerprint:
+        db = SearchDB(path)
+        logger.info(f"[searchdb] {path}: каталог не менялся, файл переиспользован")
+        return db
+    write_db(path, df_, fingerprint)
+    db = SearchDB(path)
+    logger.info(f"[searchdb] {path}: {len(df_)} строк за {time.time() - t0:.2f}s")
+    return db
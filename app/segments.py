@@ -0,0 +1,299 @@
+# app/segments.py
+"""
+Сегментированный инвертированный индекс (в духе LSM).
+
+Индекс одной колонки — несколько неизменяемых сегментов и маленький
+delta-сегмент:
+
+- сегмент хранит posting-листы термин → строки, множество своих строк
+  и tombstones — строки, чьё содержимое в этом сегменте больше не действует;
+- изменение строки: в старых сегментах она помечается tombstone'ом,
+  новое содержимое пишется в delta (delta переписывается целиком, но он мал);
+- когда delta разрастается, он "запечатывается" в обычный сегмент, а когда
+  сегментов или tombstones становится много, фоновое слияние собирает
+  запечатанные сегменты в один.
+
+Каждое изменение возвращает новый объект индекса, разделяющий неизменённые
+сегменты со старым: читатели в других потоках видят либо старую, либо новую
+версию без блокировок. Снаружи индекс выглядит как dict термин → строки
+(get / [] / in / items), поэтому query и ranking его не различают.
+"""
+import time
+import logging
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+logger = logging.getLogger("bot.segments")
+
+# Сколько строк держать в delta до запечатывания
+DELTA_MAX_ROWS = 2000
+# Слияние, если запечатанных сегментов больше / tombstones больше доли строк
+MAX_SEALED = 4
+MAX_TOMB_FRACTION = 0.2
+
+_EMPTY: frozenset = frozenset()
+
+
+class Segment:
+    __slots__ = ("postings", "rows", "tomb", "fwd")
+
+    def __init__(self, postings: dict, rows: Set[int], tomb: frozenset = _EMPTY, fwd: Optional[dict] = None):
+        self.postings = postings   # термин → строки (set) или {строка: позиции}
+        self.rows = rows           # строки, чьё содержимое записано в сегменте
+        self.tomb = tomb           # строки, удалённые/изменённые после записи
+        self.fwd = fwd             # только у delta: строка → её термины
+
+    def __getstate__(self):
+        return self.postings, self.rows, self.tomb, self.fwd
+
+    def __setstate__(self, state):
+        self.postings, self.rows, self.tomb, self.fwd = state
+
+
+class SegmentedIndex(Mapping):
+    """Термин → живые строки. Значения — множества индексов строк."""
+
+    __slots__ = ("sealed", "delta")
+
+    def __init__(self, sealed: Tuple[Segment, ...], delta: Segment):
+        self.sealed = sealed
+        self.delta = delta
+
+    def __getstate__(self):
+        return self.sealed, self.delta
+
+    def __setstate__(self, state):
+        self.sealed, self.delta = state
+
+    # ----- операции над значениями (PositionsIndex переопределяет) -----
+    @staticmethod
+    def _minus(p, tomb):
+        return p - tomb
+
+    @staticmethod
+    def _union(a, b):
+        return a | b
+
+    @staticmethod
+    def _drop(p, row: int):
+        return p - {row}
+
+    @staticmethod
+    def _add(p, row: int, value):
+        return (p or _EMPTY) | {row}
+
+    @staticmethod
+    def _rows_of(p) -> Iterable[int]:
+        return p
+
+    # ----- построение -----
+    @classmethod
+    def from_dict(cls, postings: dict, rows: Iterable[int]) -> "SegmentedIndex":
+        """Один запечатанный сегмент из готовых posting-листов (полная пересборка)."""
+        return cls((Segment(postings, set(rows)),), Segment({}, set(), _EMPTY, {}))
+
+    @classmethod
+    def wrap(cls, postings, rows: Iterable[int]) -> "SegmentedIndex":
+        """dict из старого снапшота → индекс; готовый индекс — как есть."""
+        if isinstance(postings, cls):
+            return postings
+        return cls.from_dict(postings, rows)
+
+    # ----- чтение -----
+    def _segments(self) -> Tuple[Segment, ...]:
+        return self.sealed + (self.delta,)
+
+    def get(self, term, default=None):
+        res = None
+        for seg in self._segments():
+            p = seg.postings.get(term)
+            if not p:
+                continue
+            if seg.tomb:
+                p = self._minus(p, seg.tomb)
+                if not p:
+                    continue
+            res = p if res is None else self._union(res, p)
+        return res if res else default
+
+    def has(self, term) -> bool:
+        """Есть ли у термина живые строки — без сборки объединения."""
+        for seg in self._segments():
+            p = seg.postings.get(term)
+            if p and not (seg.tomb and all(r in seg.tomb for r in self._rows_of(p))):
+                return True
+        return False
+
+    def __getitem__(self, term):
+        p = self.get(term)
+        if p is None:
+            raise KeyError(term)
+        return p
+
+    def __contains__(self, term) -> bool:
+        return self.has(term)
+
+    def __iter__(self) -> Iterator[str]:
+        seen: Set[str] = set()
+        for seg in self._segments():
+            for t in seg.postings:
+                if t not in seen:
+                    seen.add(t)
+                    if self.has(t):
+                        yield t
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    # ----- изменения -----
+    def apply(self, deleted: Iterable[int], content: Dict[int, Dict[str, object]]) -> "SegmentedIndex":
+        """
+        deleted — строки, прежнее содержимое которых больше не действует;
+        content — новое содержимое строк: строка → {термин: значение}
+        (значение — позиции для PositionsIndex, для множеств не важно).
+        Стоимость — O(изменённых строк × сегментов + размер delta).
+        """
+        gone = set(deleted) | content.keys()
+        if not gone:
+            return self
+
+        sealed = []
+        for seg in self.sealed:
+            hit = gone & seg.rows
+            sealed.append(Segment(seg.postings, seg.rows, seg.tomb | hit) if hit - seg.tomb else seg)
+
+        d = self.delta
+        postings = dict(d.postings)
+        fwd = dict(d.fwd or {})
+        rows = set(d.rows)
+        for r in gone & rows:
+            for t in fwd.pop(r, ()):
+                p = self._drop(postings[t], r)
+                if p:
+                    postings[t] = p
+                else:
+                    del postings[t]
+            rows.discard(r)
+        for r, terms in content.items():
+            if not terms:
+                continue
+            fwd[r] = list(terms)
+            rows.add(r)
+            for t, v in terms.items():
+                postings[t] = self._add(postings.get(t), r, v)
+
+        out = type(self)(tuple(sealed), Segment(postings, rows, _EMPTY, fwd))
+        if len(rows) >= DELTA_MAX_ROWS:
+            out = out.seal()
+        return out
+
+    def seal(self) -> "SegmentedIndex":
+        """delta → запечатанный сегмент, новый пустой delta."""
+        d = self.delta
+        if not d.rows:
+            return self
+        return type(self)(self.sealed + (Segment(d.postings, d.rows),), Segment({}, set(), _EMPTY, {}))
+
+    # ----- слияние -----
+    def needs_merge(self) -> bool:
+        if len(self.sealed) > MAX_SEALED:
+            return True
+        rows = sum(len(s.rows) for s in self.sealed)
+        tomb = sum(len(s.tomb) for s in self.sealed)
+        return bool(tomb) and tomb > MAX_TOMB_FRACTION * max(1, rows)
+
+    def merge_sealed(self) -> Segment:
+        """
+        Все запечатанные сегменты → один, tombstones применены физически.
+        Тяжёлая часть слияния; вызывается вне блокировок (в фоне).
+        """
+        postings: dict = {}
+        rows: Set[int] = set()
+        for seg in self.sealed:
+            rows |= seg.rows - seg.tomb
+            for t, p in seg.postings.items():
+                if seg.tomb:
+                    p = self._minus(p, seg.tomb)
+                    if not p:
+                        continue
+                acc = postings.get(t)
+                postings[t] = p if acc is None else self._union(acc, p)
+        return Segment(postings, rows)
+
+    def with_merged(self, base: Tuple[Segment, ...], merged: Segment) -> Optional["SegmentedIndex"]:
+        """
+        Подставить результат слияния base в текущий индекс. Пока шло слияние,
+        в сегменты base могли добавиться tombstones — они переносятся на merged.
+        None — base уже не префикс текущих сегментов (индекс пересобран).
+        """
+        n = len(base)
+        cur = self.sealed[:n]
+        if len(cur) < n or any(a.postings is not b.postings for a, b in zip(cur, base)):
+            return None
+        extra: Set[int] = set()
+        for a, b in zip(cur, base):
+            extra |= a.tomb - b.tomb
+        m = Segment(merged.postings, merged.rows, frozenset(extra & merged.rows))
+        return type(self)((m,) + self.sealed[n:], self.delta)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sealed": len(self.sealed),
+            "rows": sum(len(s.rows) for s in self.sealed),
+            "tomb": sum(len(s.tomb) for s in self.sealed),
+            "delta_rows": len(self.delta.rows),
+        }
+
+
+class PostingsIndex(SegmentedIndex):
+    """Пофилдовые posting-листы: термин → множество строк."""
+
+    __slots__ = ()
+
+
+class PositionsIndex(SegmentedIndex):
+    """Позиции слов: термин → {строка: [позиции]}."""
+
+    __slots__ = ()
+
+    @staticmethod
+    def _minus(p, tomb):
+        return {r: v for r, v in p.items() if r not in tomb}
+
+    @staticmethod
+    def _union(a, b):
+        return {**a, **b}
+
+    @staticmethod
+    def _drop(p, row: int):
+        return {r: v for r, v in p.items() if r != row}
+
+    @staticmethod
+    def _add(p, row: int, value):
+        return {**(p or {}), row: value}
+
+    @staticmethod
+    def _rows_of(p) -> Iterable[int]:
+        return p.keys()
+
+
+def merge_all(indexes: Dict[str, SegmentedIndex], current) -> int:
+    """
+    Фоновое слияние: для каждой колонки, которой оно нужно, собирает
+    запечатанные сегменты и подставляет результат через current(col, fn),
+    где fn(индекс) → новый индекс или None. Возвращает число слитых колонок.
+    """
+    done = 0
+    for col, ix in indexes.items():
+        if not isinstance(ix, SegmentedIndex) or not ix.needs_merge():
+            continue
+        t0 = time.time()
+        base = ix.sealed
+        merged = ix.merge_sealed()
+        if current(col, lambda cur: cur.with_merged(base, merged)):
+            done += 1
+            logger.info(
+                f"[segments] {col}: слито {len(base)} сегм., {len(merged.rows)} строк "
+                f"за {(time.time() - t0) * 1000:.0f} ms"
+            )
+    return done
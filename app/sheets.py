@@ -0,0 +1,224 @@
+# app/sheets.py
+"""
+Выгрузка из Google Sheets одним запросом values.batchGet.
+
+Раньше перезагрузка делала open_by_url + worksheet + get_all_values для SAP,
+то же самое для "Пользователи", а списание — ещё раз для заголовка "История".
+Здесь один batchGet забирает:
+- заголовок SAP и только нужные колонки (SAP_COLUMNS) — диапазонами по буквам;
+- лист пользователей целиком (он маленький);
+- заголовок "История".
+
+Раскладка колонок SAP (какая буква у какой колонки) кешируется; если
+заголовок в таблице поменялся — раскладка пересчитывается и колонки
+догружаются вторым запросом.
+"""
+import json
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from gspread.exceptions import APIError
+from gspread.utils import extract_id_from_url
+
+logger = logging.getLogger("bot.sheets")
+
+try:
+    from app.config import (
+        SPREADSHEET_URL,
+        SAP_SHEET_NAME,
+        USERS_SHEET_NAME,
+        HISTORY_SHEET,
+        SAP_COLUMNS,
+    )
+except Exception:
+    import os
+
+    SPREADSHEET_URL = os.getenv("SPREADSHEET_URL", "")
+    SAP_SHEET_NAME = os.getenv("SAP_SHEET_NAME", "SAP")
+    USERS_SHEET_NAME = os.getenv("USERS_SHEET_NAME", "Пользователи")
+    HISTORY_SHEET = os.getenv("HISTORY_SHEET", "История")
+    SAP_COLUMNS = [c.strip().lower() for c in os.getenv("SAP_COLUMNS", "*").split(",") if c.strip()]
+
+# Сколько секунд лист пользователей из общей выгрузки считается свежим
+USERS_FRESH_SEC = 60
+
+_titles: Optional[List[str]] = None       # листы таблицы (чтобы не просить несуществующие)
+_layout: Dict[str, object] = {}           # {"header": [...], "picked": [индексы колонок]}
+_users: Tuple[float, Optional[List[List[str]]]] = (0.0, None)
+_history_header: Optional[List[str]] = None
+last_stats: Dict[str, object] = {}
+
+
+# ---------- A1 ----------
+def col_letter(i: int) -> str:
+    """0 → A, 25 → Z, 26 → AA."""
+    s = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+def _q(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+
+def _spans(picked: List[int]) -> List[Tuple[int, int]]:
+    """[0,1,2,5,7,8] → [(0,2),(5,5),(7,8)] — соседние колонки одним диапазоном."""
+    out: List[Tuple[int, int]] = []
+    for i in sorted(picked):
+        if out and out[-1][1] == i - 1:
+            out[-1] = (out[-1][0], i)
+        else:
+            out.append((i, i))
+    return out
+
+
+def _norm_header(values: List[str]) -> List[str]:
+    return [str(c).strip().lower() for c in values]
+
+
+def pick_columns(header: List[str]) -> List[int]:
+    """Индексы колонок заголовка, которые нужно выгружать (SAP_COLUMNS; "*" — все)."""
+    if not SAP_COLUMNS or "*" in SAP_COLUMNS:
+        return list(range(len(header)))
+    want = set(SAP_COLUMNS)
+    return [i for i, h in enumerate(header) if h in want]
+
+
+# ---------- Запрос ----------
+def _batch_get(client, ranges: List[str]) -> List[List[List[str]]]:
+    """values.batchGet по колонкам (majorDimension=COLUMNS); ответ — списки колонок на диапазон."""
+    sid = extract_id_from_url(SPREADSHEET_URL)
+    resp = client.http_client.values_batch_get(sid, ranges, params={"majorDimension": "COLUMNS"})
+    out = [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+    last_stats["requests"] = last_stats.get("requests", 0) + 1
+    last_stats["bytes"] = last_stats.get("bytes", 0) + len(json.dumps(resp, ensure_ascii=False).encode("utf-8"))
+    return out
+
+
+def _sheet_titles(client, force: bool = False) -> List[str]:
+    global _titles
+    if _titles is None or force:
+        sid = extract_id_from_url(SPREADSHEET_URL)
+        meta = client.http_client.fetch_sheet_metadata(sid, params={"fields": "sheets.properties.title"})
+        _titles = [s["properties"]["title"] for s in meta.get("sheets", [])]
+        last_stats["requests"] = last_stats.get("requests", 0) + 1
+    return _titles
+
+
+def _rows(columns: List[List[str]], width: int = 0) -> List[List[str]]:
+    """Колонки → строки, короткие колонки добиваются пустыми строками."""
+    n = max((len(c) for c in columns), default=0)
+    width = max(width, len(columns))
+    cols = list(columns) + [[] for _ in range(width - len(columns))]
+    return [[c[r] if r < len(c) else "" for c in cols] for r in range(n)]
+
+
+def _sap_ranges(picked: List[int]) -> List[str]:
+    sap = _q(SAP_SHEET_NAME)
+    return [f"{sap}!{col_letter(a)}2:{col_letter(b)}" for a, b in _spans(picked)]
+
+
+def fetch_all(client) -> List[List[str]]:
+    """
+    Выгрузка SAP (заголовок + строки, только выбранные колонки) и попутно
+    пользователей и заголовка "История" — обычно одним запросом.
+    Возвращает значения SAP в виде get_all_values().
+    """
+    global _layout, _users, _history_header, last_stats
+    last_stats = {"requests": 0, "bytes": 0}
+    t0 = time.time()
+
+    titles = _sheet_titles(client)
+    if SAP_SHEET_NAME not in titles:
+        titles = _sheet_titles(client, force=True)
+
+    extra: List[str] = []
+    if USERS_SHEET_NAME in titles:
+        extra.append(_q(USERS_SHEET_NAME))
+    if HISTORY_SHEET in titles:
+        extra.append(f"{_q(HISTORY_SHEET)}!1:1")
+
+    picked = list(_layout.get("picked") or [])
+    ranges = [f"{_q(SAP_SHEET_NAME)}!1:1"] + extra + (_sap_ranges(picked) if picked else [])
+    try:
+        got = _batch_get(client, ranges)
+    except APIError:
+        # лист переименовали/удалили между запросами — перечитываем список листов
+        _sheet_titles(client, force=True)
+        raise
+
+    header = _norm_header([c[0] if c else "" for c in got[0]])
+    k = 1
+    if USERS_SHEET_NAME in titles:
+        _users = (time.time(), _rows(got[k]))
+        k += 1
+    else:
+        _users = (time.time(), None)
+    if HISTORY_SHEET in titles:
+        _history_header = [str(c[0]).strip() if c else "" for c in got[k]]
+        k += 1
+    else:
+        _history_header = None
+    col_chunks = got[k:]
+
+    if header != _layout.get("header"):
+        # первая выгрузка или поменялся заголовок — новая раскладка и догрузка колонок
+        picked = pick_columns(header)
+        _layout = {"header": header, "picked": picked}
+        col_chunks = _batch_get(client, _sap_ranges(picked)) if picked else []
+
+    columns: List[List[str]] = []
+    for (a, b), chunk in zip(_spans(picked), col_chunks):
+        chunk = list(chunk) + [[] for _ in range(b - a + 1 - len(chunk))]
+        columns.extend(chunk)
+
+    last_stats["sap_bytes"] = len(json.dumps(col_chunks, ensure_ascii=False).encode("utf-8"))
+    names = [header[i] for i in picked]
+    rows = _rows(columns, len(names))
+    last_stats.update({
+        "seconds": round(time.time() - t0, 3),
+        "rows": len(rows),
+        "columns": len(picked),
+        "columns_total": len(header),
+    })
+    _log_saving()
+    return [names] + rows
+
+
+def _log_saving() -> None:
+    s = last_stats
+    total, cols = s.get("columns_total") or 0, s.get("columns") or 0
+    if total and cols < total:
+        # байты пропущенных колонок не видны — оценка пропорционально числу колонок
+        s["bytes_saved_est"] = int(s["sap_bytes"] * (total - cols) / max(1, cols))
+    logger.info(
+        f"[sheets] batchGet: {s.get('rows', 0)} строк, колонок {cols}/{total}, "
+        f"{s['bytes'] / 1024:.0f} KB, запросов {s['requests']}, {s.get('seconds', 0):.2f}s"
+        + (f", сэкономлено ≈{s['bytes_saved_est'] / 1024:.0f} KB" if s.get("bytes_saved_est") else "")
+    )
+
+
+# ---------- Попутные данные ----------
+def users_values(client) -> Optional[List[List[str]]]:
+    """
+    Лист пользователей как get_all_values(): из общей выгрузки, если она
+    свежая, иначе отдельным batchGet. None — листа нет.
+    """
+    global _users
+    ts, vals = _users
+    if time.time() - ts <= USERS_FRESH_SEC:
+        return vals
+    if USERS_SHEET_NAME not in _sheet_titles(client):
+        return None
+    got = _batch_get(client, [_q(USERS_SHEET_NAME)])
+    _users = (time.time(), _rows(got[0]))
+    return _users[1]
+
+
+def history_header() -> Optional[List[str]]:
+    """Заголовок "История" из последней выгрузки (None — ещё не читали / листа нет)."""
+    return list(_history_header) if _history_header else None
@@ -0,0 +1,177 @@
+# app/similar.py
+"""
+"Похожие детали": TF-IDF по наименованию, типу и изготовителю.
+
+При загрузке каталога строится разреженная матрица (CSR на массивах NumPy),
+а таблица top-k соседей считается в фоновом потоке и хранится вместе с
+версией каталога. Карточка бота и /api/item только читают готовую таблицу.
+"""
+import re
+import math
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("bot.similar")
+
+# колонка → (префикс термина, вес поля)
+SIMILAR_FIELDS: Dict[str, Tuple[str, float]] = {
+    "наименование": ("n", 1.0),
+    "тип": ("t", 0.7),
+    "изготовитель": ("m", 0.5),
+}
+TOP_K = 5
+
+# Сколько float32 держать в одном блоке плотных скоров (строки блока × весь каталог)
+_BLOCK_CELLS = 4_000_000
+
+_lock = threading.Lock()
+_latest_version = 0
+_table: Dict[str, object] = {"version": 0, "labels": None, "ids": None, "scores": None, "pos": {}}
+
+
+# ---------- TF-IDF ----------
+def build_tfidf(df_: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    CSR-матрица (indptr, indices, data) L2-нормированных TF-IDF векторов строк.
+    Термины — слова полей с префиксом поля ("n:фильтр", "m:bosch").
+    """
+    n = len(df_)
+    vocab: Dict[str, int] = {}
+    rows_terms: List[Dict[int, float]] = [dict() for _ in range(n)]
+
+    for col, (prefix, weight) in SIMILAR_FIELDS.items():
+        if col not in df_.columns:
+            continue
+        for pos, v in enumerate(df_[col].tolist()):
+            for w in re.findall(r"\w+", str(v or "").lower().replace("ё", "е")):
+                t = vocab.setdefault(f"{prefix}:{w}", len(vocab))
+                rows_terms[pos][t] = rows_terms[pos].get(t, 0.0) + weight
+
+    df_counts = np.zeros(len(vocab), dtype=np.float32)
+    for terms in rows_terms:
+        for t in terms:
+            df_counts[t] += 1
+    idf = np.log((1 + n) / (1 + df_counts)) + 1.0
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices: List[int] = []
+    values: List[float] = []
+    for pos, terms in enumerate(rows_terms):
+        vec = [(t, tf * float(idf[t])) for t, tf in terms.items()]
+        norm = math.sqrt(sum(w * w for _, w in vec)) or 1.0
+        for t, w in vec:
+            indices.append(t)
+            values.append(w / norm)
+        indptr[pos + 1] = len(indices)
+
+    return indptr, np.asarray(indices, dtype=np.int32), np.asarray(values, dtype=np.float32)
+
+
+def _transpose(indptr: np.ndarray, indices: np.ndarray, values: np.ndarray, n_terms: int):
+    """CSR → CSC: для каждого термина строки и веса."""
+    order = np.argsort(indices, kind="stable")
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))[order]
+    tptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_terms), out=tptr[1:])
+    return tptr, rows, values[order]
+
+
+def top_k_neighbors(
+    indptr: np.ndarray, indices: np.ndarray, values: np.ndarray, k: int = TOP_K,
+    version: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Точный top-k по косинусу. Скоры считаются блоками строк: блок × каталог,
+    вклад каждого термина — одна векторная операция над его posting-листом.
+    """
+    n = len(indptr) - 1
+    n_terms = int(indices.max()) + 1 if len(indices) else 0
+    out_ids = np.full((n, k), -1, dtype=np.int32)
+    out_sc = np.zeros((n, k), dtype=np.float32)
+    if n < 2 or not n_terms:
+        return out_ids, out_sc
+
+    tptr, trows, tvals = _transpose(indptr, indices, values, n_terms)
+    block = max(1, min(n, _BLOCK_CELLS // n))
+    kk = min(k, n - 1)
+
+    for start in range(0, n, block):
+        if version is not None and version != _latest_version:
+            raise RuntimeError("catalog version changed")
+        stop = min(n, start + block)
+        scores = np.zeros((stop - start, n), dtype=np.float32)
+        for r in range(start, stop):
+            acc = scores[r - start]
+            for p in range(indptr[r], indptr[r + 1]):
+                t = indices[p]
+                a, b = tptr[t], tptr[t + 1]
+                acc[trows[a:b]] += values[p] * tvals[a:b]
+            acc[r] = -1.0
+
+        part = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        part_sc = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-part_sc, axis=1)
+        out_ids[start:stop, :kk] = np.take_along_axis(part, order, axis=1)
+        out_sc[start:stop, :kk] = np.take_along_axis(part_sc, order, axis=1)
+
+    out_ids[out_sc <= 0] = -1
+    return out_ids, out_sc
+
+
+# ---------- Фоновое построение ----------
+def _build(df_: pd.DataFrame, version: int) -> None:
+    t0 = time.time()
+    try:
+        indptr, indices, values = build_tfidf(df_)
+        ids, scores = top_k_neighbors(indptr, indices, values, TOP_K, version=version)
+    except RuntimeError:
+        logger.info(f"[similar] v{version}: устарела, пропускаем")
+        return
+    except Exception as e:
+        logger.warning(f"[similar] v{version}: ошибка построения: {e}")
+        return
+
+    labels = df_.index.tolist()
+    with _lock:
+        if version != _latest_version:
+            return
+        _table.update({
+            "version": version,
+            "labels": labels,
+            "ids": ids,
+            "scores": scores,
+            "pos": {lab: p for p, lab in enumerate(labels)},
+        })
+    logger.info(f"[similar] v{version}: соседи для {len(df_)} строк за {time.time() - t0:.1f}s")
+
+
+def start_build(df_: pd.DataFrame, version: int) -> threading.Thread:
+    """Запускает расчёт таблицы соседей для новой версии каталога в фоне."""
+    global _latest_version
+    with _lock:
+        _latest_version = version
+    th = threading.Thread(target=_build, args=(df_, version), name=f"similar-v{version}", daemon=True)
+    th.start()
+    return th
+
+
+def neighbors(row_id, version: int, k: int = TOP_K) -> List[Tuple[object, float]]:
+    """
+    Похожие строки [(индекс строки, косинус)] — только если таблица
+    посчитана для этой версии каталога; иначе пусто (ещё считается).
+    """
+    with _lock:
+        if _table.get("version") != version or _table.get("ids") is None:
+            return []
+        p = _table["pos"].get(row_id)
+        if p is None:
+            return []
+        ids = _table["ids"][p]
+        scores = _table["scores"][p]
+        labels = _table["labels"]
+    return [(labels[i], float(s)) for i, s in zip(ids[:k], scores[:k]) if i >= 0]
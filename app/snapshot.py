@@ -0,0 +1,135 @@
+# app/snapshot.py
+"""
+Локальный снапшот каталога: DataFrame + готовые индексы в одном сжатом файле.
+
+Нужен для тёплого старта и для работы, когда Google Sheets медленный или
+упёрся в квоту: бот поднимается из снапшота, а свежая загрузка идёт в фоне.
+
+Формат: gzip(pickle) — индексы (dict/set) всё равно сериализуются
+pickle'ом; pyarrow-колонки каталога (app/compact.py) pickle переносит как есть.
+"""
+import os
+import glob
+import gzip
+import time
+import atexit
+import pickle
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger("bot.snapshot")
+
+SNAPSHOT_FORMAT = 1
+STALE_TMP_SEC = 600.0       # tmp-файл старше этого — остаток прерванной записи
+EXIT_JOIN_SEC = 30.0        # сколько при выходе ждать фоновую запись
+
+_save_lock = threading.Lock()
+_save_thread: Optional[threading.Thread] = None
+
+
+def _clean_stale_tmp(path: str) -> None:
+    """
+    Удалить tmp-файлы прерванных записей (процесс убит посреди сохранения):
+    свои — сразу (вызывается под _save_lock), чужие — только старые, чтобы не
+    задеть запись, которая идёт прямо сейчас в другом процессе.
+    """
+    own = f"{path}.tmp.{os.getpid()}"
+    now = time.time()
+    for tmp in glob.glob(glob.escape(path) + ".tmp.*"):
+        try:
+            if tmp == own or now - os.path.getmtime(tmp) > STALE_TMP_SEC:
+                os.remove(tmp)
+                logger.info(f"[snapshot] удалён остаток прерванной записи {tmp}")
+        except OSError:
+            pass
+
+
+def save_snapshot(path: str, df_: pd.DataFrame, indexes: Dict[str, object], meta: Optional[dict] = None) -> bool:
+    """Атомарно пишет снапшот (tmp-файл + os.replace)."""
+    if not path:
+        return False
+    t0 = time.time()
+    payload = {
+        "format": SNAPSHOT_FORMAT,
+        "saved_at": time.time(),
+        "meta": dict(meta or {}),
+        "df": df_,
+        "indexes": indexes,
+    }
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with _save_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            _clean_stale_tmp(path)
+            with gzip.open(tmp, "wb", compresslevel=1) as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+    except Exception as e:
+        logger.warning(f"[snapshot] не удалось сохранить {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+    size_kb = os.path.getsize(path) / 1024
+    logger.info(f"[snapshot] сохранён {path}: {len(df_)} строк, {size_kb:.0f} KB за {time.time() - t0:.2f}s")
+    return True
+
+
+def save_snapshot_async(path: str, df_: pd.DataFrame, indexes: Dict[str, object], meta: Optional[dict] = None) -> None:
+    """
+    Сохранение в фоне — перезагрузка каталога не ждёт записи на диск.
+    Поток daemon, но при штатном выходе его дожидается _join_on_exit.
+    """
+    global _save_thread
+    if not path:
+        return
+    t = threading.Thread(
+        target=save_snapshot, args=(path, df_, indexes, meta), name="snapshot-save", daemon=True
+    )
+    t.start()
+    _save_thread = t
+
+
+def _join_on_exit() -> None:
+    t = _save_thread
+    if t is not None and t.is_alive():
+        logger.info("[snapshot] выход: жду завершения записи снапшота")
+        t.join(EXIT_JOIN_SEC)
+
+
+atexit.register(_join_on_exit)
+
+
+def load_snapshot(path: str) -> Optional[Tuple[pd.DataFrame, Dict[str, object], dict]]:
+    """(df, indexes, meta) или None, если файла нет / он битый / другой формат."""
+    if not path:
+        return None
+    with _save_lock:
+        _clean_stale_tmp(path)
+    if not os.path.exists(path):
+        return None
+    t0 = time.time()
+    try:
+        with gzip.open(path, "rb") as f:
+            payload = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"[snapshot] не удалось прочитать {path}: {e}")
+        return None
+
+    if not isinstance(payload, dict) or payload.get("format") != SNAPSHOT_FORMAT:
+        logger.info(f"[snapshot] {path}: другой формат — пропускаем")
+        return None
+
+    meta = dict(payload.get("meta") or {})
+    meta["saved_at"] = payload.get("saved_at", 0.0)
+    age = time.time() - meta["saved_at"]
+    logger.info(
+        f"[snapshot] загружен {path}: {len(payload['df'])} строк "
+        f"(возраст {age:.0f}s) за {(time.time() - t0) * 1000:.0f} ms"
+    )
+    return payload["df"], payload["indexes"], meta
@@ -0,0 +1,173 @@
+# app/sources.py
+"""
+Откуда грузится каталог: Google Sheets или локальный файл.
+
+CATALOG_SOURCE:
+- "sheets" (по умолчанию) — лист SAP одним batchGet (app/sheets.py);
+- "file:<путь>" — выгрузка из SAP, формат по расширению:
+  .xlsx/.xlsm — openpyxl в read-only режиме (строки читаются потоком,
+  книга целиком в память не грузится), лист SAP_SHEET_NAME или первый;
+  .csv/.tsv — pandas по частям (CSV_CHUNK_ROWS строк);
+  .parquet — pandas + pyarrow.
+
+Все источники отдают одно и то же: DataFrame со строковыми значениями,
+как их показывает таблица (12.0 → "12", пусто → ""), и только колонками
+SAP_COLUMNS. Дальше — общий путь _load_sap_dataframe: нормализация,
+дельта-синхронизация, индексы. Полностью пустые строки файла отбрасываются.
+"""
+import os
+import logging
+from datetime import date, datetime
+from typing import Callable, List, Optional
+
+import pandas as pd
+
+from app import probe, sheets
+
+logger = logging.getLogger("bot.sources")
+
+try:
+    from app.config import CATALOG_SOURCE, SAP_SHEET_NAME
+except Exception:
+    CATALOG_SOURCE = os.getenv("CATALOG_SOURCE", "sheets")
+    SAP_SHEET_NAME = os.getenv("SAP_SHEET_NAME", "SAP")
+
+CSV_CHUNK_ROWS = 50000
+
+
+def cell_str(v) -> str:
+    """Значение ячейки → строка, как её показывает Google Sheets."""
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, float):
+        if v != v:   # NaN
+            return ""
+        return str(int(v)) if v.is_integer() else repr(v)
+    if isinstance(v, datetime):
+        return v.strftime("%d.%m.%Y %H:%M:%S") if (v.hour or v.minute or v.second) else v.strftime("%d.%m.%Y")
+    if isinstance(v, date):
+        return v.strftime("%d.%m.%Y")
+    return str(v)
+
+
+def _picked_frame(header: List[str], columns: List[List[str]]) -> pd.DataFrame:
+    out = pd.DataFrame(dict(zip(header, columns)), columns=header) if header else pd.DataFrame()
+    if len(out.columns):
+        out = out[(out != "").any(axis=1)].reset_index(drop=True)
+    return out
+
+
+class CatalogSource:
+    name = "?"
+
+    def load(self) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def probe(self) -> Optional[probe.ChangeProbe]:
+        """Дешёвая проверка изменений этого источника (app/probe.py)."""
+        return None
+
+
+class SheetsSource(CatalogSource):
+    name = "sheets"
+
+    def __init__(self, client_factory: Callable[[], object]):
+        self.client_factory = client_factory
+
+    def load(self) -> pd.DataFrame:
+        # один values.batchGet: только нужные колонки SAP (+ пользователи и заголовок "История")
+        values = sheets.fetch_all(self.client_factory())
+        if not values:
+            return pd.DataFrame()
+        return pd.DataFrame(values[1:], columns=values[0])
+
+    def probe(self) -> Optional[probe.ChangeProbe]:
+        return probe.make_probe(self.client_factory)
+
+
+class FileSource(CatalogSource):
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def name(self) -> str:
+        return f"file:{self.path}"
+
+    def probe(self) -> Optional[probe.ChangeProbe]:
+        return probe.FileProbe(self.path)
+
+
+class XlsxSource(FileSource):
+    def load(self) -> pd.DataFrame:
+        from openpyxl import load_workbook
+
+        wb = load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            ws = wb[SAP_SHEET_NAME] if SAP_SHEET_NAME in wb.sheetnames else wb.worksheets[0]
+            rows = ws.iter_rows(values_only=True)
+            first = next(rows, None)
+            if first is None:
+                return pd.DataFrame()
+            header = [cell_str(c).strip().lower() for c in first]
+            picked = sheets.pick_columns(header)
+            columns: List[List[str]] = [[] for _ in picked]
+            for r in rows:
+                n = len(r)
+                for k, i in enumerate(picked):
+                    columns[k].append(cell_str(r[i]) if i < n else "")
+        finally:
+            wb.close()
+        return _picked_frame([header[i] for i in picked], columns)
+
+
+class CsvSource(FileSource):
+    def load(self) -> pd.DataFrame:
+        sep = "\t" if self.path.lower().endswith(".tsv") else ","
+        keep = set(sheets.SAP_COLUMNS)
+        everything = not keep or "*" in keep
+        chunks = pd.read_csv(
+            self.path, sep=sep, dtype=str, keep_default_na=False, encoding="utf-8-sig",
+            chunksize=CSV_CHUNK_ROWS,
+            usecols=None if everything else (lambda c: str(c).strip().lower() in keep),
+        )
+        parts = list(chunks)
+        if not parts:
+            return pd.DataFrame()
+        out = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        out.columns = [str(c).strip().lower() for c in out.columns]
+        return _picked_frame(list(out.columns), [out[c].tolist() for c in out.columns])
+
+
+class ParquetSource(FileSource):
+    def load(self) -> pd.DataFrame:
+        try:
+            raw = pd.read_parquet(self.path)
+        except ImportError as e:
+            raise RuntimeError(f"Parquet требует pyarrow: {e}")
+        raw.columns = [str(c).strip().lower() for c in raw.columns]
+        header = [raw.columns[i] for i in sheets.pick_columns(list(raw.columns))]
+        return _picked_frame(header, [[cell_str(v) for v in raw[c].tolist()] for c in header])
+
+
+FILE_SOURCES = {
+    ".xlsx": XlsxSource,
+    ".xlsm": XlsxSource,
+    ".csv": CsvSource,
+    ".tsv": CsvSource,
+    ".parquet": ParquetSource,
+}
+
+
+def make_source(client_factory: Callable[[], object], spec: str = "") -> CatalogSource:
+    spec = (spec or CATALOG_SOURCE or "sheets").strip()
+    if spec.startswith("file:"):
+        path = spec[5:]
+        cls = FILE_SOURCES.get(os.path.splitext(path)[1].lower())
+        if cls is not None:
+            return cls(path)
+        logger.error(f"[sources] формат {path!r} не поддерживается ({', '.join(FILE_SOURCES)}) — используем Google Sheets")
+    elif spec != "sheets":
+        logger.error(f"[sources] неизвестный CATALOG_SOURCE={spec!r} — используем Google Sheets")
+    return SheetsSource(client_factory)
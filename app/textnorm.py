@@ -0,0 +1,112 @@
+# app/textnorm.py
+"""
+Нормализация текста для индексов и запросов.
+
+Раньше _norm_code / squash / normalize делали re.sub на каждое значение:
+при построении индексов — по строкам каталога (одни и те же "тип",
+"изготовитель" — десятки тысяч раз), при поиске — по каждому токену
+запроса. Здесь:
+
+- таблицы str.translate вместо re.sub. Для кодов таблица ASCII
+  (o → 0, всё кроме a-z0-9 удаляется; не-ASCII отбрасывается заранее).
+  squash / normalize: ASCII-строки (коды, латиница) — через translate,
+  у которого для ASCII быстрый путь в C; строки с кириллицей — заранее
+  скомпилированной регуляркой (translate по словарю для не-ASCII
+  медленнее re.sub);
+- map_values / map_series — нормализация колонки целиком: функция
+  считается один раз на различное значение (у category — по категориям);
+- q_* — те же функции с LRU-кешем для запросов (повторяющиеся токены,
+  коды из кнопок, одинаковые запросы разных пользователей).
+
+Результат совпадает с прежними регулярками символ в символ
+(python -m app.bench norm проверяет и замеряет).
+"""
+import re
+import string
+from functools import lru_cache
+from typing import Callable, Dict, List, Sequence
+
+import pandas as pd
+
+QUERY_CACHE_SIZE = 4096
+
+
+def _ascii_table(keep: Callable[[str], bool]) -> Dict[int, object]:
+    """Таблица str.translate для ASCII: символ сохраняется, если keep(ch), иначе удаляется."""
+    return {c: (c if keep(chr(c)) else None) for c in range(128)}
+
+
+# [a-z0-9] после lower(); буква o — цифра 0 (в кодах их путают)
+_CODE_TABLE = {c: None for c in range(128)}
+_CODE_TABLE.update({ord(ch): ord(ch) for ch in string.ascii_lowercase + string.digits})
+_CODE_TABLE[ord("o")] = ord("0")
+
+_SQUASH_TABLE = _ascii_table(str.isalnum)                                          # [\W_]+ → ""
+_NORMALIZE_TABLE = _ascii_table(lambda ch: ch.isalnum() or ch == "_" or ch.isspace())  # [^\w\s] → ""
+_SQUASH_RE = re.compile(r"[\W_]+")
+_NORMALIZE_RE = re.compile(r"[^\w\s]")
+
+
+def norm_code(x) -> str:
+    """lower, o → 0, только [a-z0-9]."""
+    s = str(x or "").lower()
+    if not s.isascii():
+        s = s.encode("ascii", "ignore").decode("ascii")
+    return s.translate(_CODE_TABLE)
+
+
+def norm_str(x) -> str:
+    return str(x or "").strip().lower()
+
+
+def squash(text) -> str:
+    """Только буквы и цифры в нижнем регистре (без пробелов, знаков и "_")."""
+    s = str(text or "").lower()
+    return s.translate(_SQUASH_TABLE) if s.isascii() else _SQUASH_RE.sub("", s)
+
+
+def normalize(text) -> str:
+    """Нижний регистр без знаков препинания; пробелы между словами остаются."""
+    s = str(text or "").lower()
+    return (s.translate(_NORMALIZE_TABLE) if s.isascii() else _NORMALIZE_RE.sub("", s)).strip()
+
+
+# ---------- Запросы ----------
+q_norm_code = lru_cache(maxsize=QUERY_CACHE_SIZE)(norm_code)
+q_squash = lru_cache(maxsize=QUERY_CACHE_SIZE)(squash)
+q_normalize = lru_cache(maxsize=QUERY_CACHE_SIZE)(normalize)
+
+
+def cache_info() -> Dict[str, object]:
+    return {f.__wrapped__.__name__: f.cache_info() for f in (q_norm_code, q_squash, q_normalize)}
+
+
+# ---------- Колонки ----------
+def map_values(values: Sequence, fn: Callable) -> List:
+    """[fn(v) for v in values], но fn считается один раз на различное значение."""
+    memo: Dict[object, object] = dict.fromkeys(values)
+    for v in memo:
+        memo[v] = fn(v)
+    return [memo[v] for v in values]
+
+
+def map_series(s: pd.Series, fn: Callable) -> List:
+    """map_values для колонки; у category fn считается по категориям, строки — по кодам."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        mapped = [fn(c) for c in s.cat.categories.tolist()]
+        missing = None
+        out = []
+        for code in s.cat.codes.tolist():
+            if code < 0:
+                if missing is None:
+                    missing = fn(float("nan"))   # как у tolist() для пропуска
+                out.append(missing)
+            else:
+                out.append(mapped[code])
+        return out
+    return map_values(s.tolist(), fn)
+
+
+def lower_column(s: pd.Series) -> pd.Series:
+    """astype(str).str.strip().str.lower() по различным значениям колонки."""
+    return pd.Series(map_series(s, lambda v: str(v).strip().lower()), index=s.index, dtype=object)
@@ -14,6 +14,10 @@ function U(v){ return String(v || "").trim().toUpperCase(); }
 const q = document.getElementById("q");
 const btn = document.getElementById("btn");
 const clr = document.getElementById("clr");
+const withinBtn = document.getElementById("within");
+
+// id прошлой выдачи — для "искать в результатах"
+let lastRid = "";
 const list = document.getElementById("list");
 const countBadge = document.querySelector(".count");
 
@@ -59,15 +63,18 @@ function renderCard(item){
   `;
 }
 
-async function doSearch(){
+async function doSearch(inResults = false){
   const query = q.value.trim();
   if (!query) return info("Введите запрос");
 
   info("Поиск…");
 
+  let url = `/app/api/search?q=${encodeURIComponent(query)}`;
+  if (inResults && lastRid) url += `&within=${encodeURIComponent(lastRid)}`;
+
   let data;
   try {
-    const r = await fetch(`/app/api/search?q=${encodeURIComponent(query)}`);
+    const r = await fetch(url);
     data = await r.json();
   } catch (e) {
     return info("Ошибка сети / сервера");
@@ -80,6 +87,9 @@ async function doSearch(){
   const items = data.items || [];
   countBadge.textContent = String(items.length);
 
+  lastRid = data.rid || "";
+  withinBtn.disabled = !lastRid || !items.length;
+
   if (!items.length){
     return info("Ничего не найдено");
   }
@@ -96,8 +106,14 @@ async function doSearch(){
   });
 }
 
-btn.onclick = doSearch;
+btn.onclick = () => doSearch();
+withinBtn.onclick = () => doSearch(true);
 q.onkeydown = e => { if(e.key === "Enter") doSearch(); };
-clr.onclick = () => { q.value = ""; info("Введите запрос"); };
+clr.onclick = () => {
+  q.value = "";
+  lastRid = "";
+  withinBtn.disabled = true;
+  info("Введите запрос");
+};
 
 info("Введите запрос для поиска");
@@ -1,8 +1,14 @@
+import json
 import logging
+import uuid
 from pathlib import Path
 from aiohttp import web
+from cachetools import TTLCache
 
 import app.data as data
+import app.query as query
+import app.ranking as ranking
+from app import gateway, gclient, parts, prefork, push, textnorm
 
 logger = logging.getLogger("bot.webapp")
 
@@ -10,6 +16,9 @@ BASE_DIR = Path(__file__).resolve().parent
 WEB_DIR = BASE_DIR / "web"
 STATIC_DIR = WEB_DIR / "static"
 
+# Выдачи Mini App для "искать в результатах": rid → (версия каталога, id строк)
+_result_sets: TTLCache = TTLCache(maxsize=1024, ttl=1800)
+
 
 # ---------------- Pages ----------------
 async def page_index(request: web.Request):
@@ -69,53 +78,105 @@ async def _resolve_image_for_code(code: str, row: dict | None = None) -> str:
         return ""
 
 
+# Поля строки для фронта (порядок ключей — как в ответе)
+PUBLIC_FIELDS = (
+    "код", "наименование", "изготовитель", "парт номер", "oem парт номер",
+    "тип", "количество", "цена", "валюта", "oem",
+    "image",   # важно: отдаём и raw, и итоговый url (image_url)
+)
+
+
+def _public_fields(row) -> dict:
+    return {k: str(row.get(k, "")).strip() for k in PUBLIC_FIELDS}
+
+
+def _public_json(row) -> str:
+    """Поля строки как JSON-объект без закрывающей скобки (дальше дописывается image_url)."""
+    return json.dumps(_public_fields(row))[:-1]
+
+
 async def _row_public(row: dict) -> dict:
     """
     Что отдаём фронту. Добавляем image_url уже готовый.
+    Для Part поля берутся из кеша версии каталога (app/parts.py).
     """
+    fields = row.cached("public", _public_fields) if isinstance(row, parts.Part) else _public_fields(row)
+    image_url = await _resolve_image_for_code(fields["код"], row=row)
+    return {**fields, "image_url": image_url}
+
+
+async def _row_public_json(row) -> str:
+    """_row_public сразу JSON-строкой: готовый фрагмент строки + image_url."""
+    head = row.cached("public_json", _public_json) if isinstance(row, parts.Part) else _public_json(row)
     code = str(row.get("код", "")).strip()
     image_url = await _resolve_image_for_code(code, row=row)
+    return f'{head}, "image_url": {json.dumps(image_url)}}}'
+
 
-    return {
-        "код": code,
-        "наименование": str(row.get("наименование", "")).strip(),
-        "изготовитель": str(row.get("изготовитель", "")).strip(),
-        "парт номер": str(row.get("парт номер", "")).strip(),
-        "oem парт номер": str(row.get("oem парт номер", "")).strip(),
-        "тип": str(row.get("тип", "")).strip(),
-        "количество": str(row.get("количество", "")).strip(),
-        "цена": str(row.get("цена", "")).strip(),
-        "валюта": str(row.get("валюта", "")).strip(),
-        "oem": str(row.get("oem", "")).strip(),
-
-        # важно: отдаём и raw, и итоговый url
-        "image": str(row.get("image", "")).strip(),
-        "image_url": image_url,
-    }
-
-
-def _ensure_loaded():
+def _json_with_items(head: dict, items: list, status: int = 200) -> web.Response:
+    """json_response(head + {"items": [...]}) из готовых JSON-фрагментов строк."""
+    body = json.dumps(head)[:-1] + ', "items": [' + ", ".join(items) + "]}"
+    return web.Response(text=body, status=status, content_type="application/json")
+
+
+async def _ensure_loaded():
     if data.df is None:
-        data.ensure_fresh_data(force=True)
+        try:
+            await gateway.run("catalog.load", data.ensure_fresh_data)
+        except Exception as e:
+            logger.warning(f"catalog load failed: {e}")
     return data.df is not None
 
 
+def _rows_by_ids(ids) -> list:
+    """
+    Строки по индексам; пропавшие после смены каталога молча пропускаем.
+    """
+    if data.df is None:
+        return []
+    rows = []
+    try:
+        for i in ids:
+            try:
+                rows.append(data.row_dict(i))
+            except KeyError:
+                continue
+    except Exception:
+        logger.exception("rows by ids failed")
+        return []
+    return rows
+
+
 def _search_rows(query: str):
     """
     Поиск через существующую логику data.py (индексы/нормализация).
     """
-    q = (query or "").strip()
+    return _rows_by_ids(_search_ids(query))
+
+
+def _search_ids(text: str) -> list:
+    """
+    То же, что _search_rows, но возвращает индексы строк data.df.
+    """
+    q = (text or "").strip()
     if not q:
         return []
 
-    if not _ensure_loaded():
+    df_ = data.df
+    if df_ is None:
         return []
 
-    df_ = data.df
+    # запрос с синтаксисом — сразу по пофилдовым индексам
+    if query.is_structured(q):
+        try:
+            return query.run_query(q)
+        except Exception:
+            logger.exception("structured query failed")
+            return []
 
-    tokens = data.normalize(q).split()
-    q_squash = data.squash(q)
-    norm_code = data._norm_code(q)
+    tokens = textnorm.q_normalize(q).split()
+    q_squash = textnorm.q_squash(q)
+    norm_code = textnorm.q_norm_code(q)
 
     matched = set()
 
@@ -128,52 +189,52 @@ def _search_rows(query: str):
     except Exception:
         matched = set()
 
-    # 2) фолбэк по “склеенному”
+    # 2) фолбэк по “склеенному” (SQLite FTS5 или df, см. data.squash_rows)
     if not matched and q_squash:
         try:
-            import re
-            import pandas as pd
-
-            mask_any = pd.Series(False, index=df_.index)
-            for col in ["тип", "наименование", "код", "oem", "изготовитель", "парт номер", "oem парт номер"]:
-                series = data._safe_col(df_, col)
-                if series is None:
-                    continue
-                series_sq = series.str.replace(r"[\W_]+", "", regex=True)
-                mask_any |= series_sq.str.contains(re.escape(q_squash), na=False)
-
-            matched = set(df_.index[mask_any])
+            matched = data.squash_rows(
+                q_squash, ["тип", "наименование", "код", "oem", "изготовитель", "парт номер", "oem парт номер"]
+            )
         except Exception:
             matched = set()
 
-    if not matched:
-        return []
-
-    try:
-        return [r.to_dict() for _, r in df_.loc[list(matched)].iterrows()]
-    except Exception:
-        return []
+    return ranking.rank(matched, q)
 
 
 # ---------------- API ----------------
 async def api_search(request: web.Request):
     q = request.query.get("q", "").strip()
     user_id = request.query.get("user_id", "0")
+    within = request.query.get("within", "").strip()
 
     try:
-        rows = _search_rows(q)
+        # within=<rid> — уточнение внутри прошлой выдачи (если каталог не менялся)
+        prev = _result_sets.get(within) if within else None
+        if prev and prev[0] == data._catalog_version and q:
+            keep = query.refine_query(prev[1], q)
+            ids = [i for i in prev[1] if i in keep]
+        else:
+            within = ""
+            await _ensure_loaded()
+            ids = _search_ids(q)
+
+        rid = uuid.uuid4().hex[:16]
+        _result_sets[rid] = (data._catalog_version, ids)
+
+        rows = _rows_by_ids(ids)
         # ВАЖНО: обогащаем строки image_url по коду
         items = []
         for r in rows:
-            items.append(await _row_public(r))
+            items.append(await _row_public_json(r))
 
-        return web.json_response({
+        return _json_with_items({
             "ok": True,
             "q": q,
             "user_id": str(user_id),
+            "rid": rid,
+            "within": within,
             "count": len(items),
-            "items": items
-        })
+        }, items)
     except Exception as e:
         logger.exception("api_search failed")
         return web.json_response({"ok": False, "error": str(e)}, status=500)
@@ -187,29 +248,67 @@ async def api_item(request: web.Request):
     if not code:
         return web.json_response({"ok": False, "error": "code is required"}, status=400)
 
-    if not _ensure_loaded():
+    if not await _ensure_loaded():
         return web.json_response({"ok": False, "error": "data not loaded"}, status=500)
 
     try:
-        hit = data.df[data.df["код"].astype(str).str.lower() == code] if "код" in data.df.columns else None
-        if hit is None or hit.empty:
+        row_id = data.find_row_by_code(code)
+        row = data.part(row_id) if row_id is not None else None
+        if row is None:
             return web.json_response({"ok": False, "error": "not found"}, status=404)
 
-        row = hit.iloc[0].to_dict()
         item = await _row_public(row)
 
         # Добавим текст описания (как форматируешь в боте)
         try:
-            item["text"] = data.format_row(row)
+            item["text"] = data.card_html(row)
         except Exception:
             item["text"] = ""
 
+        # Похожие детали — из фоновой таблицы соседей (без картинок, только для списка)
+        item["similar"] = [
+            {
+                "код": str(r.get("код", "")).strip(),
+                "наименование": str(r.get("наименование", "")).strip(),
+                "тип": str(r.get("тип", "")).strip(),
+                "изготовитель": str(r.get("изготовитель", "")).strip(),
+            }
+            for r in _rows_by_ids(data.similar_rows(row_id))
+        ]
+
         return web.json_response({"ok": True, "item": item})
     except Exception as e:
         logger.exception("api_item failed")
         return web.json_response({"ok": False, "error": str(e)}, status=500)
 
 
+async def api_analogs(request: web.Request):
+    """
+    Аналоги детали по общим OEM / парт-номерам (группа предрасчитана при загрузке).
+    """
+    code = _norm_code(request.query.get("code", ""))
+    if not code:
+        return web.json_response({"ok": False, "error": "code is required"}, status=400)
+
+    if not await _ensure_loaded():
+        return web.json_response({"ok": False, "error": "data not loaded"}, status=500)
+
+    row_id = data.find_row_by_code(code)
+    if row_id is None:
+        return web.json_response({"ok": False, "error": "not found"}, status=404)
+
+    try:
+        items = [await _row_public_json(r) for r in _rows_by_ids(data.analogs_of(row_id))]
+        return _json_with_items({
+            "ok": True,
+            "code": code,
+            "count": len(items),
+        }, items)
+    except Exception as e:
+        logger.exception("api_analogs failed")
+        return web.json_response({"ok": False, "error": str(e)}, status=500)
+
+
 async def api_issue(request: web.Request):
     """
     Списание из Mini App -> лист История.
@@ -231,16 +330,15 @@ async def api_issue(request: web.Request):
     if not qty:
         return web.json_response({"ok": False, "error": "qty is required"}, status=400)
 
-    if not _ensure_loaded():
+    if not await _ensure_loaded():
         return web.json_response({"ok": False, "error": "data not loaded"}, status=500)
 
     # найдём деталь по коду
     part = None
     try:
-        if "код" in data.df.columns:
-            hit = data.df[data.df["код"].astype(str).str.lower() == code]
-            if not hit.empty:
-                part = hit.iloc[0].to_dict()
+        row_id = data.find_row_by_code(code)
+        if row_id is not None:
+            part = data.part(row_id)
     except Exception:
         part = None
 
@@ -249,21 +347,10 @@ async def api_issue(request: web.Request):
 
     # пишем в История
     try:
-        from app.config import SPREADSHEET_URL
-        import gspread
-
-        client = data.get_gs_client()
-        sh = client.open_by_url(SPREADSHEET_URL)
-
-        try:
-            ws = sh.worksheet("История")
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(title="История", rows=1000, cols=12)
-            ws.append_row(["Дата", "ID", "Имя", "Тип", "Наименование", "Код", "Количество", "Коментарий"])
-
         ts = data.now_local_str()
 
-        ws.append_row(
+        written = await gateway.write(
+            gclient.HISTORY_SHEET,
             [
                 ts,
                 str(user_id),
@@ -274,15 +361,55 @@ async def api_issue(request: web.Request):
                 str(qty),
                 comment,
             ],
-            value_input_option="USER_ENTERED",
+            gclient.HISTORY_HEADER,
         )
 
-        return web.json_response({"ok": True})
+        # deferred — таблица недоступна, строка будет дописана позже
+        return web.json_response({"ok": True, "deferred": not written})
     except Exception as e:
         logger.exception("api_issue failed")
         return web.json_response({"ok": False, "error": str(e)}, status=500)
 
 
+# ---------------- Admin: push об изменении таблицы ----------------
+def _reload_catalog() -> None:
+    # prefork: каталог обновляет родитель; иначе — дельта-синхронизация здесь
+    if not prefork.request_refresh():
+        data.ensure_fresh_data(force=True)
+
+
+_reloader = push.ReloadScheduler(_reload_catalog)
+
+
+async def api_catalog_changed(request: web.Request):
+    """
+    POST /admin/catalog/changed от Apps Script onEdit (подпись — см. app/push.py).
+    Ставит отложенную перезагрузку и сразу отвечает 202.
+    """
+    if not push.CATALOG_PUSH_SECRET:
+        return web.json_response({"ok": False, "error": "push disabled"}, status=404)
+
+    body = await request.read()
+    if not push.verify(
+        push.CATALOG_PUSH_SECRET,
+        request.headers.get(push.TIMESTAMP_HEADER, ""),
+        request.headers.get(push.SIGNATURE_HEADER, ""),
+        body,
+    ):
+        return web.json_response({"ok": False, "error": "bad signature"}, status=403)
+
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        payload = {}
+    sheet = str(payload.get("sheet") or "") if isinstance(payload, dict) else ""
+    if sheet and sheet != data.SAP_SHEET_NAME:
+        return web.json_response({"ok": True, "status": "ignored", "sheet": sheet}, status=202)
+
+    status = _reloader.trigger()
+    return web.json_response({"ok": True, "status": status, **_reloader.stats()}, status=202)
+
+
 # ---------------- Build app ----------------
 def build_web_app() -> web.Application:
     app = web.Application()
@@ -309,9 +436,15 @@ def build_web_app() -> web.Application:
     app.router.add_get("/app/api/item", api_item)
     app.router.add_get("/api/item", api_item)
 
+    app.router.add_get("/app/api/analogs", api_analogs)
+    app.router.add_get("/api/analogs", api_analogs)
+
     app.router.add_post("/app/api/issue", api_issue)
     app.router.add_post("/api/issue", api_issue)
 
+    # Admin
+    app.router.add_post(push.PUSH_PATH, api_catalog_changed)
+
     # Static (двойные пути)
     app.router.add_static("/static/", str(STATIC_DIR), show_index=False)
     app.router.add_static("/app/static/", str(STATIC_DIR), show_index=False)
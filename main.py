@@ -1,8 +1,10 @@
 import asyncio
+import json
 import logging
 import signal
+import socket
 from aiohttp import web
-from telegram import Update
+from telegram import Bot, Update
 from telegram.ext import ApplicationBuilder
 
 # Импорт конфигураций и обработчиков из вашего проекта 
@@ -13,8 +15,11 @@ from app.config import (
     PORT, 
     WEBHOOK_SECRET_TOKEN, 
     TZ_NAME,
+    WEB_WORKERS,
 )
-from app.data import initial_load
+import app.data as app_data
+from app import coordinator, prefork
+from app.data import initial_load, initial_load_async, load_snapshot
 from app.handlers import register_handlers
 from app.webapp import build_web_app
 
@@ -43,17 +48,52 @@ def _normalize_local_path(path: str) -> str:
         p = f"/{p}"
     return p
 
-async def main_async():
+async def _set_webhook(bot: Bot) -> None:
+    """Установка вебхука в Telegram — один раз при старте сервиса."""
+    await bot.set_webhook(
+        url=_normalize_full_url(WEBHOOK_URL, WEBHOOK_PATH),
+        secret_token=WEBHOOK_SECRET_TOKEN or None,
+        drop_pending_updates=True,
+        allowed_updates=None
+    )
+
+
+def _set_webhook_from_parent() -> None:
+    """prefork: вебхук ставит родитель до fork, перезапущенные воркеры его не трогают."""
+    async def _run():
+        async with Bot(TELEGRAM_TOKEN) as bot:
+            await _set_webhook(bot)
+    asyncio.run(_run())
+
+
+async def main_async(sock: socket.socket | None = None, worker_id: int = 0, n_workers: int = 1):
     logger.info(f"🚀 Запуск системы (Часовой пояс: {TZ_NAME}) ")
 
-    # 1) Загрузка базы данных (Google Sheets) перед стартом 
-    try:
-        initial_load()
-        logger.info("✅ База данных успешно загружена")
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка при загрузке данных: {e}")
-        # В продакшене можно решить, останавливать ли приложение или продолжать
-        # return 
+    # 1) Загрузка базы данных: сначала локальный снапшот (мгновенно),
+    #    свежие данные из Google Sheets догружаются в фоне.
+    #    Воркер prefork-режима получает уже загруженный каталог от родителя.
+    refresh_task: asyncio.Task | None = None
+    if sock is not None:
+        logger.info(f"👷 Воркер {worker_id}/{n_workers}: каталог v{app_data._catalog_version} от родителя")
+    elif load_snapshot():
+        logger.info("⚡ Каталог поднят из снапшота, обновление из Google Sheets — в фоне")
+
+        async def _refresh_in_background():
+            try:
+                await initial_load_async()
+                logger.info("✅ База данных обновлена из Google Sheets")
+            except Exception as e:
+                logger.error(f"❌ Фоновое обновление не удалось, работаем на снапшоте: {e}")
+
+        refresh_task = asyncio.create_task(_refresh_in_background())
+    else:
+        try:
+            initial_load()
+            logger.info("✅ База данных успешно загружена")
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка при загрузке данных: {e}")
+            # В продакшене можно решить, останавливать ли приложение или продолжать
+            # return 
 
     # 2) Инициализация Telegram Application 
     tg_app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
@@ -76,7 +116,19 @@ async def main_async():
                 return web.Response(status=403, text="Forbidden")
 
         try:
-            data = await request.json()
+            body = await request.read()
+            data = json.loads(body)
+
+            # prefork: апдейт обрабатывает воркер-владелец пользователя (его состояние диалогов)
+            if n_workers > 1 and prefork.FORWARD_HEADER not in request.headers:
+                owner = prefork.owner_of(prefork.update_user_id(data), n_workers)
+                if owner != worker_id:
+                    try:
+                        status = await prefork.forward(owner, request.path, body, dict(request.headers))
+                        return web.Response(status=status, text="OK")
+                    except Exception as e:
+                        logger.warning(f"⚠️ Воркер {owner} недоступен, обрабатываем сами: {e}")
+
             update = Update.de_json(data, tg_app.bot)
             # Обработка обновления в фоновой задаче
             asyncio.create_task(tg_app.process_update(update))
@@ -93,13 +145,9 @@ async def main_async():
     await tg_app.initialize()
     await tg_app.start()
 
-    # Установка вебхука в Telegram
-    await tg_app.bot.set_webhook(
-        url=full_webhook_url,
-        secret_token=WEBHOOK_SECRET_TOKEN or None,
-        drop_pending_updates=True,
-        allowed_updates=None
-    )
+    # Установка вебхука в Telegram (в prefork-режиме его ставит родитель)
+    if sock is None:
+        await _set_webhook(tg_app.bot)
 
     # 5) Запуск сервера aiohttp 
     runner = web.AppRunner(web_app)
@@ -107,7 +155,12 @@ async def main_async():
     
     # Railway передает PORT автоматически 
     server_port = int(PORT) if PORT else 8080
-    site = web.TCPSite(runner, host="0.0.0.0", port=server_port)
+    if sock is not None:
+        # общий слушающий сокет от родителя + свой unix-сокет для пересланных апдейтов
+        site = web.SockSite(runner, sock)
+        await web.UnixSite(runner, prefork.socket_path(worker_id)).start()
+    else:
+        site = web.TCPSite(runner, host="0.0.0.0", port=server_port)
     
     logger.info(f"🌐 Сервер Mini App запущен на порту {server_port}")
     logger.info(f"🔗 Webhook установлен на: {full_webhook_url}")
@@ -127,16 +180,42 @@ async def main_async():
         except NotImplementedError:
             pass # Для совместимости с Windows (локальная разработка)
 
+    if sock is not None:
+        # новая версия каталога от родителя — без перезапуска воркера (app/prefork.py);
+        # версию, опубликованную, пока воркер стартовал, подтягиваем сразу
+        loop.add_signal_handler(signal.SIGUSR2, prefork.on_catalog_signal)
+        prefork.on_catalog_signal()
+
     await stop_event.wait()
 
     # 6) Остановка сервисов 
     logger.info("🛑 Остановка приложения...")
+    if refresh_task is not None and not refresh_task.done():
+        # фоновую загрузку из Sheets не ждём — отменяем вместе с приложением
+        refresh_task.cancel()
+        try:
+            await refresh_task
+        except asyncio.CancelledError:
+            pass
+    await prefork.close_sessions()
+    if sock is None:
+        coordinator.release()
     await runner.cleanup()
     await tg_app.stop()
     await tg_app.shutdown()
     logger.info("✅ Приложение успешно остановлено")
 
+def _worker_main(sock: socket.socket, worker_id: int):
+    # Каталог обновляет только родитель — воркер не ходит в Sheets по TTL
+    app_data.AUTO_REFRESH = False
+    prefork.IS_WORKER = True
+    asyncio.run(main_async(sock=sock, worker_id=worker_id, n_workers=WEB_WORKERS))
+
+
 def main():
+    if WEB_WORKERS > 1:
+        prefork.run(WEB_WORKERS, int(PORT) if PORT else 8080, _worker_main, on_ready=_set_webhook_from_parent)
+        return
     try:
         asyncio.run(main_async())
     except KeyboardInterrupt:
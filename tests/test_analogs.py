@@ -0,0 +1,46 @@
+import pandas as pd
+
+import app.data as data
+
+
+def _install(rows):
+    df_ = pd.DataFrame(rows)
+    data._analog_row_keys, data._analog_key_rows = data.build_analog_index(df_)
+    return df_
+
+
+def test_same_brand_in_oem_does_not_group_unrelated_parts():
+    _install([
+        {"код": "a1", "oem": "BOSCH", "парт номер": "0451103336", "oem парт номер": ""},
+        {"код": "a2", "oem": "BOSCH", "парт номер": "0986452041", "oem парт номер": ""},
+        {"код": "a3", "oem": "BOSCH", "парт номер": "F026407006", "oem парт номер": ""},
+    ])
+    assert data.analogs_of(0) == []
+    assert data.analogs_of(1) == []
+
+
+def test_shared_part_number_links_rows_across_columns():
+    _install([
+        {"код": "a1", "oem": "MANN", "парт номер": "W 712/75", "oem парт номер": ""},
+        {"код": "a2", "oem": "VAG", "парт номер": "", "oem парт номер": "w712-75"},
+    ])
+    assert data.analogs_of(0) == [1]
+    assert data.analogs_of(1) == [0]
+
+
+def test_no_transitive_chains():
+    # a1 и a2 — общий парт-номер, a2 и a3 — общий OEM-номер; a1 и a3 ничем не связаны
+    _install([
+        {"код": "a1", "oem": "", "парт номер": "PN-1111", "oem парт номер": ""},
+        {"код": "a2", "oem": "", "парт номер": "PN-1111", "oem парт номер": "OE-2222"},
+        {"код": "a3", "oem": "", "парт номер": "", "oem парт номер": "OE-2222"},
+    ])
+    assert data.analogs_of(0) == [1]
+    assert data.analogs_of(1) == [0, 2]
+    assert data.analogs_of(2) == [1]
+
+
+def test_values_shared_by_too_many_rows_are_ignored():
+    n = data.ANALOG_MAX_KEY_ROWS + 1
+    _install([{"код": f"a{i}", "oem": "", "парт номер": "нет-номера", "oem парт номер": ""} for i in range(n)])
+    assert data.analogs_of(0) == []